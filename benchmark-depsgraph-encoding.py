@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+"""Compares JSON, BSON and MessagePack encoding of a realistic depsgraph.
+
+Reports the encoded size, and the time it takes to encode and decode the
+depsgraph in each format. Run from the Flamenco directory, with the msgpack
+module installed.
+"""
+
+import argparse
+import datetime
+import json
+import timeit
+
+import bson
+from bson import tz_util
+
+from flamenco.managers import msgpack_encoding
+
+
+def make_depsgraph(nr_of_tasks: int) -> dict:
+    """Returns a depsgraph like a Blender Render job with chunk size 1 would produce."""
+
+    job_id = bson.ObjectId()
+    manager_id = bson.ObjectId()
+    project_id = bson.ObjectId()
+    user_id = bson.ObjectId()
+    now = datetime.datetime.now(tz=tz_util.utc)
+    render_output = '/render/agent327/scenes/10_01_C/10_01_C-lighting/render-{job_id}/######.exr'
+
+    tasks = []
+    prev_task_id = None
+    for frame in range(1, nr_of_tasks + 1):
+        task_id = bson.ObjectId()
+        task = {
+            '_id': task_id,
+            '_created': now,
+            '_updated': now,
+            '_etag': '3a8d6d3a2f4c0f7a4b7c9d1e2f3a4b5c',
+            'job': job_id,
+            'manager': manager_id,
+            'project': project_id,
+            'user': user_id,
+            'name': f'blender-render-{frame}',
+            'status': 'queued',
+            'job_type': 'blender-render',
+            'task_type': 'blender-render',
+            'priority': 50,
+            'job_priority': 50,
+            'job_runnable': True,
+            'commands': [{
+                'name': 'blender_render',
+                'settings': {
+                    'blender_cmd': '{blender}',
+                    'filepath': '/shared/agent327/scenes/10_01_C/10_01_C-lighting.blend',
+                    'format': 'OPEN_EXR',
+                    'render_output': render_output,
+                    'frames': str(frame),
+                },
+            }],
+        }
+        if prev_task_id is not None and frame % 100 == 0:
+            task['parents'] = [prev_task_id]
+        tasks.append(task)
+        prev_task_id = task_id
+
+    return {'depsgraph': tasks}
+
+
+def json_default(obj):
+    if isinstance(obj, bson.ObjectId):
+        return str(obj)
+    if isinstance(obj, datetime.datetime):
+        return obj.isoformat()
+    raise TypeError(f'Unable to encode {type(obj)}')
+
+
+def json_encode(doc) -> bytes:
+    return json.dumps(doc, default=json_default).encode('utf8')
+
+
+def json_decode(data: bytes):
+    return json.loads(data.decode('utf8'))
+
+
+def bson_decode(data: bytes):
+    return bson.BSON(data).decode(codec_options=bson.CodecOptions(tz_aware=True))
+
+
+FORMATS = [
+    ('JSON', json_encode, json_decode),
+    ('BSON', bson.BSON.encode, bson_decode),
+    ('MessagePack', msgpack_encoding.packb, msgpack_encoding.unpackb),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-t', '--tasks', type=int, default=10000,
+                        help='nr of tasks in the depsgraph')
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+                        help='nr of times to encode and decode; the fastest run is reported')
+    args = parser.parse_args()
+
+    if not msgpack_encoding.available():
+        raise SystemExit('The msgpack module is not installed.')
+
+    depsgraph = make_depsgraph(args.tasks)
+    print(f'Depsgraph of {args.tasks} tasks, best of {args.repeat} runs:')
+    print(f'{"format":<12} {"size (kB)":>10} {"encode (ms)":>12} {"decode (ms)":>12}')
+
+    for name, encode, decode in FORMATS:
+        encoded = encode(depsgraph)
+        encode_time = min(timeit.repeat(lambda: encode(depsgraph), number=1, repeat=args.repeat))
+        decode_time = min(timeit.repeat(lambda: decode(encoded), number=1, repeat=args.repeat))
+        print(f'{name:<12} {len(encoded) / 1024:>10.1f} '
+              f'{encode_time * 1000:>12.1f} {decode_time * 1000:>12.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -12,10 +12,15 @@ from pillar.extension import PillarExtension
 
 EXTENSION_NAME = 'flamenco'
 
+# Fields returned by FlamencoExtension.update_status(), as far as the document has them.
+STATUS_PRE_IMAGE_PROJECTION = {'status': 1, 'job': 1, 'manager': 1, 'task_status_counts': 1,
+                               'compilation.cursor': 1}
+
 
 class FlamencoExtension(PillarExtension):
     celery_task_modules = [
         'flamenco.celery.job_archival',
+        'flamenco.celery.job_compilation',
     ]
     user_roles = {
         'flamenco-admin',
@@ -40,11 +45,14 @@ class FlamencoExtension(PillarExtension):
         import flamenco.tasks
         import flamenco.managers
         import flamenco.auth
+        import flamenco.managers.admission
 
         self.job_manager = flamenco.jobs.JobManager()
         self.task_manager = flamenco.tasks.TaskManager()
         self.manager_manager = flamenco.managers.ManagerManager()
         self.auth = flamenco.auth.Auth()
+        self.admission = flamenco.managers.admission.AdmissionController()
+        self.change_notifier = None  # created in setup_app(), as it depends on the config.
 
     @property
     def name(self):
@@ -62,7 +70,67 @@ class FlamencoExtension(PillarExtension):
         # Just so that it registers the management commands.
         from . import cli
 
-        return {'FLAMENCO_RESUME_ARCHIVING_AGE': datetime.timedelta(days=1)}
+        return {
+            'FLAMENCO_RESUME_ARCHIVING_AGE': datetime.timedelta(days=1),
+            # Limits on the decompressed size of gzip-compressed payloads sent by Managers.
+            'FLAMENCO_MAX_DECOMPRESSED_REQUEST_SIZE': 256 * 1024 * 1024,
+            'FLAMENCO_MAX_TASK_LOG_SIZE': 16 * 1024 * 1024,
+            'FLAMENCO_MAX_NDJSON_LINE_SIZE': 32 * 1024 * 1024,
+            # Task updates are handled in sub-batches of at most this many updates.
+            'FLAMENCO_TASK_UPDATE_SUB_BATCH_SIZE': 500,
+            # The depsgraph is fetched, claimed and encoded in batches of this many tasks.
+            'FLAMENCO_DEPSGRAPH_BATCH_SIZE': 1000,
+            # Job compilers insert tasks in batches of this many tasks.
+            'FLAMENCO_TASK_INSERT_BATCH_SIZE': 1000,
+            # Compile newly submitted jobs in a Celery task, so that submitting a job
+            # returns immediately. When False, jobs are compiled during the submission.
+            'FLAMENCO_COMPILE_IN_BACKGROUND': True,
+            # Jobs with many frame chunks are compiled lazily: only the tasks for this many
+            # chunks are created at once. The tasks of the next chunks are created when
+            # fewer than FLAMENCO_COMPILE_LOW_WATER tasks of the job are unfinished.
+            # Set to None to create all tasks when the job is submitted.
+            'FLAMENCO_COMPILE_WINDOW_SIZE': 5000,
+            'FLAMENCO_COMPILE_LOW_WATER': 1000,
+            # A window that is still being compiled after this long is assumed to be
+            # abandoned, for example by a crashed Celery worker, and is compiled again.
+            'FLAMENCO_COMPILE_WINDOW_CLAIM_TIMEOUT': datetime.timedelta(minutes=10),
+            # Dry runs of jobs that would have more tasks than this are refused, as they
+            # compile all tasks in memory at once.
+            'FLAMENCO_DRY_RUN_MAX_TASKS': 100000,
+            # The Manager fields needed by the Manager API are cached per web process, for
+            # at most this many Managers and this long. Changes made by other web processes,
+            # such as cancelled tasks, can take this long to be seen by the Manager API.
+            'FLAMENCO_MANAGER_API_CACHE_SIZE': 1000,
+            'FLAMENCO_MANAGER_API_CACHE_TTL': datetime.timedelta(seconds=5),
+            # The job status counts shown on the dashboard are cached this long.
+            'FLAMENCO_DASHBOARD_SUMMARY_TTL': datetime.timedelta(seconds=10),
+            # Managers can wait this long for depsgraph changes (long polling).
+            'FLAMENCO_DEPSGRAPH_MAX_WAIT': datetime.timedelta(seconds=30),
+            # How long-polling requests learn of changes; 'mongo' polls the Managers'
+            # depsgraph generations every FLAMENCO_CHANGE_NOTIFIER_POLL_INTERVAL to see
+            # changes made by other processes, 'local' only sees changes made in the same
+            # process, and should only be used with a single web process. Each web process
+            # polls with one query per interval, for all its waiting requests together.
+            'FLAMENCO_CHANGE_NOTIFIER': 'mongo',
+            'FLAMENCO_CHANGE_NOTIFIER_POLL_INTERVAL': datetime.timedelta(seconds=1),
+            # Admission control of the Manager API, see flamenco/managers/admission.py.
+            # The max nr of in-flight requests is per endpoint (the name of the view
+            # function), of which a fraction is reserved for priority requests.
+            'FLAMENCO_ADMISSION_CONTROL': True,
+            'FLAMENCO_ADMISSION_MAX_IN_FLIGHT': {
+                'default': 32,
+                'task_update_batch': 32,
+                'get_depsgraph': 16,
+            },
+            'FLAMENCO_ADMISSION_PRIORITY_RESERVE': 0.25,
+            # Non-priority requests are rejected when the recent latency of their endpoint
+            # exceeds this. Measurements older than the window are ignored.
+            'FLAMENCO_ADMISSION_MAX_LATENCY': datetime.timedelta(seconds=2),
+            'FLAMENCO_ADMISSION_LATENCY_WINDOW': datetime.timedelta(seconds=30),
+            # Task update IDs are remembered this long, so that replayed updates can be
+            # acknowledged without handling them again.
+            'FLAMENCO_TASK_UPDATE_ID_RETENTION': datetime.timedelta(hours=6),
+        }
 
     def eve_settings(self):
         """Returns extensions to the Eve settings.
@@ -122,6 +190,9 @@ class FlamencoExtension(PillarExtension):
             self._create_collections(app.db())
 
         from . import managers, jobs, tasks
+        from .managers import notifications
+
+        self.change_notifier = notifications.create_notifier(app.config)
 
         managers.setup_app(app)
         jobs.setup_app(app)
@@ -146,8 +217,11 @@ class FlamencoExtension(PillarExtension):
         # by anything due to its sensitive nature.
         ORPHAN_FINDER_SKIP_COLLECTIONS.add('flamenco_manager_linking_keys')
 
+        # Only contains IDs of task updates sent by Managers.
+        ORPHAN_FINDER_SKIP_COLLECTIONS.add('flamenco_task_update_ids')
+
     def _create_collections(self, db):
-        import pymongo
+        from . import indexes
 
         # flamenco_task_logs
         if 'flamenco_task_logs' not in db.list_collection_names():
@@ -159,15 +233,6 @@ class FlamencoExtension(PillarExtension):
         else:
             self._log.debug('Not creating flamenco_task_logs collection, already exists.')
 
-        self._log.info('Creating index on flamenco_task_logs collection')
-        db.flamenco_task_logs.create_index(
-            [('task_id', pymongo.ASCENDING),
-             ('received_on_manager', pymongo.ASCENDING)],
-            background=True,
-            unique=False,
-            sparse=False,
-        )
-
         # flamenco_tasks
         if 'flamenco_tasks' not in db.collection_names(include_system_collections=False):
             self._log.info('Creating flamenco_tasks collection.')
@@ -178,20 +243,6 @@ class FlamencoExtension(PillarExtension):
         else:
             self._log.debug('Not creating flamenco_tasks collection, already exists.')
 
-        self._log.info('Creating index on flamenco_tasks collection')
-        db.flamenco_tasks.create_index(
-            [('manager', pymongo.ASCENDING)],
-            background=False,
-            unique=False,
-            sparse=False,
-        )
-        db.flamenco_tasks.create_index(
-            [('_updated', pymongo.DESCENDING)],
-            background=False,
-            unique=False,
-            sparse=False,
-        )
-
         # Manager linking keys
         if 'flamenco_manager_linking_keys' not in db.list_collection_names():
             self._log.info('Creating flamenco_manager_linking_keys collection.')
@@ -200,8 +251,14 @@ class FlamencoExtension(PillarExtension):
             self._log.debug(
                 'Not creating flamenco_manager_linking_keys collection, already exists.')
 
-        self._log.info('Creating index on flamenco_manager_linking_keys')
-        db.flamenco_manager_linking_keys.create_index('remove_after', expireAfterSeconds=0)
+        # Indexes are declared in flamenco.indexes, and built in the background.
+        created = indexes.create_indexes(db)
+        if created:
+            self._log.info('Created %i missing indexes', len(created))
+        obsolete = indexes.obsolete_indexes(db)
+        if obsolete:
+            self._log.warning('Obsolete indexes found, run "manage.py flamenco setup_indexes '
+                              '--drop-obsolete" to remove them: %s', obsolete)
 
     def flamenco_projects(self, *, projection: dict = None):
         """Returns projects set up for Flamenco.
@@ -284,8 +341,9 @@ class FlamencoExtension(PillarExtension):
         return flask.current_app.db()['flamenco_%s' % collection_name]
 
     def update_status(self, collection_name, document_id, new_status,
-                      *, now: datetime.datetime = None):
-        """Updates a document's status, avoiding Eve.
+                      *, now: datetime.datetime = None,
+                      expected_status=None) -> typing.Optional[dict]:
+        """Updates a document's status with a single compare-and-set operation, avoiding Eve.
 
         Doesn't use Eve patch_internal to avoid Eve's authorisation. For
         example, Eve doesn't know certain PATCH operations are allowed by
@@ -293,20 +351,77 @@ class FlamencoExtension(PillarExtension):
 
         :param now: the _updated field is set to this timestamp; use this to set multiple
             objects to the same _updated field.
-        :rtype: pymongo.results.UpdateResult
+        :param expected_status: query on the current status, for example 'queued' or
+            {'$ne': 'active'}. The document is only updated when its status matches.
+            When None, the status is updated unconditionally.
+        :returns: the document as it was before the update, with only the fields in
+            STATUS_PRE_IMAGE_PROJECTION, or None if no document matched.
         """
+        from pymongo import ReturnDocument
+        from flamenco import current_flamenco
+
+        query = {'_id': document_id}
+        if expected_status is not None:
+            query['status'] = expected_status
 
-        return self.update_status_q(collection_name, {'_id': document_id}, new_status, now=now)
+        collection = current_flamenco.db(collection_name)
+        before = collection.find_one_and_update(
+            query,
+            self._status_update(collection_name, new_status, now),
+            projection=STATUS_PRE_IMAGE_PROJECTION,
+            return_document=ReturnDocument.BEFORE,
+        )
+        if before is None:
+            self._log.debug('Not updating status of %s to %s, it does not match %s',
+                            collection_name, new_status, query)
+            return None
+
+        # The pre-image tells us which transition was performed, so there is no
+        # need to query the tasks before updating them.
+        if collection_name == 'tasks' and before['status'] != new_status:
+            self.task_manager.apply_status_transitions([{
+                'job': before.get('job'),
+                'manager': before.get('manager'),
+                'status': before['status'],
+                'count': 1,
+                'task_ids': [document_id],
+            }], new_status)
+
+        self._log.debug('Updated status of %s %s from %s to %s',
+                        collection_name, document_id, before['status'], new_status)
+        return before
 
     def update_status_q(self, collection_name, query, new_status, *, now: datetime.datetime = None):
         """Updates the status for the queried objects.
 
         :param now: the _updated field is set to this timestamp; use this to set multiple
             objects to the same _updated field.
-        :returns: the result of the collection.update_many() call
-        :rtype: pymongo.results.UpdateResult
+        :returns: the nr of modified objects.
         """
-        from flamenco import eve_settings, current_flamenco
+        from flamenco import current_flamenco
+
+        singular_name = collection_name.rstrip('s')  # jobs -> job
+        update = self._status_update(collection_name, new_status, now)
+
+        if collection_name == 'tasks':
+            # Tasks are counted per status on their job, so the task manager has
+            # to know exactly which status transitions are performed.
+            modified_count = self.task_manager.api_update_status_q(query, new_status, update)
+        else:
+            collection = current_flamenco.db(collection_name)
+            modified_count = collection.update_many(query, update).modified_count
+
+        self._log.debug('Updated status of %i %s %s to %s',
+                        modified_count, singular_name, query, new_status)
+
+        return modified_count
+
+    def _status_update(self, collection_name, new_status, now: datetime.datetime = None) -> dict:
+        """Returns the MongoDB update that sets the status.
+
+        :raises ValueError: when the status is not valid for the collection.
+        """
+        from flamenco import eve_settings
         import uuid
 
         singular_name = collection_name.rstrip('s')  # jobs -> job
@@ -316,27 +431,16 @@ class FlamencoExtension(PillarExtension):
         if new_status not in valid_statuses:
             raise ValueError('Invalid %s status %s' % (singular_name, new_status))
 
-        # Generate random ETag since we can't compute it from the entire document.
-        # This means that a subsequent PUT will change the etag even when the document doesn't
-        # change; this is unavoidable without fetching the entire document.
-        etag = uuid.uuid4().hex
-
         if now is None:
             from bson import tz_util
             now = datetime.datetime.now(tz=tz_util.utc)
 
-        collection = current_flamenco.db(collection_name)
-        result = collection.update_many(
-            query,
-            {'$set': {'status': new_status,
-                      '_updated': now,
-                      '_etag': etag}}
-        )
-
-        self._log.debug('Updated status of %i %s %s to %s',
-                        result.modified_count, singular_name, query, new_status)
-
-        return result
+        # Generate random ETag since we can't compute it from the entire document.
+        # This means that a subsequent PUT will change the etag even when the document doesn't
+        # change; this is unavoidable without fetching the entire document.
+        return {'$set': {'status': new_status,
+                         '_updated': now,
+                         '_etag': uuid.uuid4().hex}}
 
     def api_recreate_job(self, job_id: bson.ObjectId):
         """Deletes all tasks of a job, then recompiles the job to construct new tasks.
@@ -363,7 +467,9 @@ class FlamencoExtension(PillarExtension):
         self._log.info('Recreating job %s', job_id)
         self.job_manager.api_set_job_status(job_id, 'under-construction')
         self.task_manager.api_delete_tasks_for_job(job_id)
-        job_compilers.compile_job(job_doc)
+        jobs_coll.update_one({'_id': job_id}, {'$unset': {'compilation': True,
+                                                          'command_templates': True}})
+        job_compilers.start_compile_job(job_doc)
         self._log.info('Recreated job %s', job_id)
 
 
@@ -54,9 +54,8 @@ def archive_job(job_id: str):
         outfile.write(dumps(job, indent=4, sort_keys=True))
 
     # Set job status to 'archiving'.
-    res = current_flamenco.job_manager.api_set_job_status(job_oid, 'archiving')
-    if res.matched_count != 1:
-        raise ArchivalError(f'Unable to update job {job_oid}, matched count={res.matched_count}')
+    if current_flamenco.job_manager.api_set_job_status(job_oid, 'archiving') is None:
+        raise ArchivalError(f'Unable to update job {job_oid}, it does not exist')
 
     # Run each task log compression in a separate Celery task.
     tasks_coll = current_flamenco.db('tasks')
@@ -193,8 +192,8 @@ def update_mongo(archive_blob_name: str, job_id: str):
         task['_id']
         for task in tasks_coll.find({'job': job_oid})
     ]
-    logs_coll.delete_many({'task_id': {'$in': task_ids}})
-    tasks_coll.delete_many({'job': job_oid})
+    logs_coll.delete_many({'task': {'$in': task_ids}})
+    current_flamenco.task_manager.api_delete_tasks_for_job(job_oid)
 
     # Update the job's archive blob name
     res = jobs_coll.update_one({'_id': job_oid},
@@ -205,11 +204,9 @@ def update_mongo(archive_blob_name: str, job_id: str):
             f"matched count={res.matched_count}")
 
     # Update the job status to 'archived'
-    res = current_flamenco.job_manager.api_set_job_status(job_oid, 'archived')
-    if res.matched_count != 1:
+    if current_flamenco.job_manager.api_set_job_status(job_oid, 'archived') is None:
         raise ArchivalError(
-            f"Unable to update job {job_oid} to status 'archived', "
-            f"matched count={res.matched_count}")
+            f"Unable to update job {job_oid} to status 'archived', it does not exist")
 
 
 @current_app.celery.task(ignore_result=True)
@@ -0,0 +1,64 @@
+import logging
+
+import bson
+
+from pillar import current_app
+
+from flamenco import current_flamenco
+
+log = logging.getLogger(__name__)
+
+
+@current_app.celery.task(ignore_result=True)
+def compile_job(job_id: str):
+    """Compiles a given job into tasks.
+
+    - Only compiles the job when it has status "under-construction".
+    - Deletes any tasks left behind by an earlier, interrupted compilation.
+    - Records the nr of tasks created so far in the job's "compilation" field.
+    - When compilation fails, deletes the created tasks, records the reason in
+      the job's "compilation" field, and sets the job status to "canceled".
+    - When compilation succeeds, the job becomes "queued" or "paused".
+    """
+
+    from flamenco import job_compilers
+
+    job_oid = bson.ObjectId(job_id)
+    jobs_coll = current_flamenco.db('jobs')
+    job = jobs_coll.find_one({'_id': job_oid})
+    if job is None:
+        log.warning('Job %s does not exist, not compiling it', job_oid)
+        return
+    if job['status'] != 'under-construction':
+        log.info('Job %s has status %r, not compiling it', job_oid, job['status'])
+        return
+
+    log.info('Compiling job %s', job_oid)
+    # Remove tasks left behind by an interrupted compilation of the same job.
+    current_flamenco.task_manager.api_delete_tasks_for_job(job_oid)
+    current_flamenco.job_manager.api_set_compile_progress(job_oid, 0)
+
+    # Validation of the tasks happens by Eve, which expects a request context.
+    with current_app.test_request_context():
+        try:
+            job_compilers.compile_job(job)
+        except Exception as ex:
+            log.exception('Error compiling job %s', job_oid)
+            reason = f'{type(ex).__name__}: {ex}'
+            current_flamenco.job_manager.api_fail_compilation(job_oid, reason)
+            return
+
+    log.info('Compiled job %s', job_oid)
+
+
+@current_app.celery.task(ignore_result=True)
+def compile_job_window(job_id: str, cursor: int):
+    """Creates the tasks of the next window of a lazily compiled job.
+
+    See flamenco.job_compilers.compile_window().
+    """
+
+    from flamenco import job_compilers
+
+    with current_app.test_request_context():
+        job_compilers.compile_window(bson.ObjectId(job_id), cursor)
@@ -122,6 +122,37 @@ def create_test_job(manager_id, user_email, project_url):
     log.info('Job created:\n%s', dumps(job, indent=4))
 
 
+@manager_flamenco.command
+def dry_run_job(job_type, settings):
+    """Compiles a job without creating it, and shows statistics of its tasks.
+
+    The settings are given as JSON, for example
+    '{"frames": "1-100000", "chunk_size": 10, "time_in_seconds": 3}'.
+    """
+
+    import json
+    import time
+    from flamenco import job_compilers, exceptions
+
+    start = time.monotonic()
+    try:
+        stats = job_compilers.dry_run_job({'job_type': job_type,
+                                           'settings': json.loads(settings)})
+    except exceptions.TooManyTasksError as ex:
+        log.error('Job is too large for a dry run: %s', ex)
+        return 1
+    duration = time.monotonic() - start
+
+    print(f'Tasks: {stats.task_count}')
+    for task_type, count in sorted(stats.task_types.items()):
+        print(f'    {task_type}: {count}')
+    print(f'Critical path length: {stats.critical_path_length} tasks')
+    print(f'Estimated size of task documents: {stats.document_size / 1024:.1f} kB')
+    print(f'Max fan-in: {stats.max_fan_in}')
+    print(f'Max fan-out: {stats.max_fan_out}')
+    print(f'Dry run took {duration * 1000:.0f} ms')
+
+
 @manager_flamenco.command
 def make_admin(user_email):
     """Grants the user flamenco-admin role."""
@@ -172,6 +203,40 @@ def archive_job(job_id):
     log.info('Created Celery task %s', celery_task)
 
 
+@manager_flamenco.command
+def compile_job(job_id):
+    """Compiles a single job that is stuck in the "under-construction" state.
+
+    Creates a Celery task that compiles the job. Use this when the Celery task
+    that should have compiled the job was lost.
+    """
+
+    from flamenco.celery import job_compilation
+
+    log.info('Creating Celery background task for compilation of job %s', job_id)
+    celery_task = job_compilation.compile_job.delay(job_id)
+    log.info('Created Celery task %s', celery_task)
+
+
+@manager_flamenco.command
+def compile_progress(job_id):
+    """Shows the compilation progress of a job."""
+
+    from flamenco import current_flamenco
+
+    job = current_flamenco.db('jobs').find_one({'_id': str2id(job_id)},
+                                               projection={'status': 1, 'compilation': 1})
+    if job is None:
+        log.error('Job %s does not exist', job_id)
+        return 1
+
+    compilation = job.get('compilation') or {}
+    print(f'Status: {job["status"]}')
+    print(f'Tasks created: {compilation.get("tasks_created", 0)}')
+    if compilation.get('failure_reason'):
+        print(f'Compilation failed: {compilation["failure_reason"]}')
+
+
 @manager_flamenco.command
 def resume_job_archiving():
     """Resumes archiving of jobs that are stuck in status "archiving".
@@ -210,4 +275,86 @@ def unused_manager_owners():
     print(emails)
 
 
+@manager_flamenco.command
+@manager_flamenco.option('-j', '--job', dest='job_id', default=None)
+def recount_task_statuses(job_id=None):
+    """Rebuilds the per-job task status counts.
+
+    Recounts all jobs, or only the given job. Run this after upgrading from a
+    version of Flamenco Server that did not keep track of task status counts.
+    """
+
+    from flamenco import current_flamenco
+
+    job_ids = None if job_id is None else [str2id(job_id)]
+    counts = current_flamenco.job_manager.api_recount_task_statuses(job_ids)
+    log.info('Recounted task statuses of %i jobs with tasks', len(counts))
+
+
+@manager_flamenco.command
+def rebuild_cancel_requested():
+    """Rebuilds the per-Manager sets of cancel-requested tasks.
+
+    Run this after upgrading from a version of Flamenco Server that did not keep
+    track of those sets.
+    """
+
+    from flamenco import current_flamenco
+
+    counts = current_flamenco.manager_manager.api_rebuild_cancel_requested()
+    for manager_id, count in counts.items():
+        log.info('Manager %s has %i cancel-requested tasks', manager_id, count)
+    log.info('Rebuilt cancel-requested tasks of all Managers')
+
+
+@manager_flamenco.command
+def backfill_job_runnable():
+    """Sets the 'job_runnable' field of all tasks, based on the status of their job.
+
+    Run this after upgrading from a version of Flamenco Server that did not
+    store this field on tasks.
+    """
+
+    from flamenco import current_flamenco
+
+    runnable, unrunnable = current_flamenco.job_manager.api_backfill_job_runnable()
+    log.info('Marked %i tasks as runnable and %i tasks as not runnable', runnable, unrunnable)
+
+
+@manager_flamenco.command
+@manager_flamenco.option('-d', '--drop-obsolete', dest='drop_obsolete', action='store_true',
+                         default=False)
+def setup_indexes(drop_obsolete=False):
+    """Creates missing MongoDB indexes and reports hot queries that scan entire collections.
+
+    Indexes are built in the background. Use --drop-obsolete to remove indexes
+    created by older versions of Flamenco Server.
+    """
+
+    from flamenco import indexes
+
+    db = current_app.db()
+
+    created = indexes.create_indexes(db)
+    for index in created:
+        log.info('Created index %s on flamenco_%s', index.name, index.collection)
+    if not created:
+        log.info('All indexes already exist')
+
+    if drop_obsolete:
+        indexes.drop_obsolete_indexes(db)
+    else:
+        for coll_name, index_name in indexes.obsolete_indexes(db):
+            log.warning('Obsolete index %s on flamenco_%s; use --drop-obsolete to remove it',
+                        index_name, coll_name)
+
+    collscans = indexes.collection_scans(db)
+    for query in collscans:
+        log.error('Hot query %r on flamenco_%s performs a COLLSCAN: %s',
+                  query.name, query.collection, query.filter)
+    if collscans:
+        raise SystemExit(1)
+    log.info('All hot queries use an index')
+
+
 manager.add_command("flamenco", manager_flamenco)
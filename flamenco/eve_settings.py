@@ -119,8 +119,22 @@ managers_schema = {
                 'type': 'integer',
             }
         }
-    }
-
+    },
+    # IDs of this Manager's tasks in status 'cancel-requested', kept in sync by Flamenco
+    # whenever tasks enter or leave that status. The version is incremented on every change.
+    # Use 'manage.py flamenco rebuild_cancel_requested' to rebuild it from the tasks collection.
+    'cancel_requested_tasks': {
+        'type': 'list',
+        'schema': {'type': 'objectid'},
+    },
+    'cancel_requested_version': {
+        'type': 'integer',
+    },
+    # Incremented whenever something changes that may affect this Manager's depsgraph,
+    # so that unchanged depsgraph polls can be answered without querying the tasks.
+    'depsgraph_generation': {
+        'type': 'integer',
+    },
 }
 
 jobs_schema = {
@@ -204,6 +218,20 @@ jobs_schema = {
             'canceled': {'type': 'integer'}
         }
     },
+    # Number of tasks per task status, kept in sync by Flamenco whenever tasks are
+    # created, deleted, or change status. Use 'manage.py flamenco recount_task_statuses'
+    # to rebuild it from the tasks collection.
+    'task_status_counts': {
+        'type': 'dict',
+        'allow_unknown': True,
+    },
+    # Command settings that are shared by many tasks, as {template key: template}.
+    # Tasks store only their per-task settings and refer to the template by key; see
+    # flamenco.job_compilers.commands.expand_command().
+    'command_templates': {
+        'type': 'dict',
+        'allow_unknown': True,
+    },
     # The most important part of a job. These custom values are parsed by the
     # job compiler in order to generate the tasks.
     'settings': {
@@ -212,6 +240,21 @@ jobs_schema = {
         'allow_unknown': True,
     },
 
+    # Progress of the job compiler, set while the job is 'under-construction'. When
+    # compilation fails, the job is canceled and the reason is stored here.
+    'compilation': {
+        'type': 'dict',
+        'schema': {
+            'tasks_created': {'type': 'integer'},
+            'failure_reason': {'type': 'string'},
+            # Only for jobs compiled in windows: index of the first frame chunk of the
+            # next window, absent once all tasks have been created.
+            'cursor': {'type': 'integer'},
+            # When compilation of the window at the cursor was claimed by a process.
+            'window_claimed': {'type': 'datetime'},
+        },
+    },
+
     # Blob in the project's storage, containing the archived job.
     'archive_blob_name': {'type': 'string'},
     # Status the job had before it became 'archiving'.
@@ -277,6 +320,13 @@ tasks_schema = {
         'max': 100,
         'default': 50
     },
+    # Whether the job's status allows its tasks to be run, i.e. whether the job status
+    # is in flamenco.managers.api.DEPSGRAPH_RUNNABLE_JOB_STATUSES. Kept in sync by the
+    # JobManager, so that the depsgraph can be obtained with a single query.
+    'job_runnable': {
+        'type': 'boolean',
+        'default': False,
+    },
     'job_type': {
         'type': 'string',
         'required': True,
@@ -296,10 +346,18 @@ tasks_schema = {
         'schema': {
             'type': 'dict',
             'schema': {
-                # The parser is inferred form the command name
+                # The parser is inferred form the command name. Commands that refer to
+                # a command template of the job get their name from the template.
                 'name': {
                     'type': 'string',
-                    'required': True,
+                },
+                # Key of the command template in the job's 'command_templates'.
+                'template': {
+                    'type': 'string',
+                },
+                # Frame number to fill in the 'frame_patterns' of the command template.
+                'frame': {
+                    'type': 'integer',
                 },
                 # In the list of built arguments for the command, we will
                 # replace the executable, which will be defined on the fly by
@@ -7,3 +7,7 @@ class FlamencoException(Exception):
 
 class JobSettingError(FlamencoException):
     """Raised when a job's settings contains errors."""
+
+
+class TooManyTasksError(FlamencoException):
+    """Raised when a dry run of a job would create too many tasks."""
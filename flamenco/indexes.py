@@ -0,0 +1,234 @@
+"""MongoDB indexes used by Flamenco, and verification of the query plans of hot queries.
+
+All indexes are declared here, rather than created ad-hoc, so that they can be
+created at startup, by the 'manage.py flamenco setup_indexes' command, and be
+verified against the queries that depend on them.
+"""
+
+import datetime
+import logging
+import typing
+
+import attr
+import bson
+from bson import tz_util
+import pymongo
+import pymongo.database
+
+log = logging.getLogger(__name__)
+
+
+@attr.s(frozen=True)
+class Index:
+    """Declaration of a MongoDB index.
+
+    The collection name is without the 'flamenco_' prefix.
+    """
+    collection = attr.ib(validator=attr.validators.instance_of(str))
+    name = attr.ib(validator=attr.validators.instance_of(str))
+    keys = attr.ib(validator=attr.validators.instance_of(list))
+    options = attr.ib(default=attr.Factory(dict))
+
+
+@attr.s(frozen=True)
+class HotQuery:
+    """A query on a hot path, which should never need a collection scan."""
+    name = attr.ib(validator=attr.validators.instance_of(str))
+    collection = attr.ib(validator=attr.validators.instance_of(str))
+    filter = attr.ib(validator=attr.validators.instance_of(dict))
+    sort = attr.ib(default=None)
+
+
+# Partial indexes can only be limited to non-final statuses where a single value or
+# field expresses that. Before MongoDB 6.0, partialFilterExpression rejects $in and $or,
+# so {'status': {'$in': [non-final statuses]}} cannot be used. Instead, the depsgraph
+# indexes are limited to tasks of non-final jobs through the denormalised 'job_runnable'
+# field, and the cancel-requested index to that single status. The 'job_status' index
+# cannot be partial, as the job cascade also queries completed and failed tasks. Jobs
+# are only queried by _id on hot paths, so they have no indexes of their own.
+INDEXES = [
+    # Depsgraph queries, and claiming tasks for a Manager.
+    Index('tasks', 'depsgraph_runnable',
+          [('manager', pymongo.ASCENDING),
+           ('job_runnable', pymongo.ASCENDING),
+           ('status', pymongo.ASCENDING),
+           ('_updated', pymongo.ASCENDING)],
+          {'partialFilterExpression': {'job_runnable': True}}),
+    # Depsgraph queries that limit the number of tasks, which are handed out by priority.
+    Index('tasks', 'depsgraph_priority',
+          [('manager', pymongo.ASCENDING),
+           ('job_runnable', pymongo.ASCENDING),
+           ('status', pymongo.ASCENDING),
+           ('job_priority', pymongo.DESCENDING),
+           ('priority', pymongo.DESCENDING),
+           ('_id', pymongo.ASCENDING)],
+          {'partialFilterExpression': {'job_runnable': True}}),
+    # Job status cascade, requeueing, cancelling, and task status counting.
+    Index('tasks', 'job_status',
+          [('job', pymongo.ASCENDING),
+           ('status', pymongo.ASCENDING)]),
+    # Rebuilding the Managers' sets of cancel-requested tasks.
+    Index('tasks', 'cancel_requested',
+          [('status', pymongo.ASCENDING),
+           ('manager', pymongo.ASCENDING)],
+          {'partialFilterExpression': {'status': 'cancel-requested'}}),
+    Index('tasks', '_updated_-1',
+          [('_updated', pymongo.DESCENDING)]),
+
+    # Paging through the log of a task.
+    Index('task_logs', 'task_log_paging',
+          [('task', pymongo.ASCENDING),
+           ('received_on_manager', pymongo.ASCENDING),
+           ('_id', pymongo.ASCENDING)]),
+
+    Index('task_update_ids', 'manager_1__id_1',
+          [('manager', pymongo.ASCENDING),
+           ('_id', pymongo.ASCENDING)]),
+    Index('task_update_ids', 'remove_after_1',
+          [('remove_after', pymongo.ASCENDING)],
+          {'expireAfterSeconds': 0}),
+
+    Index('manager_linking_keys', 'remove_after_1',
+          [('remove_after', pymongo.ASCENDING)],
+          {'expireAfterSeconds': 0}),
+]
+
+# Indexes created by earlier versions of Flamenco, which are no longer used.
+OBSOLETE_INDEXES = [
+    # This was on the wrong field; task logs refer to their task with 'task'.
+    ('task_logs', 'task_id_1_received_on_manager_1'),
+    # Covered by the 'depsgraph_runnable' index.
+    ('tasks', 'manager_1'),
+    # The depsgraph no longer queries jobs, as tasks know whether their job is runnable.
+    ('tasks', 'depsgraph'),
+    ('jobs', 'manager_status'),
+]
+
+
+def hot_queries() -> typing.List[HotQuery]:
+    """Returns the query shapes of the hot paths, filled with placeholder values."""
+
+    from flamenco.managers import api, depsgraph
+
+    some_id = bson.ObjectId()
+    some_time = datetime.datetime.now(tz=tz_util.utc)
+
+    return [
+        HotQuery('depsgraph clean slate', 'tasks',
+                 {'manager': some_id,
+                  'job_runnable': True,
+                  'status': {'$in': api.DEPSGRAPH_CLEAN_SLATE_TASK_STATUSES}},
+                 [('_updated', pymongo.DESCENDING)]),
+        HotQuery('depsgraph modified since', 'tasks',
+                 {'manager': some_id,
+                  'job_runnable': True,
+                  'status': {'$in': api.DEPSGRAPH_MODIFIED_SINCE_TASK_STATUSES},
+                  '_updated': {'$gt': some_time}},
+                 [('_updated', pymongo.DESCENDING)]),
+        HotQuery('depsgraph by priority', 'tasks',
+                 {'manager': some_id,
+                  'job_runnable': True,
+                  'status': {'$in': api.DEPSGRAPH_CLEAN_SLATE_TASK_STATUSES}},
+                 depsgraph.PRIORITY_SORT),
+        HotQuery('job cascade', 'tasks',
+                 {'job': some_id, 'status': {'$in': ['active', 'claimed-by-manager']}}),
+        HotQuery('tasks of job', 'tasks',
+                 {'job': some_id}),
+        HotQuery('cancel-requested tasks', 'tasks',
+                 {'status': 'cancel-requested'}),
+        HotQuery('task log paging', 'task_logs',
+                 {'task': some_id},
+                 [('received_on_manager', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)]),
+        HotQuery('replayed task updates', 'task_update_ids',
+                 {'manager': some_id, '_id': {'$in': [some_id]}}),
+    ]
+
+
+def _collection(db: pymongo.database.Database, name: str) -> pymongo.collection.Collection:
+    return db['flamenco_%s' % name]
+
+
+def missing_indexes(db: pymongo.database.Database) -> typing.List[Index]:
+    """Returns the declared indexes that do not exist in the database."""
+
+    existing = {}
+    missing = []
+    for index in INDEXES:
+        if index.collection not in existing:
+            coll = _collection(db, index.collection)
+            existing[index.collection] = set(coll.index_information().keys())
+        if index.name not in existing[index.collection]:
+            missing.append(index)
+    return missing
+
+
+def create_indexes(db: pymongo.database.Database) -> typing.List[Index]:
+    """Creates the declared indexes that do not exist yet.
+
+    Indexes are built in the background, so that this does not block other
+    operations on the collections.
+
+    :returns: the indexes that were created.
+    """
+
+    to_create = missing_indexes(db)
+    for index in to_create:
+        log.info('Creating index %s on flamenco_%s', index.name, index.collection)
+        _collection(db, index.collection).create_index(
+            index.keys, name=index.name, background=True, **index.options)
+    return to_create
+
+
+def obsolete_indexes(db: pymongo.database.Database) -> typing.List[typing.Tuple[str, str]]:
+    """Returns (collection, index name) tuples of existing, obsolete indexes."""
+
+    found = []
+    for coll_name, index_name in OBSOLETE_INDEXES:
+        if index_name in _collection(db, coll_name).index_information():
+            found.append((coll_name, index_name))
+    return found
+
+
+def drop_obsolete_indexes(db: pymongo.database.Database) -> typing.List[typing.Tuple[str, str]]:
+    """Drops obsolete indexes.
+
+    :returns: (collection, index name) tuples of the dropped indexes.
+    """
+
+    to_drop = obsolete_indexes(db)
+    for coll_name, index_name in to_drop:
+        log.info('Dropping obsolete index %s on flamenco_%s', index_name, coll_name)
+        _collection(db, coll_name).drop_index(index_name)
+    return to_drop
+
+
+def plan_stages(plan: dict) -> typing.Set[str]:
+    """Returns the names of all stages in an explained query plan."""
+
+    stages = set()
+    todo = [plan]
+    while todo:
+        stage = todo.pop()
+        stages.add(stage.get('stage'))
+        if 'inputStage' in stage:
+            todo.append(stage['inputStage'])
+        todo.extend(stage.get('inputStages', []))
+    stages.discard(None)
+    return stages
+
+
+def explain(db: pymongo.database.Database, query: HotQuery) -> typing.Set[str]:
+    """Returns the stages of the winning query plan of the hot query."""
+
+    cursor = _collection(db, query.collection).find(query.filter)
+    if query.sort:
+        cursor = cursor.sort(query.sort)
+    explanation = cursor.explain()
+    return plan_stages(explanation['queryPlanner']['winningPlan'])
+
+
+def collection_scans(db: pymongo.database.Database) -> typing.List[HotQuery]:
+    """Returns the hot queries that would perform a collection scan."""
+
+    return [query for query in hot_queries()
+            if 'COLLSCAN' in explain(db, query)]
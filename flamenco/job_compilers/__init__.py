@@ -31,6 +31,103 @@ def compile_job(job):
     compiler.compile(job)
 
 
+def start_compile_job(job):
+    """Starts compilation of the given job.
+
+    When FLAMENCO_COMPILE_IN_BACKGROUND is set, the job is compiled by a Celery
+    task and this function returns immediately; the job stays 'under-construction'
+    until its tasks have been created. Otherwise the job is compiled immediately.
+    """
+
+    from flask import current_app
+
+    if not current_app.config['FLAMENCO_COMPILE_IN_BACKGROUND']:
+        compile_job(job)
+        return
+
+    from flamenco.celery import job_compilation
+
+    log.info('Creating Celery background task for compilation of job %s', job['_id'])
+    job_compilation.compile_job.delay(str(job['_id']))
+
+
+def compile_window(job_id, cursor: int):
+    """Creates the tasks of the next window of a lazily compiled job.
+
+    Does nothing when the window is already being compiled by another process,
+    or when the job is no longer queued or active.
+    """
+
+    from flamenco import current_flamenco
+
+    job_manager = current_flamenco.job_manager
+    job = job_manager.api_claim_compile_window(job_id, cursor)
+    if job is None:
+        log.debug('Not compiling window %i of job %s', cursor, job_id)
+        return
+
+    log.info('Compiling window %i of job %s', cursor, job_id)
+    compiler = construct_job_compiler(job)
+    try:
+        next_cursor = compiler.compile_window(job, cursor)
+    except Exception as ex:
+        log.exception('Error compiling window %i of job %s', cursor, job_id)
+        job_manager.api_fail_compile_window(job_id, f'{type(ex).__name__}: {ex}')
+        return
+    job_manager.api_set_compile_cursor(job_id, next_cursor)
+
+
+def start_compile_window(job_id, cursor: int):
+    """Starts compilation of the next window of a lazily compiled job.
+
+    Like start_compile_job(), this uses a Celery task when
+    FLAMENCO_COMPILE_IN_BACKGROUND is set.
+    """
+
+    from flask import current_app
+
+    if not current_app.config['FLAMENCO_COMPILE_IN_BACKGROUND']:
+        compile_window(job_id, cursor)
+        return
+
+    from flamenco.celery import job_compilation
+
+    log.info('Creating Celery background task for compilation of window %i of job %s',
+             cursor, job_id)
+    job_compilation.compile_job_window.delay(str(job_id), cursor)
+
+
+def dry_run_job(job: dict) -> 'dry_run.TaskGraphStatistics':
+    """Compiles the job in memory, returning statistics of the resulting task graph.
+
+    The job does not have to exist in the database; only its job type and
+    settings are required. Jobs with more than FLAMENCO_DRY_RUN_MAX_TASKS tasks
+    are refused.
+
+    :raises flamenco.exceptions.JobSettingError if the settings are bad.
+    :raises flamenco.exceptions.TooManyTasksError if the job has too many tasks.
+    :raises KeyError if there is no compiler for the job type.
+    """
+
+    from flask import current_app
+    from flamenco import exceptions, utils
+    from . import dry_run
+
+    compiler = construct_job_compiler(job)
+    compiler.validate_job_settings(job)
+
+    # Every task renders at most 'chunk_size' frames, so refuse too many frames before
+    # the compiler lists them all in memory.
+    max_tasks = current_app.config['FLAMENCO_DRY_RUN_MAX_TASKS']
+    settings = job['settings']
+    chunk_size = settings.get('chunk_size')
+    if isinstance(chunk_size, int) and chunk_size > 0 and isinstance(settings.get('frames'), str):
+        if utils.frame_range_count(settings['frames']) > max_tasks * chunk_size:
+            raise exceptions.TooManyTasksError(f'Job has more than {max_tasks} tasks')
+
+    return compiler.dry_run(dry_run.placeholder_job(job), max_tasks=max_tasks)
+
+
 def validate_job(job):
     """Validates job settings.
 
@@ -42,11 +139,13 @@ def validate_job(job):
 
 
 def construct_job_compiler(job) -> abstract_compiler.AbstractJobCompiler:
+    from flask import current_app
     from flamenco import current_flamenco
 
     compiler_class = find_job_compiler(job)
     compiler = compiler_class(task_manager=current_flamenco.task_manager,
-                              job_manager=current_flamenco.job_manager)
+                              job_manager=current_flamenco.job_manager,
+                              window_size=current_app.config['FLAMENCO_COMPILE_WINDOW_SIZE'])
 
     return compiler
 
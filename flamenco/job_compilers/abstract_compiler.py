@@ -1,4 +1,6 @@
 import abc
+import itertools
+import typing
 
 import attr
 import bson
@@ -9,22 +11,92 @@ from pillar import attrs_extra
 class AbstractJobCompiler(object, metaclass=abc.ABCMeta):
     task_manager = attr.ib(cmp=False, hash=False)
     job_manager = attr.ib(cmp=False, hash=False)
+    # Max nr of chunks to create tasks for at once, see _iter_window().
+    # None means that all tasks are created when the job is compiled.
+    window_size = attr.ib(default=None)
     _log = attrs_extra.log('%s.AbstractJobType' % __name__)
+    # Buffer of the tasks created by _create_task(), only set while compiling.
+    _task_buffer = attr.ib(default=None, init=False, cmp=False, hash=False, repr=False)
+    # Status of the tasks created by _create_task().
+    _task_status = attr.ib(default='under-construction', init=False, repr=False)
+    # Index of the first chunk of the window that is being compiled.
+    _window_start = attr.ib(default=0, init=False, repr=False)
+    # Index of the first chunk of the next window, or None if there are no more chunks.
+    _next_cursor = attr.ib(default=None, init=False, repr=False)
 
     REQUIRED_SETTINGS = []
 
     def compile(self, job: dict):
         """Compiles the job into a list of tasks.
 
-        Calls self.task_manager.create_task(...) to create the task in the database.
+        The tasks are created in the database in bulk, using a task buffer from
+        self.task_manager.task_buffer(job).
+
+        When the compiler uses _iter_window() and the job has more than
+        self.window_size chunks, only the tasks of the first window are created.
+        The job then remembers where the next window starts, and compile_window()
+        is used to create the other tasks once the job is running.
         """
 
         if not isinstance(job.get('_id'), bson.ObjectId):
             raise TypeError("job['_id'] should be an ObjectId, not %s" % job.get('_id'))
 
-        self._compile(job)
+        self._compile_window(job, 0, 'under-construction')
+        if self._next_cursor is not None:
+            self.job_manager.api_set_compile_cursor(job['_id'], self._next_cursor)
         self._flip_status(job)
 
+    def compile_window(self, job: dict, cursor: int) -> typing.Optional[int]:
+        """Creates the tasks of the window starting at the given chunk.
+
+        The tasks are queued immediately, so the job should be queued or active.
+        When compilation fails, the tasks of this window that were already inserted
+        are deleted, so that the window can be compiled again.
+
+        :returns: the cursor of the next window, or None if this was the last window.
+        """
+
+        task_buffer = self.task_manager.task_buffer(job)
+        try:
+            self._compile_window(job, cursor, 'queued', task_buffer=task_buffer)
+        except Exception:
+            task_buffer.discard()
+            raise
+        return self._next_cursor
+
+    def dry_run(self, job: dict, *, max_tasks: int = None) -> 'dry_run.TaskGraphStatistics':
+        """Compiles the job into an in-memory task sink, without using the database.
+
+        All tasks are compiled, regardless of self.window_size.
+
+        :param max_tasks: when given, compilation stops with a TooManyTasksError
+            when the job has more tasks than this.
+        :returns: statistics of the task graph the job would have.
+        """
+
+        from . import dry_run
+
+        sink = dry_run.TaskSink(self.task_manager, job, max_tasks=max_tasks)
+        window_size, self.window_size = self.window_size, None
+        try:
+            self._compile_window(job, 0, 'queued', task_buffer=sink)
+        finally:
+            self.window_size = window_size
+        return sink.statistics()
+
+    def _compile_window(self, job: dict, cursor: int, task_status: str, *, task_buffer=None):
+        self._window_start = cursor
+        self._next_cursor = None
+        self._task_status = task_status
+        if task_buffer is None:
+            task_buffer = self.task_manager.task_buffer(job)
+        self._task_buffer = task_buffer
+        try:
+            self._compile(job)
+            self._task_buffer.flush()
+        finally:
+            self._task_buffer = None
+
     @abc.abstractmethod
     def _compile(self, job: dict):
         """Compiles the job into a list of tasks.
@@ -61,12 +133,54 @@ class AbstractJobCompiler(object, metaclass=abc.ABCMeta):
         Use this to construct tasks, rather than calling self.task_manager.api_create_task directly.
         This is important to prevent race conditions between job compilation and the Manager
         fetching tasks.
+
+        The task is buffered, and inserted into the database in bulk with other
+        tasks. The returned ObjectId can be used immediately, for example to refer
+        to the task as parent of other tasks.
         """
 
-        return self.task_manager.api_create_task(job, commands, name,
-                                                 status='under-construction',
-                                                 task_type=task_type,
-                                                 **kwargs)
+        assert self._task_buffer is not None, '_create_task() should only be called by _compile()'
+        return self._task_buffer.create_task(commands, name,
+                                             status=self._task_status,
+                                             task_type=task_type,
+                                             **kwargs)
+
+    def _iter_window(self, chunks: typing.Iterable) -> typing.Iterator:
+        """Yields the chunks of the window that is being compiled.
+
+        Use this in _compile() to iterate over the chunks that each become a task.
+        Tasks that depend on all chunks, such as the job-ender tasks, should only
+        be created when self._is_last_window() returns True, and should use
+        self._with_earlier_windows() to obtain their parent tasks.
+        """
+
+        if self.window_size is None:
+            yield from chunks
+            return
+
+        chunks = iter(chunks)
+        window_end = self._window_start + self.window_size
+        yield from itertools.islice(chunks, self._window_start, window_end)
+
+        more_chunks = next(chunks, None) is not None
+        self._next_cursor = window_end if more_chunks else None
+
+    def _is_last_window(self) -> bool:
+        """Returns True when all chunks have been compiled; call after _iter_window()."""
+        return self._next_cursor is None
+
+    def _with_earlier_windows(self, job: dict, task_ids: typing.List[bson.ObjectId],
+                              task_type: str) -> typing.List[bson.ObjectId]:
+        """Returns the given task IDs, preceded by those of earlier windows of this type."""
+
+        if not self._window_start:
+            return task_ids
+
+        in_window = set(task_ids)
+        earlier = [task_id for task_id
+                   in self.task_manager.api_task_ids_for_job(job['_id'], task_type=task_type)
+                   if task_id not in in_window]
+        return earlier + task_ids
 
     def validate_job_settings(self, job):
         """Raises an exception if required settings are missing.
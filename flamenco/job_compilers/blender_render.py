@@ -34,7 +34,13 @@ class BlenderRender(AbstractJobCompiler):
         self.render_dir = intermediate_path(job, self.final_dir)
 
         render_tasks = self._make_render_tasks(job)
-        self._make_move_to_final_task(job, render_tasks)
+        if not self._is_last_window():
+            self._log.info('Created %i tasks for job %s, more will follow',
+                           len(render_tasks), job['_id'])
+            return
+
+        all_render_tasks = self._with_earlier_windows(job, render_tasks, 'blender-render')
+        self._make_move_to_final_task(job, all_render_tasks)
 
         task_count = len(render_tasks) + 1
         self._log.info('Created %i tasks for job %s', task_count, job['_id'])
@@ -64,7 +70,8 @@ class BlenderRender(AbstractJobCompiler):
         job_settings = job['settings']
 
         task_ids = []
-        for chunk_frames in iter_frame_range(job_settings['frames'], job_settings['chunk_size']):
+        chunks = iter_frame_range(job_settings['frames'], job_settings['chunk_size'])
+        for chunk_frames in self._iter_window(chunks):
             frame_range = frame_range_merge(chunk_frames)
             frame_range_bstyle = frame_range_merge(chunk_frames, blender_style=True)
 
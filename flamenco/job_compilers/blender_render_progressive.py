@@ -131,19 +131,18 @@ class BlenderRenderProgressive(AbstractJobCompiler):
                                        cycles_samples_to: int) -> ObjectId:
         """Publishes the first cycles-chunk of renders."""
 
-        cmds: typing.List[commands.AbstractCommand] = [commands.MoveOutOfWay(
-            src=str(self.render_path))]
+        cmds: typing.List[typing.Union[commands.AbstractCommand, commands.ForFrame]] = [
+            commands.MoveOutOfWay(src=str(self.render_path))]
 
         src_path = self._render_output(cycles_samples_from, cycles_samples_to)
         src_fmt = str(src_path).replace('######', '%06i.exr')
         dest_fmt = str(self.render_output).replace('######', '%06i.exr')
 
+        # The paths only differ in frame number, so all copy commands share a template.
+        copy_file = commands.CopyFile(src=src_fmt, dest=dest_fmt)
         for chunk_frames in self._iter_frame_chunks():
             for frame in chunk_frames:
-                cmds.append(commands.CopyFile(
-                    src=src_fmt % frame,
-                    dest=dest_fmt % frame,
-                ))
+                cmds.append(commands.ForFrame(copy_file, frozenset({'src', 'dest'}), frame))
 
         task_id = self._create_task(job, cmds, 'publish-first-chunk', 'file-management',
                                     parents=parents)
@@ -267,24 +266,25 @@ class BlenderRenderProgressive(AbstractJobCompiler):
         output_fmt = str(output).replace('######', '%06i.exr')
         final_dest_fmt = str(self.render_output).replace('######', '%06i.exr')
 
+        # The paths only differ in frame number, so all merge and copy commands of
+        # this Cycles chunk share a template.
+        merge = commands.MergeProgressiveRenders(
+            input1=input1_fmt,
+            input2=input2_fmt,
+            output=output_fmt,
+            weight1=weight1,
+            weight2=weight2,
+        )
+        copy_file = commands.CopyFile(src=output_fmt, dest=final_dest_fmt)
+
         for chunk_idx, chunk_frames in enumerate(self._iter_frame_chunks()):
             # Create a merge command for every frame in the chunk.
             task_cmds = []
             for framenr in chunk_frames:
-                intermediate = output_fmt % framenr
-                task_cmds.append(
-                    commands.MergeProgressiveRenders(
-                        input1=input1_fmt % framenr,
-                        input2=input2_fmt % framenr,
-                        output=intermediate,
-                        weight1=weight1,
-                        weight2=weight2,
-                    ))
-                task_cmds.append(
-                    commands.CopyFile(
-                        src=intermediate,
-                        dest=final_dest_fmt % framenr,
-                    ))
+                task_cmds.append(commands.ForFrame(
+                    merge, frozenset({'input1', 'input2', 'output'}), framenr))
+                task_cmds.append(commands.ForFrame(
+                    copy_file, frozenset({'src', 'dest'}), framenr))
 
             name = name_fmt % frame_range_merge(chunk_frames)
 
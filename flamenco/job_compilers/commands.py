@@ -1,3 +1,8 @@
+import functools
+import hashlib
+import json
+import typing
+
 import attr
 
 
@@ -8,6 +13,10 @@ class AbstractCommand(object):
     Command settings are defined in subclasses using attr.ib().
     """
 
+    # Names of the settings that typically differ between tasks, such as the frames
+    # to render. The other settings are sent to Managers as shared command blocks.
+    per_task_settings = frozenset()
+
     @classmethod
     def cmdname(cls):
         """Returns the command name."""
@@ -23,6 +32,29 @@ class AbstractCommand(object):
             'settings': attr.asdict(self),
         }
 
+    def to_template(self) -> typing.Optional[typing.Tuple[dict, dict]]:
+        """Splits the command into a template shared by tasks, and the per-task part.
+
+        :returns: tuple (template, per-task command without template key), or None
+            when the command has no per-task settings, and thus should not be
+            stored as template.
+        """
+
+        if not self.per_task_settings:
+            return None
+
+        settings = attr.asdict(self)
+        template = {
+            'name': self.cmdname(),
+            'settings': {key: value for key, value in settings.items()
+                         if key not in self.per_task_settings},
+        }
+        command = {
+            'settings': {key: value for key, value in settings.items()
+                         if key in self.per_task_settings},
+        }
+        return template, command
+
 
 @attr.s
 class Sleep(AbstractCommand):
@@ -36,6 +68,8 @@ class Echo(AbstractCommand):
 
 @attr.s
 class BlenderRender(AbstractCommand):
+    per_task_settings = frozenset({'frames'})
+
     # Blender executable to run.
     blender_cmd = attr.ib(validator=attr.validators.instance_of(str))
     # blend file path.
@@ -52,6 +86,9 @@ class BlenderRender(AbstractCommand):
 
 @attr.s
 class BlenderRenderProgressive(BlenderRender):
+    per_task_settings = frozenset({'frames', 'cycles_chunk',
+                                   'cycles_samples_from', 'cycles_samples_to'})
+
     # Total number of Cycles sample chunks.
     cycles_num_chunks = attr.ib(validator=attr.validators.instance_of(int))
     # Cycle sample chunk to render in this command.
@@ -118,6 +155,8 @@ class MergeProgressiveRenders(AbstractCommand):
     """Merges two Cycles outputs into one by taking the weighted average.
     """
 
+    per_task_settings = frozenset({'input1', 'input2', 'output', 'weight1', 'weight2'})
+
     input1 = attr.ib(validator=attr.validators.instance_of(str))
     input2 = attr.ib(validator=attr.validators.instance_of(str))
     output = attr.ib(validator=attr.validators.instance_of(str))
@@ -129,3 +168,126 @@ class MergeProgressiveRenders(AbstractCommand):
     # This is usually determined by the Flamenco Manager configuration.
     blender_cmd = attr.ib(validator=attr.validators.instance_of(str),
                           default='{blender}')
+
+
+@attr.s
+class ForFrame(object):
+    """A command for a single frame, of which some settings are frame number patterns.
+
+    The settings named in 'patterns' are %-format patterns, such as
+    '/render/frame-%06i.exr', into which the frame number is filled in. As
+    template, the patterns are shared by all frames, and commands only store
+    their frame number.
+    """
+
+    command = attr.ib(validator=attr.validators.instance_of(AbstractCommand))
+    patterns = attr.ib(validator=attr.validators.instance_of(frozenset))
+    frame = attr.ib(validator=attr.validators.instance_of(int))
+
+    def to_dict(self):
+        as_dict = self.command.to_dict()
+        for key in self.patterns:
+            as_dict['settings'][key] = as_dict['settings'][key] % self.frame
+        return as_dict
+
+    def to_template(self) -> typing.Tuple[dict, dict]:
+        as_dict = self.command.to_dict()
+        settings = as_dict['settings']
+        template = {
+            'name': as_dict['name'],
+            'settings': {key: value for key, value in settings.items()
+                         if key not in self.patterns},
+            'frame_patterns': {key: settings[key] for key in self.patterns},
+        }
+        return template, {'frame': self.frame, 'settings': {}}
+
+
+def template_key(template: dict) -> str:
+    """Returns the key of a command template, which is a hash of its contents."""
+
+    canonical = json.dumps(template, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf8')).hexdigest()[:32]
+
+
+def to_templated_dict(command, templates: typing.MutableMapping[str, dict]) -> dict:
+    """Returns a dictionary representation of the command that refers to a template.
+
+    The template is added to 'templates', as {template key: template}. Commands
+    that should not be stored as template are returned as to_dict() does.
+    """
+
+    parts = command.to_template()
+    if parts is None:
+        return command.to_dict()
+
+    template, templated = parts
+    key = template_key(template)
+    templates.setdefault(key, template)
+    templated['template'] = key
+    return templated
+
+
+def expand_command(command: dict, templates: typing.Mapping[str, dict]) -> dict:
+    """Returns the command as understood by Managers, by expanding its template.
+
+    Commands that do not refer to a template are returned as-is.
+
+    :raises KeyError: when the template does not exist.
+    """
+
+    key = command.get('template')
+    if key is None:
+        return command
+
+    template = templates[key]
+    settings = dict(template['settings'])
+    for setting, pattern in template.get('frame_patterns', {}).items():
+        settings[setting] = pattern % command['frame']
+    settings.update(command.get('settings') or {})
+    return {'name': template['name'], 'settings': settings}
+
+
+def uses_templates(task: dict) -> bool:
+    """Returns True iff any of the task's commands refers to a template."""
+    return any('template' in command for command in task.get('commands') or ())
+
+
+def expand_task(task: dict, templates: typing.Mapping[str, dict]) -> dict:
+    """Returns the task with its commands expanded, see expand_command().
+
+    Tasks without templated commands are returned as-is, others are copied.
+    """
+
+    if not uses_templates(task):
+        return task
+
+    expanded = task.copy()
+    expanded['commands'] = [expand_command(command, templates)
+                            for command in task['commands']]
+    return expanded
+
+
+@functools.lru_cache()
+def _command_classes() -> typing.Dict[str, typing.Type[AbstractCommand]]:
+    """Returns a mapping from command name to command class."""
+
+    classes = {}
+    todo = [AbstractCommand]
+    while todo:
+        cls = todo.pop()
+        todo.extend(cls.__subclasses__())
+        if cls is not AbstractCommand:
+            classes[cls.cmdname()] = cls
+    return classes
+
+
+def per_task_settings(command_name: str) -> typing.FrozenSet[str]:
+    """Returns the names of the per-task settings of the named command.
+
+    Unknown commands have no per-task settings.
+    """
+
+    cls = _command_classes().get(command_name)
+    if cls is None:
+        return frozenset()
+    return cls.per_task_settings
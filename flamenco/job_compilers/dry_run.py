@@ -0,0 +1,152 @@
+"""Dry runs of job compilers.
+
+A dry run compiles a job into an in-memory TaskSink instead of the database, and
+reports statistics of the resulting task graph. This shows the effect of job
+settings such as 'chunk_size' and 'cycles_num_chunks' before the job is submitted.
+
+To keep dry runs fast for jobs with many tasks, only one in SIZE_SAMPLE_INTERVAL
+tasks of each task type is converted to a BSON document. The size of the other
+tasks is estimated from those samples.
+"""
+
+import collections
+import datetime
+
+import attr
+import bson
+from bson import tz_util
+
+SIZE_SAMPLE_INTERVAL = 100
+
+# Size in bytes of an ObjectId array element without its key: type byte, 12 bytes
+# of ObjectId, and the nul byte that terminates the key.
+_OBJECTID_ELEMENT_SIZE = 14
+# Size in bytes of the 'parents' array without its elements: type byte, key
+# 'parents' with terminating nul byte, int32 document size, and terminating nul byte.
+_PARENTS_ARRAY_SIZE = 14
+
+
+@attr.s
+class TaskGraphStatistics:
+    task_count = attr.ib(default=0)
+    # Mapping {task type: nr of tasks}
+    task_types = attr.ib(default=attr.Factory(dict))
+    # Nr of tasks on the longest chain of tasks that depend on each other.
+    critical_path_length = attr.ib(default=0)
+    # Estimated total size of the task documents in the database, in bytes.
+    document_size = attr.ib(default=0)
+    # Largest nr of parents of a single task.
+    max_fan_in = attr.ib(default=0)
+    # Largest nr of tasks that have the same parent.
+    max_fan_out = attr.ib(default=0)
+
+
+@attr.s
+class TaskSink:
+    """Collects the tasks created by a job compiler in memory.
+
+    Has the same create_task() and flush() methods as flamenco.tasks.buffer.TaskBuffer.
+    The task IDs it returns are ints, which are only meaningful as parents of
+    other tasks created by the same sink.
+    """
+
+    task_manager = attr.ib(cmp=False, hash=False)
+    job = attr.ib(validator=attr.validators.instance_of(dict), repr=False)
+    # Creating more tasks than this raises a TooManyTasksError; None means unlimited.
+    max_tasks = attr.ib(default=None)
+
+    # Per task, indexed by task ID: the length of the longest path to the task.
+    _depths = attr.ib(default=attr.Factory(list), init=False, repr=False)
+    # Per task, indexed by task ID: the nr of tasks that have the task as parent.
+    _children = attr.ib(default=attr.Factory(list), init=False, repr=False)
+    _task_types = attr.ib(default=attr.Factory(collections.Counter), init=False)
+    _max_fan_in = attr.ib(default=0, init=False)
+    # Mapping {task type: [sampled size of a task without parents]}
+    _size_samples = attr.ib(default=attr.Factory(lambda: collections.defaultdict(list)),
+                            init=False, repr=False)
+    _parents_size = attr.ib(default=0, init=False)
+    # Mapping {template key: command template}, see TaskBuffer.
+    _command_templates = attr.ib(default=attr.Factory(dict), init=False, repr=False)
+
+    def create_task(self, commands, name, parents=None, priority=50,
+                    status='queued', *, task_type: str) -> int:
+        """Records the task, returning its ID.
+
+        :raises flamenco.exceptions.TooManyTasksError: when more than max_tasks tasks
+            are created.
+        """
+
+        from flamenco import exceptions
+
+        parents = parents or []
+        task_id = len(self._depths)
+        if self.max_tasks is not None and task_id >= self.max_tasks:
+            raise exceptions.TooManyTasksError(f'Job has more than {self.max_tasks} tasks')
+
+        self._depths.append(1 + max((self._depths[parent] for parent in parents), default=0))
+        self._children.append(0)
+        for parent in parents:
+            self._children[parent] += 1
+        self._max_fan_in = max(self._max_fan_in, len(parents))
+
+        if parents:
+            self._parents_size += _PARENTS_ARRAY_SIZE + sum(
+                _OBJECTID_ELEMENT_SIZE + len(str(index)) for index in range(len(parents)))
+        if self._task_types[task_type] % SIZE_SAMPLE_INTERVAL == 0:
+            self._sample_size(commands, name, priority, status, task_type)
+        self._task_types[task_type] += 1
+
+        return task_id
+
+    def flush(self):
+        """Does nothing, as there is no database to write to."""
+
+    def statistics(self) -> TaskGraphStatistics:
+        """Returns the statistics of the tasks created so far."""
+
+        document_size = self._parents_size
+        for task_type, count in self._task_types.items():
+            samples = self._size_samples[task_type]
+            document_size += round(count * sum(samples) / len(samples))
+
+        return TaskGraphStatistics(
+            task_count=len(self._depths),
+            task_types=dict(self._task_types),
+            critical_path_length=max(self._depths, default=0),
+            document_size=document_size,
+            max_fan_in=self._max_fan_in,
+            max_fan_out=max(self._children, default=0),
+        )
+
+    def _sample_size(self, commands, name, priority, status, task_type):
+        task = self.task_manager.task_document(self.job, commands, name, None, priority,
+                                               status, task_type=task_type,
+                                               command_templates=self._command_templates)
+
+        # Include the fields that are set when the task is inserted into the database.
+        now = datetime.datetime.now(tz=tz_util.utc)
+        task = {**task,
+                '_id': bson.ObjectId(),
+                '_created': now,
+                '_updated': now,
+                '_etag': 32 * '0'}
+        self._size_samples[task_type].append(len(bson.BSON.encode(task)))
+
+
+def placeholder_job(job: dict) -> dict:
+    """Returns a copy of the job, with placeholders for missing fields that compilers use.
+
+    This allows dry runs of jobs that have not been stored in the database.
+    """
+
+    placeholders = {
+        '_id': bson.ObjectId(),
+        '_created': datetime.datetime.now(tz=tz_util.utc),
+        'manager': bson.ObjectId(),
+        'project': bson.ObjectId(),
+        'user': bson.ObjectId(),
+        'priority': 50,
+        'status': 'queued',
+    }
+    return {**placeholders, **job}
+
@@ -13,7 +13,8 @@ class Sleep(AbstractJobCompiler):
 
         job_settings = job['settings']
         task_count = 0
-        for chunk_frames in iter_frame_range(job_settings['frames'], job_settings['chunk_size']):
+        chunks = iter_frame_range(job_settings['frames'], job_settings['chunk_size'])
+        for chunk_frames in self._iter_window(chunks):
             task_cmds = [
                 commands.Echo(message='Preparing to sleep'),
                 commands.Sleep(time_in_seconds=job_settings['time_in_seconds']),
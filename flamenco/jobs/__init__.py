@@ -4,11 +4,12 @@ import typing
 import collections
 import copy
 import datetime
+import threading
+import time
 
 import attr
 import bson
 from flask import current_app
-import pymongo.results
 import werkzeug.exceptions as wz_exceptions
 
 import pillarsdk
@@ -20,18 +21,138 @@ from flamenco import current_flamenco
 CANCELABLE_JOB_STATES = {'active', 'queued', 'failed'}
 REQUEABLE_JOB_STATES = {'completed', 'canceled', 'failed', 'paused'}
 RECREATABLE_JOB_STATES = {'canceled'}
+COMPILE_WINDOW_JOB_STATES = {'queued', 'active'}  # states in which more tasks can be created.
 ARCHIVE_JOB_STATES = {'archiving', 'archived'}  # states that represent more-or-less archived jobs.
 ARCHIVEABLE_JOB_STATES = REQUEABLE_JOB_STATES  # states from which a job can be archived.
 FAILED_TASKS_REQUEABLE_JOB_STATES = {'active', 'queued'}
 TASK_FAIL_JOB_PERCENTAGE = 10  # integer from 0 to 100
 
+# When multiple tasks of a job change status at once, the job-level consequences are evaluated
+# once per new task status, in this order. The strongest transition is evaluated last, so that
+# it determines the final job status. Statuses not mentioned here do not influence the job.
+TASK_STATUS_CASCADE_ORDER = ['queued', 'active', 'processing', 'completed', 'canceled', 'failed']
+TASK_STATUS_NO_CASCADE = {'cancel-requested', 'claimed-by-manager'}
+
+
+@attr.s(frozen=True)
+class TaskRewrite:
+    """Sets the status of tasks of a job, as consequence of a job status change.
+
+    Rewrites the tasks with a status in `from_statuses`, or when that is None, all
+    tasks except those with a status in `except_statuses`.
+    """
+    to_status = attr.ib(validator=attr.validators.instance_of(str))
+    from_statuses = attr.ib(default=None)
+    except_statuses = attr.ib(default=frozenset())
+    # Activity for rewritten tasks that do not have one yet; formatted with job_status.
+    activity = attr.ib(default='')
+
+    def matches(self, task_status: str) -> bool:
+        if task_status == self.to_status:
+            return False
+        if self.from_statuses is not None:
+            return task_status in self.from_statuses
+        return task_status not in self.except_statuses
+
+    def status_query(self) -> dict:
+        """Returns the MongoDB query on the task status."""
+        if self.from_statuses is not None:
+            return {'$in': sorted(self.from_statuses - {self.to_status})}
+        return {'$nin': sorted(self.except_statuses | {self.to_status})}
+
+
+@attr.s(frozen=True)
+class JobTransition:
+    """The consequences of a job getting a certain status."""
+
+    rewrites = attr.ib(default=())
+    # Mapping {old job status: rewrites}, overriding 'rewrites' for those old statuses.
+    rewrites_from = attr.ib(default=attr.Factory(dict))
+    # The job status that follows this one, if next_if(task status counts) is true.
+    next_status = attr.ib(default=None)
+    next_if = attr.ib(default=None)
+    # Old job statuses from which this transition has no consequences at all.
+    ignored_from = attr.ib(default=frozenset())
+
+
+CANCEL_TASKS = (
+    # Directly cancel any task that might run in the future.
+    TaskRewrite('canceled', from_statuses=frozenset({'queued'}),
+                activity='Server cancelled this task because the job got status {job_status!r}.'),
+    # Request cancel of any task that might run on the Manager.
+    TaskRewrite('cancel-requested', from_statuses=frozenset({'active', 'claimed-by-manager'}),
+                activity='Server cancelled this task because the job got status {job_status!r}.'),
+)
+
+# Transitions of job statuses not mentioned here do not influence the tasks. For example,
+# 'completed' and 'canceled' happen as response to all tasks receiving this status, and
+# 'active' happens when a task gets started, which has nothing to do with other tasks.
+JOB_TRANSITIONS = {
+    'cancel-requested': JobTransition(
+        rewrites=CANCEL_TASKS,
+        # Without cancel-requested tasks there is nothing to wait for.
+        next_status='canceled',
+        next_if=lambda counts: not counts.get('cancel-requested'),
+    ),
+    'failed': JobTransition(rewrites=CANCEL_TASKS),
+    'requeued': JobTransition(
+        # Cancel-requested tasks should remain untouched; changing their status is only
+        # allowed by Managers, to avoid race conditions.
+        rewrites=(TaskRewrite('queued',
+                              except_statuses=frozenset({'completed', 'cancel-requested'})),),
+        rewrites_from={
+            'completed': (TaskRewrite('queued', except_statuses=frozenset({'cancel-requested'})),),
+        },
+        next_status='queued',
+        # The job compiler has just finished its work; the tasks are already queued.
+        ignored_from=frozenset({'under-construction'}),
+    ),
+    'queued': JobTransition(
+        next_status='completed',
+        next_if=lambda counts: counts.get('completed', 0) == sum(counts.values()),
+    ),
+}
+
+
+@attr.s
+class JobStatusPlan:
+    """The chain of job status transitions, and the task updates that go with it.
+
+    Computed in memory by JobManager.plan_job_status_change(), and applied with a
+    single bulk write by JobManager.apply_job_status_plan().
+    """
+    job_id = attr.ib(validator=attr.validators.instance_of(bson.ObjectId))
+    manager_id = attr.ib()
+    old_status = attr.ib(validator=attr.validators.instance_of(str))
+    # The job statuses, in the order in which the job obtains them.
+    statuses = attr.ib(default=attr.Factory(list))
+    # List of (rewrite, job status that caused it, expected nr of rewritten tasks) tuples.
+    rewrites = attr.ib(default=attr.Factory(list))
+    # Mapping {task status: change in count}
+    count_deltas = attr.ib(default=attr.Factory(lambda: collections.defaultdict(int)))
+    # Whether not all tasks of this lazily compiled job have been created yet.
+    compiling_lazily = attr.ib(default=False)
+
+    @property
+    def final_status(self) -> str:
+        return self.statuses[-1] if self.statuses else self.old_status
+
+    @property
+    def tasks_changed(self) -> bool:
+        return any(expected for _, _, expected in self.rewrites)
+
 
 class ProjectSummary(object):
     """Summary of the jobs in a project."""
 
-    def __init__(self):
+    def __init__(self, counts: typing.Mapping[str, int] = None):
+        """Constructs the summary from a mapping {job status: nr of jobs}."""
+
         self._counts = collections.defaultdict(int)
         self._total = 0
+        for status, count in (counts or {}).items():
+            self._counts[status] += count
+            self._total += count
 
     def count(self, status):
         self._counts[status] += 1
@@ -62,6 +183,13 @@ class ProjectSummary(object):
 class JobManager(object):
     _log = attrs_extra.log('%s.JobManager' % __name__)
 
+    # Tuple (mapping {project ID: {job status: nr of jobs}}, time.monotonic() of query)
+    _status_counts_cache = attr.ib(default=None, init=False, repr=False)
+    # Incremented by forget_job_status_summaries(), so that queries running
+    # concurrently with a job status change do not cache their outdated result.
+    _status_counts_generation = attr.ib(default=0, init=False, repr=False)
+    _status_counts_lock = attr.ib(default=attr.Factory(threading.Lock), init=False, repr=False)
+
     def api_create_job(self, job_name, job_desc, job_type, job_settings,
                        project_id, user_id, manager_id, priority=50,
                        *, start_paused=False):
@@ -114,58 +242,73 @@ class JobManager(object):
             return {'_items': [], '_meta': {'total': 0}}
         return j
 
-    def job_status_summary(self, project_id):
-        """Returns number of shots per shot status for the given project.
+    def job_status_summary(self, project_id) -> ProjectSummary:
+        """Returns number of jobs per job status for the given project."""
 
-        :rtype: ProjectSummary
-        """
-        from .sdk import Job
+        counts = self.job_status_counts().get(bson.ObjectId(project_id), {})
+        return ProjectSummary(counts)
 
-        api = pillar_api()
+    def job_status_counts(self) -> typing.Dict[bson.ObjectId, typing.Dict[str, int]]:
+        """Returns the number of jobs per project and job status.
 
-        # TODO: turn this into an aggregation call to do the counting on
-        # MongoDB.
-        try:
-            jobs = Job.all({
-                'where': {
-                    'project': project_id,
-                },
-                'projection': {
-                    'status': 1,
-                },
-                'order': [
-                    ('status', 1),
-                ],
-            }, api=api)
-        except pillarsdk.ResourceNotFound:
-            return ProjectSummary()
+        Counts all projects with a single aggregation query. The result is cached for
+        FLAMENCO_DASHBOARD_SUMMARY_TTL; job status changes made by this process
+        invalidate the cache. The returned mapping must not be modified.
 
-        # FIXME: this breaks when we hit the pagination limit.
-        summary = ProjectSummary()
-        for job in jobs['_items']:
-            summary.count(job['status'])
+        :returns: mapping {project ID: {job status: nr of jobs}}
+        """
 
-        return summary
+        now = time.monotonic()
+        ttl = current_app.config['FLAMENCO_DASHBOARD_SUMMARY_TTL'].total_seconds()
+        with self._status_counts_lock:
+            cached = self._status_counts_cache
+            generation = self._status_counts_generation
+        if cached is not None and now - cached[1] < ttl:
+            return cached[0]
 
-    def update_job_after_task_status_change(self, job_id, task_id, new_task_status):
-        """Updates the job status based on the status of this task and other tasks in the job.
+        jobs_coll = current_flamenco.db('jobs')
+        counts = collections.defaultdict(dict)
+        for group in jobs_coll.aggregate([
+            {'$group': {
+                '_id': {'project': '$project', 'status': '$status'},
+                'count': {'$sum': 1},
+            }},
+        ]):
+            counts[group['_id'].get('project')][group['_id'].get('status')] = group['count']
+        counts = dict(counts)
+
+        with self._status_counts_lock:
+            if generation == self._status_counts_generation:
+                self._status_counts_cache = (counts, now)
+        return counts
+
+    def forget_job_status_summaries(self):
+        """Invalidates the cache of job_status_counts().
+
+        Call this after changing the status of jobs.
         """
 
-        jobs_coll = current_flamenco.db('jobs')
-        tasks_coll = current_flamenco.db('tasks')
+        with self._status_counts_lock:
+            self._status_counts_cache = None
+            self._status_counts_generation += 1
+
+    def update_job_after_task_status_change(self, job_id, task_id, new_task_status):
+        """Updates the job status based on the status of this task and other tasks in the job.
 
-        def __job_status_if_a_then_b(if_status: str, then_new_status: str):
-            """Set job to active if it was queued."""
+        Job status changes are compare-and-set operations, so concurrent task updates
+        of the same job do not need any locking.
+        """
 
-            job = jobs_coll.find_one(job_id, projection={'status': 1})
-            if job['status'] == if_status:
-                self._log.info('Job %s became %s because one of its tasks %s changed '
-                               'status to %s', job_id, then_new_status, task_id, new_task_status)
-                self.api_set_job_status(job_id, then_new_status)
+        def __transition(expected_status, new_job_status: str):
+            job = self.api_transition_job_status(job_id, expected_status, new_job_status)
+            if job is not None:
+                self._log.info('Job %s went from %s to %s because one of its tasks %s changed '
+                               'status to %s', job_id, job['status'], new_job_status,
+                               task_id, new_task_status)
 
         if new_task_status == 'queued':
             # Re-queueing a task on a completed job should re-queue the job too.
-            __job_status_if_a_then_b('completed', 'queued')
+            __transition('completed', 'queued')
             return
 
         if new_task_status in {'cancel-requested', 'claimed-by-manager'}:
@@ -175,53 +318,81 @@ class JobManager(object):
 
         if new_task_status == 'canceled':
             # This could be the last cancel-requested task to go to 'canceled.
-            statuses = tasks_coll.distinct('status', {'job': job_id})
-            if 'cancel-requested' not in statuses:
+            counts = self.task_status_counts(job_id)
+            if not counts.get('cancel-requested'):
                 self._log.info('Last task %s of job %s went from cancel-requested to canceld.',
                                task_id, job_id)
-                self.api_set_job_status(job_id, 'canceled')
+                __transition({'$ne': 'canceled'}, 'canceled')
             return
 
         if new_task_status == 'failed':
             # Count the number of failed tasks. If it is more than 10%, fail the job.
-            total_count = tasks_coll.find({'job': job_id}).count()
-            fail_count = tasks_coll.find({'job': job_id, 'status': 'failed'}).count()
+            counts = self.task_status_counts(job_id)
+            total_count = sum(counts.values())
+            fail_count = counts.get('failed', 0)
             fail_perc = fail_count / float(total_count) * 100
             if fail_perc >= TASK_FAIL_JOB_PERCENTAGE:
                 self._log.info('Failing job %s because %i of its %i tasks (%i%%) failed',
                                job_id, fail_count, total_count, fail_perc)
-                self.api_set_job_status(job_id, 'failed')
+                __transition({'$ne': 'failed'}, 'failed')
             else:
                 self._log.info('Task %s of job %s failed; '
                                'only %i of its %i tasks failed (%i%%), so ignoring for now',
                                task_id, job_id, fail_count, total_count, fail_perc)
-                __job_status_if_a_then_b('queued', 'active')
+                __transition('queued', 'active')
             return
 
         if new_task_status in {'active', 'processing'}:
-            job = jobs_coll.find_one(job_id, projection={'status': 1})
-            if job['status'] != 'active':
-                self._log.info('Job %s became active because one of its tasks %s changed '
-                               'status to %s', job_id, task_id, new_task_status)
-                self.api_set_job_status(job_id, 'active')
+            __transition({'$ne': 'active'}, 'active')
             return
 
         if new_task_status == 'completed':
-            # Maybe all tasks are completed, which should complete the job.
-            statuses = tasks_coll.distinct('status', {'job': job_id})
-            if statuses == ['completed']:
+            # Maybe all tasks are completed, which should complete the job, unless not
+            # all of its tasks have been created yet.
+            counts = self.task_status_counts(job_id)
+            if self._compile_next_window(job_id, counts):
+                __transition('queued', 'active')
+            elif set(counts.keys()) == {'completed'}:
                 self._log.info('All tasks (last one was %s) of job %s are completed, '
                                'setting job to completed.',
                                task_id, job_id)
-                self.api_set_job_status(job_id, 'completed')
+                __transition({'$ne': 'completed'}, 'completed')
             else:
-                __job_status_if_a_then_b('queued', 'active')
+                __transition('queued', 'active')
             return
 
         self._log.warning('Task %s of job %s obtained status %s, '
                           'which we do not know how to handle.',
                           task_id, job_id, new_task_status)
 
+    def update_jobs_after_task_status_changes(self, status_changes):
+        """Updates job statuses after a batch of task status changes.
+
+        The changes are collected per job, and the job-level evaluation of
+        update_job_after_task_status_change() is performed only once per job and new
+        task status, rather than once per task.
+
+        :param status_changes: iterable of (job ID, task ID, new task status) tuples.
+        """
+
+        # Mapping from job ID to {new task status: ID of the last task to get that status}
+        per_job = collections.OrderedDict()
+        for job_id, task_id, new_task_status in status_changes:
+            if new_task_status in TASK_STATUS_NO_CASCADE:
+                continue
+            per_job.setdefault(job_id, {})[new_task_status] = task_id
+
+        def cascade_order(task_status: str) -> int:
+            try:
+                return TASK_STATUS_CASCADE_ORDER.index(task_status)
+            except ValueError:
+                return len(TASK_STATUS_CASCADE_ORDER)
+
+        for job_id, task_statuses in per_job.items():
+            for new_task_status in sorted(task_statuses, key=cascade_order):
+                self.update_job_after_task_status_change(
+                    job_id, task_statuses[new_task_status], new_task_status)
+
     def web_set_job_status(self, job_id, new_status):
         """Web-level call to updates the job status."""
         from .sdk import Job
@@ -232,129 +403,479 @@ class JobManager(object):
                    'status': new_status}, api=api)
 
     def api_set_job_status(self, job_id: bson.ObjectId, new_status: str,
-                           *, now: datetime.datetime = None) -> pymongo.results.UpdateResult:
-        """API-level call to updates the job status."""
+                           *, now: datetime.datetime = None) -> typing.Optional[dict]:
+        """API-level call to updates the job status.
+
+        :returns: the job before the status change, see api_transition_job_status().
+        """
         assert new_status
         self._log.debug('Setting job %s status to "%s"', job_id, new_status)
+        return self.api_transition_job_status(job_id, None, new_status, now=now)
+
+    def api_transition_job_status(self, job_id: bson.ObjectId, expected_status, new_status: str,
+                                  *, now: datetime.datetime = None) -> typing.Optional[dict]:
+        """Compare-and-set of the job status, followed by the consequences of the change.
+
+        The job status is set with a single find_one_and_update() call, returning the
+        job as it was before. From that, the entire chain of status transitions (for
+        example requeued → queued → completed) is computed in memory, and applied with
+        a single bulk write on the tasks.
+
+        :param expected_status: query on the current job status, for example 'queued' or
+            {'$ne': 'active'}; when None, the status is set unconditionally.
+        :returns: the job before the status change, with only its status, manager and
+            task status counts, or None if the job does not exist or its status did
+            not match.
+        :raises ValueError: when the new status is invalid.
+        """
 
-        jobs_coll = current_flamenco.db('jobs')
-        curr_job = jobs_coll.find_one({'_id': job_id}, projection={'status': 1})
-        old_status = curr_job['status']
+        if now is None:
+            from bson import tz_util
+            now = datetime.datetime.now(tz=tz_util.utc)
 
-        # Go through all necessary status transitions.
-        result = None  # make sure that 'result' always has a value.
-        while new_status:
-            result = current_flamenco.update_status('jobs', job_id, new_status, now=now)
-            next_status = self.handle_job_status_change(job_id, old_status, new_status)
-            old_status, new_status = new_status, next_status
+        job = current_flamenco.update_status('jobs', job_id, new_status,
+                                             now=now, expected_status=expected_status)
+        if job is None:
+            return None
 
-        return result
+        self._ensure_task_status_counts(job)
+        plan = self.plan_job_status_change(job, new_status)
+        self.apply_job_status_plan(plan, now=now)
+        return job
 
-    def handle_job_status_change(self, job_id: bson.ObjectId,
-                                 old_status: str, new_status: str) -> typing.Optional[str]:
-        """Updates task statuses based on this job status transition.
+    def api_set_tasks_job_runnable(self, job_id: bson.ObjectId, runnable: bool):
+        """Sets the denormalised 'job_runnable' field of all tasks of the job.
 
-        :returns: the new job status, if this status transition should be
-            followed by another one.
+        The tasks' _updated and _etag fields are left alone, as the tasks themselves
+        do not change.
         """
-        self._log.info('status transition job_id %s from %r to %r', job_id, old_status, new_status)
 
-        if new_status in {'completed', 'canceled'}:
-            # Nothing to do; this will happen as a response to all tasks receiving this status.
-            return
-        elif new_status == 'active':
-            # Nothing to do; this happens when a task gets started, which has nothing to
-            # do with other tasks in the job.
+        self._log.debug('Setting job_runnable=%s on tasks of job %s', runnable, job_id)
+        tasks_coll = current_flamenco.db('tasks')
+        result = tasks_coll.update_many({'job': job_id, 'job_runnable': {'$ne': runnable}},
+                                        {'$set': {'job_runnable': runnable}})
+        if not result.modified_count:
             return
-        elif new_status in {'cancel-requested', 'failed'}:
-            return self._do_cancel_tasks(job_id, old_status, new_status)
-        elif new_status == 'requeued':
-            return self._do_requeue(job_id, old_status, new_status)
-        elif new_status == 'queued':
-            return self._do_check_completion(job_id, new_status)
 
-    def _do_cancel_tasks(self, job_id, old_status, new_status) -> typing.Optional[str]:
-        """Directly cancel any task that might run in the future.
+        job = current_flamenco.db('jobs').find_one({'_id': job_id}, {'manager': 1})
+        if job is not None:
+            current_flamenco.manager_manager.api_bump_depsgraph_generation([job.get('manager')])
 
-        Only cancels tasks that haven't been touched by a manager yet;
-        otherwise it requests the Manager to cancel the tasks.
+    def api_backfill_job_runnable(self) -> typing.Tuple[int, int]:
+        """Sets the 'job_runnable' field on all tasks, based on the status of their job.
 
-        :returns: the next job status, if a status change is required.
+        :returns: the number of modified tasks of (runnable, non-runnable) jobs.
         """
 
-        current_flamenco.update_status_q(
-            'tasks',
-            {'job': job_id, 'status': 'queued'},
-            'canceled')
-        # Request cancel of any task that might run on the manager.
-        cancelreq_result = current_flamenco.update_status_q(
-            'tasks',
-            {'job': job_id, 'status': {'$in': ['active', 'claimed-by-manager']}},
-            'cancel-requested')
-        # Update the activity of all the tasks we just cancelled (or requested cancellation),
-        # so that users can tell why they were cancelled.
-        current_flamenco.task_manager.api_set_activity(
-            {'job': job_id,
-             'status': {'$in': ['cancel-requested', 'canceled']},
-             'activity': {'$exists': False}},
-            'Server cancelled this task because the job got status %r.' % new_status
-        )
-        # If the new status is cancel-requested, and no tasks were marked as cancel-requested,
-        # we can directly transition the job to 'canceled', without waiting for more task
-        # updates.
-        if new_status == 'cancel-requested' and cancelreq_result.modified_count == 0:
-            self._log.info('handle_job_status_change(%s, %s, %s): no cancel-requested tasks, '
-                           'so transitioning directly to canceled',
-                           job_id, old_status, new_status)
-            return 'canceled'
-
-    def _do_requeue(self, job_id, old_status, new_status) -> typing.Optional[str]:
-        """Re-queue all tasks of the job, and the job itself.
-
-        :returns: the new job status, if this status transition should be
-            followed by another one.
+        from flamenco.managers.api import DEPSGRAPH_RUNNABLE_JOB_STATUSES
+
+        jobs_coll = current_flamenco.db('jobs')
+        runnable_job_ids = [job['_id'] for job in jobs_coll.find(
+            {'status': {'$in': DEPSGRAPH_RUNNABLE_JOB_STATUSES}},
+            projection={'_id': 1})]
+
+        tasks_coll = current_flamenco.db('tasks')
+        runnable = tasks_coll.update_many(
+            {'job': {'$in': runnable_job_ids}, 'job_runnable': {'$ne': True}},
+            {'$set': {'job_runnable': True}})
+        unrunnable = tasks_coll.update_many(
+            {'job': {'$nin': runnable_job_ids}, 'job_runnable': {'$ne': False}},
+            {'$set': {'job_runnable': False}})
+        return runnable.modified_count, unrunnable.modified_count
+
+    def handle_job_status_change(self, job_id: bson.ObjectId, old_status: str, new_status: str):
+        """Updates task statuses based on a job status transition performed by Eve.
+
+        The job already has the new status in the database; this applies the
+        consequences, including any status transitions that should follow it.
         """
-        if old_status == 'under-construction':
-            # Nothing to do, the job compiler has just finished its work; the tasks have
-            # already been set to 'queued' status.
-            self._log.debug('Ignoring job status change %r -> %r', old_status, new_status)
+        self._log.info('status transition job_id %s from %r to %r', job_id, old_status, new_status)
+
+        jobs_coll = current_flamenco.db('jobs')
+        job = jobs_coll.find_one({'_id': job_id}, projection={'manager': 1, 'task_status_counts': 1,
+                                                              'compilation.cursor': 1})
+        if job is None:
+            raise ValueError(f'Job {job_id} does not exist')
+
+        job['status'] = old_status
+        self._ensure_task_status_counts(job)
+        plan = self.plan_job_status_change(job, new_status)
+        self.apply_job_status_plan(plan)
+
+    def _ensure_task_status_counts(self, job: dict):
+        """Recounts the task statuses of the job document if it has no counts yet."""
+
+        if job.get('task_status_counts') is not None:
             return
+        self._log.info('Job %s has no task status counts, recounting', job['_id'])
+        job['task_status_counts'] = self.api_recount_task_statuses([job['_id']]).get(job['_id'], {})
 
-        if old_status == 'completed':
-            # Re-queue all tasks except cancel-requested; those should remain
-            # untouched; changing their status is only allowed by managers, to avoid
-            # race conditions.
-            query = {'status': {'$ne': 'cancel-requested'}}
-        else:
-            # Re-queue any non-completed task. Cancel-requested tasks should also be
-            # untouched; changing their status is only allowed by managers, to avoid
-            # race conditions.
-            query = {'status': {'$nin': ['completed', 'cancel-requested']}}
+    def plan_job_status_change(self, job: dict, new_status: str) -> JobStatusPlan:
+        """Computes the chain of status transitions of the job, using JOB_TRANSITIONS.
+
+        Does not touch the database; the task status counts of the job are used to
+        determine the effect of each transition on the tasks.
 
-        # Update the tasks.
-        query['job'] = job_id
-        current_flamenco.update_status_q('tasks', query, 'queued')
-        return 'queued'
+        :param job: the job document, with at least _id, status, manager, and
+            task_status_counts, and compilation.cursor if it has one.
+        :raises ValueError: when one of the job statuses is invalid.
+        """
+        from flamenco.eve_settings import jobs_schema
 
-    def _do_check_completion(self, job_id, new_status) -> typing.Optional[str]:
-        """Completes the job if all tasks are completed.
+        valid_statuses = jobs_schema['status']['allowed']
+        counts = {status: count for status, count in job['task_status_counts'].items() if count}
+        plan = JobStatusPlan(job['_id'], job.get('manager'), job['status'],
+                             compiling_lazily='cursor' in job.get('compilation', {}))
 
-        :returns: the new job status, if this status transition should be
-            followed by another one.
+        old_status = job['status']
+        while new_status:
+            if new_status not in valid_statuses:
+                raise ValueError('Invalid job status %s' % new_status)
+            plan.statuses.append(new_status)
+
+            transition = JOB_TRANSITIONS.get(new_status)
+            if transition is None or old_status in transition.ignored_from:
+                self._log.debug('Job %s status change %r -> %r has no consequences',
+                                job['_id'], old_status, new_status)
+                break
+
+            for rewrite in transition.rewrites_from.get(old_status, transition.rewrites):
+                rewritten = 0
+                for task_status in [status for status in counts if rewrite.matches(status)]:
+                    count = counts.pop(task_status)
+                    plan.count_deltas[task_status] -= count
+                    rewritten += count
+                if rewritten:
+                    plan.count_deltas[rewrite.to_status] += rewritten
+                    counts[rewrite.to_status] = counts.get(rewrite.to_status, 0) + rewritten
+                plan.rewrites.append((rewrite, new_status, rewritten))
+
+            if transition.next_if is not None and not transition.next_if(counts):
+                break
+            if transition.next_status == 'completed' and plan.compiling_lazily:
+                # Not all tasks of this lazily compiled job have been created yet.
+                break
+            old_status, new_status = new_status, transition.next_status
+
+        self._log.info('Job %s goes from %r via %s, changing status of tasks %s',
+                       plan.job_id, plan.old_status, ' -> '.join(plan.statuses),
+                       dict(plan.count_deltas))
+        return plan
+
+    def apply_job_status_plan(self, plan: JobStatusPlan, *, now: datetime.datetime = None):
+        """Performs the task and job updates of the plan.
+
+        The job should already have the first status of the plan in the database. All
+        task updates are sent in one ordered bulk write, followed by at most one update
+        of the job; everything gets the same _updated timestamp.
+
+        :param now: the _updated field is set to this timestamp.
         """
 
+        import uuid
+        from bson import tz_util
+        from pymongo import UpdateMany
+        from flamenco.managers.api import DEPSGRAPH_RUNNABLE_JOB_STATUSES
+
+        if now is None:
+            now = datetime.datetime.now(tz=tz_util.utc)
+        etag = uuid.uuid4().hex
         tasks_coll = current_flamenco.db('tasks')
-        total_tasks = tasks_coll.find({'job': job_id}).count()
-        completed_tasks = tasks_coll.find({'job': job_id, 'status': 'completed'}).count()
-        if completed_tasks < total_tasks:
-            # Not yet completed, so just stay at current status.
-            self._log.debug('Job %s has %d of %d tasks completed, staying at status %r',
-                            job_id, completed_tasks, total_tasks, new_status)
+        jobs_coll = current_flamenco.db('jobs')
+
+        # Tasks entering 'cancel-requested' are tracked per Manager.
+        cancel_requested = collections.defaultdict(list)
+        requests = []
+        for rewrite, _, rewritten in plan.rewrites:
+            query = {'job': plan.job_id, 'status': rewrite.status_query()}
+            if rewrite.to_status == 'cancel-requested' and rewritten:
+                for task in tasks_coll.find(query, projection={'manager': 1}):
+                    cancel_requested[task.get('manager')].append(task['_id'])
+            requests.append(UpdateMany(query, {'$set': {
+                'status': rewrite.to_status, '_updated': now, '_etag': etag}}))
+
+        # Let users know why their tasks changed status.
+        for rewrite, job_status, rewritten in plan.rewrites:
+            if not rewrite.activity or not rewritten:
+                continue
+            requests.append(UpdateMany(
+                {'job': plan.job_id, 'status': rewrite.to_status, 'activity': {'$exists': False}},
+                {'$set': {'activity': rewrite.activity.format(job_status=job_status),
+                          '_updated': now, '_etag': etag}}))
+
+        # The tasks' _updated and _etag fields are left alone when only their runnability
+        # changes, as the tasks themselves do not change.
+        is_runnable = plan.final_status in DEPSGRAPH_RUNNABLE_JOB_STATUSES
+        runnability_changed = is_runnable != (plan.old_status in DEPSGRAPH_RUNNABLE_JOB_STATUSES)
+        if runnability_changed:
+            requests.append(UpdateMany({'job': plan.job_id, 'job_runnable': {'$ne': is_runnable}},
+                                       {'$set': {'job_runnable': is_runnable}}))
+
+        if requests:
+            bulk_result = tasks_coll.bulk_write(requests, ordered=True)
+            self._log.debug('Job %s status change modified %i tasks in %i updates',
+                            plan.job_id, bulk_result.modified_count, len(requests))
+
+        # The job already has the first status of the plan; follow-up transitions only
+        # change it again when nobody else changed it in the mean time.
+        inc = {f'task_status_counts.{status}': delta
+               for status, delta in plan.count_deltas.items()
+               if delta}
+        followed_up = False
+        if len(plan.statuses) > 1:
+            update = {'$set': {'status': plan.final_status, '_updated': now, '_etag': etag}}
+            if inc:
+                update['$inc'] = inc
+            result = jobs_coll.update_one({'_id': plan.job_id, 'status': plan.statuses[0]}, update)
+            followed_up = bool(result.matched_count)
+            if not followed_up:
+                self._log.info('Job %s changed status concurrently, not transitioning from %r '
+                               'to %r', plan.job_id, plan.statuses[0], plan.final_status)
+        if inc and not followed_up:
+            jobs_coll.update_one({'_id': plan.job_id}, {'$inc': inc})
+
+        self.forget_job_status_summaries()
+        if cancel_requested:
+            current_flamenco.manager_manager.api_update_cancel_requested(added=cancel_requested)
+        if plan.tasks_changed or runnability_changed:
+            current_flamenco.manager_manager.api_bump_depsgraph_generation([plan.manager_id])
+
+        # Creating the next window of a lazily compiled job is normally triggered by its
+        # tasks completing. When all its tasks finished while the job was paused or
+        # failed, that won't happen any more, so check again when the job resumes.
+        resumed = len(plan.statuses) <= 1 or followed_up
+        if plan.compiling_lazily and resumed \
+                and plan.final_status in COMPILE_WINDOW_JOB_STATES \
+                and plan.old_status not in COMPILE_WINDOW_JOB_STATES:
+            self._compile_next_window(plan.job_id, self.task_status_counts(plan.job_id))
+
+    def task_status_counts(self, job_id: bson.ObjectId) -> typing.Dict[str, int]:
+        """Returns the number of tasks per task status of this job.
+
+        Statuses without any tasks are not included. Jobs that do not have their
+        task status counts stored yet (for example jobs created before this was
+        introduced) are recounted.
+        """
+
+        jobs_coll = current_flamenco.db('jobs')
+        job = jobs_coll.find_one({'_id': job_id}, projection={'task_status_counts': 1})
+        if job is None:
+            raise ValueError(f'Job {job_id} does not exist')
+
+        counts = job.get('task_status_counts')
+        if counts is None:
+            self._log.info('Job %s has no task status counts, recounting', job_id)
+            counts = self.api_recount_task_statuses([job_id]).get(job_id, {})
+
+        return {status: count for status, count in counts.items() if count}
+
+    def api_inc_task_status_counts(
+            self, deltas: typing.Mapping[bson.ObjectId, typing.Mapping[str, int]]):
+        """Applies changes to the per-job task status counts.
+
+        Jobs that do not have task status counts yet are left alone; they are
+        recounted on first use.
+
+        :param deltas: mapping {job ID: {task status: change in count}}.
+        """
+
+        from pymongo import UpdateOne
+
+        requests = []
+        for job_id, job_deltas in deltas.items():
+            inc = {f'task_status_counts.{status}': delta
+                   for status, delta in job_deltas.items()
+                   if delta}
+            if not inc:
+                continue
+            requests.append(UpdateOne({'_id': job_id, 'task_status_counts': {'$exists': True}},
+                                      {'$inc': inc}))
+
+        if not requests:
             return
 
-        self._log.info("Job %s has all %d tasks completed, transition from %r to 'completed'",
-                       job_id, total_tasks, new_status)
-        return 'completed'
+        jobs_coll = current_flamenco.db('jobs')
+        jobs_coll.bulk_write(requests, ordered=False)
+
+    def api_reset_task_status_counts(self, job_id: bson.ObjectId):
+        """Marks the job as having no tasks at all."""
+
+        jobs_coll = current_flamenco.db('jobs')
+        jobs_coll.update_one({'_id': job_id}, {'$set': {'task_status_counts': {}}})
+
+    def api_recount_task_statuses(self, job_ids: typing.List[bson.ObjectId] = None) \
+            -> typing.Dict[bson.ObjectId, typing.Dict[str, int]]:
+        """Recounts the tasks per task status, and stores the result in the jobs.
+
+        Performs a single aggregation query on the tasks collection.
+
+        :param job_ids: the jobs to recount; when None, all jobs are recounted.
+        :returns: mapping {job ID: {task status: task count}}, for those jobs that
+            have any tasks.
+        """
+
+        from pymongo import UpdateOne
+
+        tasks_coll = current_flamenco.db('tasks')
+        jobs_coll = current_flamenco.db('jobs')
+
+        pipeline = [
+            {'$group': {
+                '_id': {'job': '$job', 'status': '$status'},
+                'count': {'$sum': 1},
+            }},
+        ]
+        if job_ids is not None:
+            pipeline.insert(0, {'$match': {'job': {'$in': job_ids}}})
+
+        counts = collections.defaultdict(dict)
+        for group in tasks_coll.aggregate(pipeline):
+            counts[group['_id']['job']][group['_id']['status']] = group['count']
+
+        requests = [UpdateOne({'_id': job_id}, {'$set': {'task_status_counts': job_counts}})
+                    for job_id, job_counts in counts.items()]
+        if requests:
+            jobs_coll.bulk_write(requests, ordered=False)
+
+        # Jobs without any tasks should still get their (empty) counts.
+        no_tasks_query = {'_id': {'$nin': list(counts.keys())}}
+        if job_ids is not None:
+            no_tasks_query = {'$and': [no_tasks_query, {'_id': {'$in': job_ids}}]}
+        jobs_coll.update_many(no_tasks_query, {'$set': {'task_status_counts': {}}})
+
+        self._log.info('Recounted task statuses of %i jobs with tasks', len(counts))
+        return counts
+
+    def api_set_compile_progress(self, job_id: bson.ObjectId, tasks_created: int):
+        """Records the nr of tasks the job compiler has created so far."""
+
+        jobs_coll = current_flamenco.db('jobs')
+        jobs_coll.update_one({'_id': job_id},
+                             {'$set': {'compilation.tasks_created': tasks_created}})
+
+    def api_inc_compile_progress(self, job_id: bson.ObjectId, tasks_created: int):
+        """Adds to the nr of tasks the job compiler has created so far."""
+
+        jobs_coll = current_flamenco.db('jobs')
+        jobs_coll.update_one({'_id': job_id},
+                             {'$inc': {'compilation.tasks_created': tasks_created}})
+
+    def api_add_command_templates(self, job_id: bson.ObjectId,
+                                  templates: typing.Mapping[str, dict]):
+        """Stores command templates on the job, see TaskBuffer."""
+
+        jobs_coll = current_flamenco.db('jobs')
+        jobs_coll.update_one({'_id': job_id},
+                             {'$set': {f'command_templates.{key}': template
+                                       for key, template in templates.items()}})
+
+    def api_set_compile_cursor(self, job_id: bson.ObjectId, cursor: typing.Optional[int]):
+        """Records where the next window of a lazily compiled job starts.
+
+        Also releases the claim of api_claim_compile_window(). A cursor of None
+        means that all tasks of the job have been created.
+        """
+
+        jobs_coll = current_flamenco.db('jobs')
+        if cursor is None:
+            update = {'$unset': {'compilation.cursor': True,
+                                 'compilation.window_claimed': True}}
+        else:
+            update = {'$set': {'compilation.cursor': cursor},
+                      '$unset': {'compilation.window_claimed': True}}
+        jobs_coll.update_one({'_id': job_id}, update)
+
+    def api_claim_compile_window(self, job_id: bson.ObjectId,
+                                 cursor: int) -> typing.Optional[dict]:
+        """Claims the compilation of the window of a lazily compiled job.
+
+        The claim is the time at which it was made, and is released by
+        api_set_compile_cursor() or api_fail_compile_window(). A claim older than
+        FLAMENCO_COMPILE_WINDOW_CLAIM_TIMEOUT is taken over, as the process that made
+        it probably died.
+
+        :returns: the job, or None if the job is not queued or active, or the window
+            has already been claimed or compiled.
+        """
+
+        from bson import tz_util
+        from pymongo import ReturnDocument
+
+        now = datetime.datetime.now(tz=tz_util.utc)
+        jobs_coll = current_flamenco.db('jobs')
+        return jobs_coll.find_one_and_update(
+            {'_id': job_id,
+             'status': {'$in': list(COMPILE_WINDOW_JOB_STATES)},
+             'compilation.cursor': cursor,
+             '$or': [{'compilation.window_claimed': {'$exists': False}},
+                     {'compilation.window_claimed': {'$lt': self._stale_claim_time(now)}}]},
+            {'$set': {'compilation.window_claimed': now}},
+            return_document=ReturnDocument.AFTER)
+
+    @staticmethod
+    def _stale_claim_time(now: datetime.datetime) -> datetime.datetime:
+        """Returns the time before which window claims are considered abandoned."""
+        return now - current_app.config['FLAMENCO_COMPILE_WINDOW_CLAIM_TIMEOUT']
+
+    def api_fail_compile_window(self, job_id: bson.ObjectId, reason: str):
+        """Fails a lazily compiled job of which a window could not be compiled.
+
+        The window is released, so that it is compiled again after the job has
+        been re-queued.
+        """
+
+        self._log.warning('Compilation of job %s failed: %s', job_id, reason)
+
+        jobs_coll = current_flamenco.db('jobs')
+        jobs_coll.update_one({'_id': job_id},
+                             {'$set': {'compilation.failure_reason': reason},
+                              '$unset': {'compilation.window_claimed': True}})
+        self.api_set_job_status(job_id, 'failed')
+
+    def _compile_next_window(self, job_id: bson.ObjectId, counts: typing.Mapping[str, int]) \
+            -> bool:
+        """Starts compiling the next window of the job when it runs out of tasks.
+
+        This happens when fewer than FLAMENCO_COMPILE_LOW_WATER tasks of the job
+        are unfinished.
+
+        :returns: True iff not all tasks of the job have been created yet.
+        """
+
+        from bson import tz_util
+        from flamenco import job_compilers
+
+        jobs_coll = current_flamenco.db('jobs')
+        job = jobs_coll.find_one({'_id': job_id, 'compilation.cursor': {'$exists': True}},
+                                 projection={'compilation': 1})
+        if job is None:
+            return False
+
+        cursor = job['compilation']['cursor']
+        claimed = job['compilation'].get('window_claimed')
+        now = datetime.datetime.now(tz=tz_util.utc)
+        unfinished = sum(counts.values()) - counts.get('completed', 0)
+        if unfinished < current_app.config['FLAMENCO_COMPILE_LOW_WATER'] \
+                and (claimed is None or claimed < self._stale_claim_time(now)):
+            self._log.info('Job %s has %i unfinished tasks, compiling window %i',
+                           job_id, unfinished, cursor)
+            job_compilers.start_compile_window(job_id, cursor)
+        return True
+
+    def api_fail_compilation(self, job_id: bson.ObjectId, reason: str):
+        """Cancels a job that could not be compiled, recording the reason.
+
+        The tasks that were created before the failure are deleted, so that the
+        job can be re-created once the cause of the failure has been fixed.
+        """
+
+        self._log.warning('Compilation of job %s failed: %s', job_id, reason)
+        current_flamenco.task_manager.api_delete_tasks_for_job(job_id)
+
+        jobs_coll = current_flamenco.db('jobs')
+        jobs_coll.update_one({'_id': job_id},
+                             {'$set': {'compilation.failure_reason': reason}})
+        self.api_transition_job_status(job_id, 'under-construction', 'canceled')
 
     def archive_job(self, job: dict):
         """Initiates job archival by creating a Celery task for it."""
@@ -384,7 +905,8 @@ class JobManager(object):
 
 
 def setup_app(app):
-    from . import eve_hooks, patch
+    from . import eve_hooks, patch, api
 
     eve_hooks.setup_app(app)
     patch.setup_app(app)
+    api.setup_app(app)
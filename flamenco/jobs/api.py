@@ -0,0 +1,55 @@
+"""API interface for jobs, in addition to what Eve provides."""
+
+import logging
+
+import attr
+from flask import Blueprint, request
+import werkzeug.exceptions as wz_exceptions
+
+from pillar.api.utils import authorization
+
+api_blueprint = Blueprint('flamenco.jobs.api', __name__)
+log = logging.getLogger(__name__)
+
+
+@api_blueprint.route('/dry-run', methods=['POST'])
+@authorization.require_login(require_cap='flamenco-use')
+def dry_run():
+    """Compiles a job without creating it, and returns statistics of its tasks.
+
+    Expects a JSON object with the 'job_type' and 'settings' of the job, like
+    those used to create a job. See flamenco.job_compilers.dry_run.TaskGraphStatistics
+    for the returned statistics. Jobs with more than FLAMENCO_DRY_RUN_MAX_TASKS
+    tasks are refused with 422 Unprocessable Entity.
+    """
+
+    import time
+    from pillar.api.utils import jsonify
+    from flamenco import job_compilers, exceptions
+
+    data = request.get_json()
+    if not isinstance(data, dict):
+        raise wz_exceptions.BadRequest('Expected a JSON object')
+    job_type = data.get('job_type')
+    settings = data.get('settings')
+    if not job_type or not isinstance(settings, dict):
+        raise wz_exceptions.BadRequest('Expected job_type and settings')
+
+    start = time.monotonic()
+    try:
+        stats = job_compilers.dry_run_job({'job_type': job_type, 'settings': settings})
+    except KeyError:
+        raise wz_exceptions.UnprocessableEntity(f'Unknown job type {job_type!r}')
+    except exceptions.TooManyTasksError as ex:
+        raise wz_exceptions.UnprocessableEntity(f'Job is too large for a dry run: {ex}')
+    except (exceptions.JobSettingError, ValueError, TypeError) as ex:
+        raise wz_exceptions.UnprocessableEntity(f'Invalid job settings: {ex}')
+    duration = time.monotonic() - start
+
+    log.info('Dry run of %s job with %i tasks took %.3f seconds',
+             job_type, stats.task_count, duration)
+    return jsonify(attr.asdict(stats))
+
+
+def setup_app(app):
+    app.register_api_blueprint(api_blueprint, url_prefix='/flamenco/jobs')
@@ -18,6 +18,8 @@ def before_inserting_jobs(jobs):
         # Jobs are forced to be 'under construction' when they are created.
         # This is set to 'queued' when job compilation is finished.
         job['status'] = 'under-construction'
+        # Tasks are counted per status as they are created.
+        job['task_status_counts'] = {}
 
         try:
             job_compilers.validate_job(job)
@@ -34,7 +36,7 @@ def after_inserting_jobs(jobs):
         # Prepare storage dir for the job files?
         # Generate tasks
         log.info(f'Generating tasks for job {job_id}')
-        job_compilers.compile_job(job)
+        job_compilers.start_compile_job(job)
 
 
 def check_job_permission_fetch(job_doc):
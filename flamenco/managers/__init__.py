@@ -1,8 +1,11 @@
 """Manager management."""
 
+import collections
 import datetime
 import enum
 import logging
+import threading
+import time
 import typing
 
 import attr
@@ -28,6 +31,14 @@ class ShareAction(enum.Enum):
     unshare = 'unshare'
 
 
+# The fields of a Manager that are needed by Manager API calls, see ManagerManager.api_info().
+API_INFO_PROJECTION = {
+    'service_account': 1,
+    'cancel_requested_version': 1,
+    'depsgraph_generation': 1,
+}
+
+
 @attr.s
 class ManagerManager(object):
     """Manager manager.
@@ -39,6 +50,20 @@ class ManagerManager(object):
     _log = attrs_extra.log('%s.ManagerManager' % __name__)
     ShareAction = ShareAction  # so you can use current_flamenco.manager_manager.ShareAction
 
+    # Mapping {manager ID: (cancel_requested_version, frozenset of task IDs or None if unknown)}
+    _cancel_requested_cache = attr.ib(default=attr.Factory(dict), init=False, repr=False)
+    _cancel_requested_lock = attr.ib(default=attr.Factory(threading.Lock), init=False, repr=False)
+
+    # Bounded mapping {manager ID: (Manager document with API_INFO_PROJECTION fields,
+    # time.monotonic() when it was fetched)}, least recently fetched first.
+    _api_info_cache = attr.ib(default=attr.Factory(collections.OrderedDict),
+                              init=False, repr=False)
+    _api_info_lock = attr.ib(default=attr.Factory(threading.Lock), init=False, repr=False)
+    # Mapping {manager ID: (X-Flamenco-If-Updated-Since header, depsgraph generation)} of
+    # the last depsgraph poll for which it is known that no tasks were modified.
+    _unchanged_depsgraphs = attr.ib(default=attr.Factory(dict), init=False, repr=False)
+    _generation_lock = attr.ib(default=attr.Factory(threading.Lock), init=False, repr=False)
+
     def create_new_manager(self, name: str, description: str, owner_id: bson.ObjectId) \
             -> typing.Tuple[dict, dict, dict]:
         """Creates a new Manager, including its system account."""
@@ -284,6 +309,7 @@ class ManagerManager(object):
             update['$unset']['user_groups'] = 1
 
         res: UpdateResult = mngr_coll.update_one({'_id': manager_id}, update)
+        self.forget_api_info(manager_id)
 
         if res.matched_count < 1:
             self._log.error('Unable to update projects on Manager %s to %s: %s',
@@ -317,6 +343,7 @@ class ManagerManager(object):
         self._log.info('Revoking authentication tokens for Manager %s on behalf of user %s',
                        manager_id, current_user.user_id)
         service_account_id = self.find_service_account_id(manager_id)
+        self.forget_api_info(manager_id)
 
         tokens_coll = current_app.db('tokens')
         result: pymongo.results.DeleteResult = tokens_coll.delete_many({'user': service_account_id})
@@ -400,6 +427,241 @@ class ManagerManager(object):
         managers = managers_coll.find({'owner': {'$in': user_group_ids}}, projection)
         return managers
 
+    def api_info(self, manager_id: bson.ObjectId) -> typing.Optional[dict]:
+        """Returns the Manager's API_INFO_PROJECTION fields, or None if it does not exist.
+
+        The result is cached for FLAMENCO_MANAGER_API_CACHE_TTL, and shared between
+        requests. Changes made by this process invalidate or update the cache; changes
+        made by other processes are seen when the cached document expires.
+        The returned document must not be modified.
+        """
+
+        now = time.monotonic()
+        ttl = current_app.config['FLAMENCO_MANAGER_API_CACHE_TTL'].total_seconds()
+        with self._api_info_lock:
+            cached = self._api_info_cache.get(manager_id)
+        if cached is not None and now - cached[1] < ttl:
+            return cached[0]
+
+        managers_coll = current_flamenco.db('managers')
+        mngr_doc = managers_coll.find_one({'_id': manager_id}, projection=API_INFO_PROJECTION)
+        if mngr_doc is None:
+            self.forget_api_info(manager_id)
+            return None
+
+        max_size = current_app.config['FLAMENCO_MANAGER_API_CACHE_SIZE']
+        with self._api_info_lock:
+            self._api_info_cache[manager_id] = (mngr_doc, now)
+            self._api_info_cache.move_to_end(manager_id)
+            while len(self._api_info_cache) > max_size:
+                self._api_info_cache.popitem(last=False)
+        return mngr_doc
+
+    def forget_api_info(self, manager_id: bson.ObjectId):
+        """Removes the Manager from the api_info() cache.
+
+        Call this after modifying the Manager or its service account.
+        """
+
+        with self._api_info_lock:
+            self._api_info_cache.pop(manager_id, None)
+
+    def _update_api_info(self, manager_id: bson.ObjectId, **fields):
+        """Updates the cached api_info() document, if there is one."""
+
+        with self._api_info_lock:
+            cached = self._api_info_cache.get(manager_id)
+            if cached is not None:
+                self._api_info_cache[manager_id] = ({**cached[0], **fields}, cached[1])
+
+    def cancel_requested_tasks(self, manager_id: bson.ObjectId,
+                               known_version: int) -> typing.FrozenSet[bson.ObjectId]:
+        """Returns the IDs of the Manager's tasks in status 'cancel-requested'.
+
+        :param known_version: the Manager's 'cancel_requested_version' as known by the
+            caller, typically from a Manager document it fetched already. When the
+            cached set is at least this recent, no database query is performed.
+        """
+
+        with self._cancel_requested_lock:
+            cached = self._cancel_requested_cache.get(manager_id)
+        if cached is not None and cached[0] >= known_version:
+            if cached[1] is not None:
+                return cached[1]
+        elif not known_version:
+            # This Manager never had any cancel-requested tasks.
+            return frozenset()
+
+        managers_coll = current_flamenco.db('managers')
+        mngr_doc = managers_coll.find_one(
+            {'_id': manager_id},
+            projection={'cancel_requested_tasks': 1, 'cancel_requested_version': 1})
+        if mngr_doc is None:
+            return frozenset()
+
+        version = mngr_doc.get('cancel_requested_version', 0)
+        task_ids = frozenset(mngr_doc.get('cancel_requested_tasks', []))
+        with self._cancel_requested_lock:
+            cached = self._cancel_requested_cache.get(manager_id)
+            if cached is None or cached[0] <= version:
+                self._cancel_requested_cache[manager_id] = (version, task_ids)
+        return task_ids
+
+    def api_update_cancel_requested(
+            self,
+            added: typing.Mapping[bson.ObjectId, typing.Iterable[bson.ObjectId]] = None,
+            removed: typing.Mapping[bson.ObjectId, typing.Iterable[bson.ObjectId]] = None):
+        """Maintains the per-Manager sets of cancel-requested task IDs.
+
+        :param added: mapping {manager ID: task IDs that entered 'cancel-requested'}
+        :param removed: mapping {manager ID: task IDs that left 'cancel-requested'}
+        """
+
+        for manager_id, task_ids in (added or {}).items():
+            self._modify_cancel_requested(manager_id, set(task_ids), add=True)
+        for manager_id, task_ids in (removed or {}).items():
+            self._modify_cancel_requested(manager_id, set(task_ids), add=False)
+
+    def _modify_cancel_requested(self, manager_id: bson.ObjectId,
+                                 task_ids: typing.Set[bson.ObjectId], *, add: bool):
+        from pymongo import ReturnDocument
+
+        if manager_id is None or not task_ids:
+            return
+
+        if add:
+            update = {'$addToSet': {'cancel_requested_tasks': {'$each': list(task_ids)}}}
+        else:
+            update = {'$pull': {'cancel_requested_tasks': {'$in': list(task_ids)}}}
+        update['$inc'] = {'cancel_requested_version': 1}
+
+        managers_coll = current_flamenco.db('managers')
+        mngr_doc = managers_coll.find_one_and_update(
+            {'_id': manager_id}, update,
+            projection={'cancel_requested_version': 1},
+            return_document=ReturnDocument.AFTER)
+        if mngr_doc is None:
+            self._log.warning('Unable to update cancel-requested tasks of non-existing '
+                              'Manager %s', manager_id)
+            return
+        version = mngr_doc['cancel_requested_version']
+        self._update_api_info(manager_id, cancel_requested_version=version)
+
+        # Apply the same change to the cached set, if it is exactly one version behind.
+        # Otherwise only remember the new version; the set has to be fetched again.
+        with self._cancel_requested_lock:
+            cached = self._cancel_requested_cache.get(manager_id)
+            if cached is None or cached[1] is None or cached[0] != version - 1:
+                self._cancel_requested_cache[manager_id] = (version, None)
+                return
+            if add:
+                cached_ids = cached[1] | task_ids
+            else:
+                cached_ids = cached[1] - task_ids
+            self._cancel_requested_cache[manager_id] = (version, frozenset(cached_ids))
+
+    def api_rebuild_cancel_requested(self) -> typing.Dict[bson.ObjectId, int]:
+        """Rebuilds the cancel-requested task IDs of all Managers from the tasks collection.
+
+        :returns: mapping {manager ID: nr of cancel-requested tasks} for those Managers
+            that have cancel-requested tasks.
+        """
+
+        from pymongo import UpdateOne
+
+        tasks_coll = current_flamenco.db('tasks')
+        grouped = tasks_coll.aggregate([
+            {'$match': {'status': 'cancel-requested'}},
+            {'$group': {'_id': '$manager', 'task_ids': {'$push': '$_id'}}},
+        ])
+        task_ids_per_manager = {group['_id']: group['task_ids']
+                                for group in grouped
+                                if group['_id'] is not None}
+
+        managers_coll = current_flamenco.db('managers')
+        requests = [UpdateOne({'_id': manager_id},
+                              {'$set': {'cancel_requested_tasks': task_ids},
+                               '$inc': {'cancel_requested_version': 1}})
+                    for manager_id, task_ids in task_ids_per_manager.items()]
+        if requests:
+            managers_coll.bulk_write(requests, ordered=False)
+        managers_coll.update_many(
+            {'_id': {'$nin': list(task_ids_per_manager.keys())}},
+            {'$set': {'cancel_requested_tasks': []},
+             '$inc': {'cancel_requested_version': 1}})
+
+        with self._cancel_requested_lock:
+            self._cancel_requested_cache.clear()
+        with self._api_info_lock:
+            self._api_info_cache.clear()
+
+        return {manager_id: len(task_ids)
+                for manager_id, task_ids in task_ids_per_manager.items()}
+
+    def depsgraph_generation(self, manager_id: bson.ObjectId, *, mngr_doc: dict = None) -> int:
+        """Returns the depsgraph generation of the Manager.
+
+        When mngr_doc is not given, the generation is taken from api_info().
+        """
+
+        if mngr_doc is None:
+            mngr_doc = self.api_info(manager_id) or {}
+        return mngr_doc.get('depsgraph_generation', 0)
+
+    def api_bump_depsgraph_generation(self, manager_ids: typing.Iterable[bson.ObjectId]):
+        """Increments the depsgraph generation of the given Managers.
+
+        Call this after changing tasks in a way that may change the depsgraphs of
+        their Managers, so that the next depsgraph poll queries the tasks again.
+        Long-polling depsgraph requests of these Managers are woken up.
+
+        The new generation is stored in the api_info() cache, rather than evicting
+        the Managers from it, as this happens on nearly every task update.
+        """
+
+        from pymongo import ReturnDocument
+
+        manager_ids = {manager_id for manager_id in manager_ids if manager_id is not None}
+        if not manager_ids:
+            return
+
+        managers_coll = current_flamenco.db('managers')
+        for manager_id in manager_ids:
+            mngr_doc = managers_coll.find_one_and_update(
+                {'_id': manager_id},
+                {'$inc': {'depsgraph_generation': 1}},
+                projection={'depsgraph_generation': 1},
+                return_document=ReturnDocument.AFTER)
+            if mngr_doc is None:
+                self.forget_api_info(manager_id)
+            else:
+                self._update_api_info(manager_id,
+                                      depsgraph_generation=mngr_doc['depsgraph_generation'])
+
+        current_flamenco.change_notifier.notify(manager_ids)
+
+    def depsgraph_unchanged(self, manager_id: bson.ObjectId, modified_since: str,
+                            generation: int) -> bool:
+        """Returns True iff no tasks were modified since modified_since at this generation.
+
+        This only returns True when remember_unchanged_depsgraph() was called with the
+        same arguments, so when in doubt the depsgraph has to be queried.
+        """
+
+        with self._generation_lock:
+            return self._unchanged_depsgraphs.get(manager_id) == (modified_since, generation)
+
+    def remember_unchanged_depsgraph(self, manager_id: bson.ObjectId, modified_since: str,
+                                     generation: int):
+        """Remembers that no tasks were modified since modified_since at this generation.
+
+        The generation must have been obtained before querying the tasks, so that
+        changes made during the query bump the generation past it.
+        """
+
+        with self._generation_lock:
+            self._unchanged_depsgraphs[manager_id] = (modified_since, generation)
+
 
 def setup_app(app):
     from . import eve_hooks, api, patch, linking_api
@@ -0,0 +1,177 @@
+"""Admission control for the Manager API.
+
+When MongoDB is slow, Managers that keep sending requests make things worse. The
+AdmissionController keeps track, per endpoint, of the nr of admitted requests that
+are still in progress, and of the recent latency of their database work. Requests
+over budget are rejected with a Retry-After header:
+
+- 429 Too Many Requests when too many requests are in flight for the endpoint;
+- 503 Service Unavailable when the recent latency of the endpoint is too high.
+
+Priority requests, such as task updates that change task statuses, can use the
+in-flight capacity that is reserved for them, and are not rejected because of
+high latency; this keeps the latency measurements fresh as well.
+
+The state and counters are per web process.
+"""
+
+import collections
+import contextlib
+import math
+import threading
+import time
+import typing
+
+import attr
+
+from pillar import attrs_extra
+
+# Smoothing factor of the exponentially weighted moving average of the latency.
+LATENCY_SMOOTHING = 0.2
+MAX_RETRY_AFTER = 60  # seconds
+
+
+@attr.s
+class Rejection:
+    """Describes why a request was not admitted."""
+    status = attr.ib(validator=attr.validators.instance_of(int))
+    message = attr.ib(validator=attr.validators.instance_of(str))
+    retry_after = attr.ib(validator=attr.validators.instance_of(int))
+
+
+@attr.s
+class EndpointStats:
+    in_flight = attr.ib(default=0)
+    # Exponentially weighted moving average of the duration of database work, in seconds.
+    latency = attr.ib(default=0.0)
+    # time.monotonic() of the last latency measurement.
+    measured_at = attr.ib(default=0.0)
+    admitted = attr.ib(default=0)
+    admitted_priority = attr.ib(default=0)
+    # Mapping {HTTP status code: nr of rejected requests}
+    rejected = attr.ib(default=attr.Factory(lambda: collections.defaultdict(int)))
+
+
+@attr.s
+class AdmissionController:
+    _log = attrs_extra.log('%s.AdmissionController' % __name__)
+
+    _stats = attr.ib(default=attr.Factory(lambda: collections.defaultdict(EndpointStats)),
+                     init=False, repr=False)
+    _lock = attr.ib(default=attr.Factory(threading.Lock), init=False, repr=False)
+
+    def admit(self, endpoint: str, *, priority: bool) -> typing.Optional[Rejection]:
+        """Decides whether a request to the endpoint can be handled.
+
+        An admitted request counts as in flight until release() is called for it,
+        which should happen when the request ends.
+
+        :returns: None when the request is admitted, or a Rejection if not.
+        """
+
+        from flask import current_app
+
+        config = current_app.config
+        if not config['FLAMENCO_ADMISSION_CONTROL']:
+            with self._lock:
+                self._stats[endpoint].in_flight += 1
+            return None
+
+        limits = config['FLAMENCO_ADMISSION_MAX_IN_FLIGHT']
+        limit = limits.get(endpoint, limits['default'])
+        if not priority:
+            limit = int(limit * (1 - config['FLAMENCO_ADMISSION_PRIORITY_RESERVE']))
+        max_latency = config['FLAMENCO_ADMISSION_MAX_LATENCY'].total_seconds()
+        window = config['FLAMENCO_ADMISSION_LATENCY_WINDOW'].total_seconds()
+
+        with self._lock:
+            stats = self._stats[endpoint]
+            latency = stats.latency
+            if time.monotonic() - stats.measured_at > window:
+                # Old measurements say nothing about the current state of the database.
+                latency = 0.0
+
+            rejection = None
+            if stats.in_flight >= limit:
+                retry_after = latency * (1 + stats.in_flight / max(limit, 1))
+                rejection = Rejection(429, f'Too many {endpoint} requests in progress',
+                                      _retry_after(retry_after))
+            elif not priority and latency > max_latency:
+                rejection = Rejection(503, f'Database is too slow for {endpoint} requests',
+                                      _retry_after(2 * latency))
+
+            if rejection is None:
+                stats.in_flight += 1
+                stats.admitted += 1
+                if priority:
+                    stats.admitted_priority += 1
+            else:
+                stats.rejected[rejection.status] += 1
+
+        if rejection is not None:
+            self._log.info('Rejecting %s request with status %i, retry after %i seconds: '
+                           '%i in flight, latency %.3f seconds',
+                           endpoint, rejection.status, rejection.retry_after,
+                           stats.in_flight, latency)
+        return rejection
+
+    def release(self, endpoint: str):
+        """Marks an admitted request to the endpoint as no longer in flight."""
+
+        with self._lock:
+            self._stats[endpoint].in_flight -= 1
+
+    @contextlib.contextmanager
+    def idle(self, endpoint: str):
+        """Context manager, an admitted request is not in flight while in this context.
+
+        This is for waiting on something other than the database, such as a long-polling
+        request waiting for changes.
+        """
+
+        self.release(endpoint)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._stats[endpoint].in_flight += 1
+
+    @contextlib.contextmanager
+    def database_work(self, endpoint: str):
+        """Context manager, tracks the database work of an admitted request.
+
+        The duration of the context is used as latency measurement.
+        """
+
+        from flask import current_app
+
+        window = current_app.config['FLAMENCO_ADMISSION_LATENCY_WINDOW'].total_seconds()
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            end = time.monotonic()
+            with self._lock:
+                stats = self._stats[endpoint]
+                duration = end - start
+                if stats.measured_at and end - stats.measured_at <= window:
+                    stats.latency += LATENCY_SMOOTHING * (duration - stats.latency)
+                else:
+                    stats.latency = duration
+                stats.measured_at = end
+
+    def counters(self) -> typing.Dict[str, dict]:
+        """Returns the admission counters and current state per endpoint."""
+
+        with self._lock:
+            return {endpoint: {
+                'in_flight': stats.in_flight,
+                'latency': stats.latency,
+                'admitted': stats.admitted,
+                'admitted_priority': stats.admitted_priority,
+                'rejected': {str(status): count for status, count in stats.rejected.items()},
+            } for endpoint, stats in self._stats.items()}
+
+
+def _retry_after(seconds: float) -> int:
+    return min(max(1, math.ceil(seconds)), MAX_RETRY_AFTER)
@@ -1,10 +1,13 @@
 import logging
+import typing
 
-from flask import Blueprint, request
+from flask import Blueprint, g, request
 import werkzeug.exceptions as wz_exceptions
 
 from pillar.api.utils import authorization, authentication, utcnow, random_etag
 
+from . import payload
+
 api_blueprint = Blueprint('flamenco.managers.api', __name__)
 log = logging.getLogger(__name__)
 
@@ -19,28 +22,77 @@ DEPSGRAPH_MODIFIED_SINCE_TASK_STATUSES = ['queued', 'claimed-by-manager']
 
 
 def manager_api_call(wrapped):
-    """Decorator, performs some standard stuff for Manager API endpoints."""
+    """Decorator, performs some standard stuff for Manager API endpoints.
+
+    Requests are subject to admission control, see flamenco.managers.admission.
+    The endpoint name used for admission control is the name of the wrapped function.
+    Admitted requests are in flight until the request context is torn down, which
+    for streamed responses is after the response has been sent.
+    """
     import functools
 
     @authorization.require_login(require_roles={'service', 'flamenco_manager'}, require_all=True)
     @functools.wraps(wrapped)
     def wrapper(manager_id, *args, **kwargs):
         from flamenco import current_flamenco
-        from pillar.api.utils import str2id, mongo
+        from pillar.api.utils import str2id
+
+        request_payload = payload.request_payload()
+        endpoint = wrapped.__name__
+        rejection = current_flamenco.admission.admit(
+            endpoint, priority=is_priority_request(endpoint, request_payload))
+        if rejection is not None:
+            return rejection_response(rejection)
+        g.flamenco_admitted_endpoint = endpoint
 
         manager_id = str2id(manager_id)
-        manager = mongo.find_one_or_404('flamenco_managers', manager_id)
+        manager = current_flamenco.manager_manager.api_info(manager_id)
+        if manager is None:
+            raise wz_exceptions.NotFound()
         if not current_flamenco.manager_manager.user_manages(mngr_doc=manager):
             user_id = authentication.current_user_id()
             log.warning('Service account %s sent startup notification for manager %s of another '
                         'service account', user_id, manager_id)
             raise wz_exceptions.Unauthorized()
 
-        return wrapped(manager_id, request.json, *args, **kwargs)
+        # Store for later use, so that we don't have to fetch the Manager again.
+        # This only contains the fields of managers.API_INFO_PROJECTION.
+        g.flamenco_manager = manager
+
+        return wrapped(manager_id, request_payload, *args, **kwargs)
 
     return wrapper
 
 
+def is_priority_request(endpoint: str, request_payload) -> bool:
+    """Returns True iff the request should get priority in admission control.
+
+    Task updates that change task statuses have priority over progress-only updates,
+    as the former influence the Manager's scheduling and the jobs' statuses.
+    """
+
+    if endpoint == 'startup':
+        return True
+    if endpoint != 'task_update_batch':
+        return False
+    if payload.request_is_ndjson():
+        # The stream cannot be inspected without consuming it.
+        return True
+    return any(task_update.get('task_status') for task_update in request_payload or [])
+
+
+def rejection_response(rejection):
+    """Returns the response for a request that was not admitted."""
+
+    from pillar.api.utils import jsonify
+
+    resp = jsonify({'_status': 'ERR',
+                    '_error': {'code': rejection.status, 'message': rejection.message}},
+                   status=rejection.status)
+    resp.headers['Retry-After'] = str(rejection.retry_after)
+    return resp
+
+
 @api_blueprint.route('/<manager_id>/startup', methods=['POST'])
 @manager_api_call
 def startup(manager_id, notification):
@@ -76,23 +128,70 @@ def startup(manager_id, notification):
 @api_blueprint.route('/<manager_id>/task-update-batch', methods=['POST'])
 @manager_api_call
 def task_update_batch(manager_id, task_updates):
+    """Handles a batch of task updates.
+
+    The batch is either a JSON or MessagePack array of task updates, or an
+    application/x-ndjson stream with one task update per line. The latter is
+    handled as it comes in. The response is MessagePack when the Manager
+    prefers that in its Accept header, and JSON otherwise.
+    """
+    from flask import Response
     from pillar.api.utils import jsonify
+    from flamenco import current_flamenco
+    from . import msgpack_encoding
+
+    if payload.request_is_ndjson():
+        task_updates = payload.iter_request_ndjson()
 
-    total_modif_count, handled_update_ids = handle_task_update_batch(manager_id, task_updates)
+    total_modif_count, handled_update_ids = handle_task_update_stream(
+        manager_id, task_updates)
 
     # Check which tasks are in state 'cancel-requested', as those need to be sent back.
     # This MUST be done after we run the task update batch, as just-changed task statuses
     # should be taken into account.
-    tasks_to_cancel = tasks_cancel_requested(manager_id)
+    with current_flamenco.admission.database_work('task_update_batch'):
+        tasks_to_cancel = tasks_cancel_requested(manager_id)
 
     response = {'modified_count': total_modif_count,
                 'handled_update_ids': handled_update_ids}
     if tasks_to_cancel:
         response['cancel_task_ids'] = list(tasks_to_cancel)
 
+    if payload.response_is_msgpack():
+        return Response(msgpack_encoding.packb(response), mimetype=msgpack_encoding.MIMETYPE)
     return jsonify(response)
 
 
+def handle_task_update_stream(manager_id, task_updates):
+    """Performs task updates in sub-batches of bounded size.
+
+    Only handling the sub-batches is measured as database work for admission control,
+    and not reading them from a streamed request.
+
+    :param task_updates: iterable of task updates; it is consumed one sub-batch at a time.
+    :returns: tuple (total nr of modified tasks, handled update IDs)
+    """
+
+    from flask import current_app
+    from flamenco import current_flamenco
+    from flamenco.utils import chunked
+
+    if not task_updates:
+        return 0, []
+
+    sub_batch_size = current_app.config['FLAMENCO_TASK_UPDATE_SUB_BATCH_SIZE']
+    total_modif_count = 0
+    handled_update_ids = []
+
+    for sub_batch in chunked(task_updates, sub_batch_size):
+        with current_flamenco.admission.database_work('task_update_batch'):
+            modif_count, handled_ids = handle_task_update_batch(manager_id, sub_batch)
+        total_modif_count += modif_count
+        handled_update_ids.extend(handled_ids)
+
+    return total_modif_count, handled_update_ids
+
+
 def handle_task_update_batch(manager_id, task_updates):
     """Performs task updates.
 
@@ -100,13 +199,23 @@ def handle_task_update_batch(manager_id, task_updates):
     task ID is contained in 'tasks_to_cancel'; in that case only a transition to either
     'canceled', 'completed' or 'failed' is accepted.
 
+    All tasks referenced by the batch are fetched with a single query, and all task
+    modifications and log entries are written with one bulk write per collection.
+    Multiple updates for the same task are merged, in the order they were received.
+
+    Updates that were handled before (because the Manager never received our
+    acknowledgement and resent them) are acknowledged without handling them again.
+
     :returns: tuple (total nr of modified tasks, handled update IDs)
     """
 
     if not task_updates:
         return 0, []
 
+    import collections
+
     import dateutil.parser
+    from pymongo import ReplaceOne, UpdateOne
     from pillar.api.utils import str2id
 
     from flamenco import current_flamenco, eve_settings
@@ -118,14 +227,40 @@ def handle_task_update_batch(manager_id, task_updates):
 
     valid_statuses = set(eve_settings.tasks_schema['status']['allowed'])
     handled_update_ids = []
-    total_modif_count = 0
+
+    replayed_update_ids = find_handled_update_ids(
+        manager_id, [str2id(task_update['_id']) for task_update in task_updates])
+    if replayed_update_ids:
+        log.info('Manager %s resent %i already handled task updates, acknowledging them again',
+                 manager_id, len(replayed_update_ids))
+
+    # Fetch all tasks referenced by this batch in one go.
+    task_ids = list({str2id(task_update['task_id']) for task_update in task_updates
+                     if str2id(task_update['_id']) not in replayed_update_ids})
+    task_infos = {}
+    if task_ids:
+        task_infos = {
+            task_info['_id']: task_info
+            for task_info in tasks_coll.find({'_id': {'$in': task_ids}},
+                                             projection={'manager': 1, 'status': 1, 'job': 1})
+        }
+    original_statuses = {task_id: task_info['status']
+                         for task_id, task_info in task_infos.items()}
+
+    # Mapping from task ID to the fields to $set on that task.
+    task_sets = collections.OrderedDict()
+    log_writes = []
+    status_changes = []  # list of (job ID, task ID, new task status) tuples
 
     for task_update in task_updates:
         # Check that this task actually belongs to this manager, before we accept any updates.
         update_id = str2id(task_update['_id'])
+        if update_id in replayed_update_ids:
+            handled_update_ids.append(update_id)
+            continue
+
         task_id = str2id(task_update['task_id'])
-        task_info = tasks_coll.find_one({'_id': task_id},
-                                        projection={'manager': 1, 'status': 1, 'job': 1})
+        task_info = task_infos.get(task_id)
 
         # For now, we just ignore updates to non-existing tasks. Someone might have just deleted
         # one, for example. This is not a reason to reject the entire batch.
@@ -140,14 +275,22 @@ def handle_task_update_batch(manager_id, task_updates):
                         manager_id, task_id, task_info['manager'])
             continue
 
-        if task_update.get('received_on_manager'):
-            received_on_manager = dateutil.parser.parse(task_update['received_on_manager'])
-        else:
+        # MessagePack payloads contain actual timestamps, JSON payloads contain strings.
+        received_on_manager = task_update.get('received_on_manager')
+        if isinstance(received_on_manager, str) and received_on_manager:
+            received_on_manager = dateutil.parser.parse(received_on_manager)
+        elif not received_on_manager:
             # Fake a 'received on manager' field; it really should have been in the JSON payload.
             received_on_manager = utcnow()
 
         # Store the log for this task, allowing for duplicate log reports.
         task_log = task_update.get('log')
+        if not task_log and task_update.get('gz_log'):
+            try:
+                task_log = payload.decode_gz_log(task_update['gz_log'])
+            except ValueError as ex:
+                log.warning('Manager %s sent undecodable compressed log for task %s: %s',
+                            manager_id, task_id, ex)
         if task_log:
             log_doc = {
                 '_id': update_id,
@@ -155,7 +298,7 @@ def handle_task_update_batch(manager_id, task_updates):
                 'received_on_manager': received_on_manager,
                 'log': task_log
             }
-            logs_coll.replace_one({'_id': update_id}, log_doc, upsert=True)
+            log_writes.append(ReplaceOne({'_id': update_id}, log_doc, upsert=True))
 
         # Modify the task, and append the log to the logs collection.
         updates = {
@@ -170,6 +313,9 @@ def handle_task_update_batch(manager_id, task_updates):
                                                task_update.get('task_status'), valid_statuses)
         if new_status:
             updates['status'] = new_status
+            # Subsequent updates of the same task in this batch should see the new status.
+            task_info['status'] = new_status
+            status_changes.append((task_info['job'], task_id, new_status))
 
         new_activity = task_update.get('activity')
         if new_activity:
@@ -178,19 +324,170 @@ def handle_task_update_batch(manager_id, task_updates):
         if worker:
             updates['worker'] = worker
 
-        result = tasks_coll.update_one({'_id': task_id}, {'$set': updates})
-        total_modif_count += result.modified_count
-
+        task_sets.setdefault(task_id, {}).update(updates)
         handled_update_ids.append(update_id)
 
-        # Update the task's job after updating the task itself.
-        if new_status:
-            current_flamenco.job_manager.update_job_after_task_status_change(
-                task_info['job'], task_id, new_status)
+    if log_writes:
+        logs_coll.bulk_write(log_writes, ordered=False)
+
+    total_modif_count = 0
+    task_writes = []
+    conflicting_task_ids = []
+    for task_id, updates in task_sets.items():
+        if 'status' not in updates:
+            task_writes.append(UpdateOne({'_id': task_id}, {'$set': updates}))
+            continue
+        # Status changes are compare-and-set operations on the status the task had when
+        # we fetched it, so that concurrent status changes are never overwritten. They
+        # are written one by one, so that we know which ones lost the race.
+        result = tasks_coll.update_one({'_id': task_id, 'status': original_statuses[task_id]},
+                                       {'$set': updates})
+        if result.matched_count:
+            total_modif_count += result.modified_count
+        else:
+            conflicting_task_ids.append(task_id)
+    if task_writes:
+        total_modif_count += tasks_coll.bulk_write(task_writes, ordered=False).modified_count
+    if conflicting_task_ids:
+        total_modif_count += retry_conflicting_task_updates(
+            manager_id, conflicting_task_ids, task_sets, task_infos, original_statuses,
+            status_changes, valid_statuses)
+
+    # Keep the per-job task status counts in sync.
+    status_count_deltas = collections.defaultdict(lambda: collections.defaultdict(int))
+    for task_id, task_info in task_infos.items():
+        old_status = original_statuses[task_id]
+        if task_info['status'] == old_status:
+            continue
+        status_count_deltas[task_info['job']][old_status] -= 1
+        status_count_deltas[task_info['job']][task_info['status']] += 1
+    current_flamenco.job_manager.api_inc_task_status_counts(status_count_deltas)
+
+    # Keep the Manager's set of cancel-requested tasks in sync.
+    cancel_requested_added = [task_id for task_id, task_info in task_infos.items()
+                              if task_info['status'] == 'cancel-requested'
+                              and original_statuses[task_id] != 'cancel-requested']
+    cancel_requested_removed = [task_id for task_id, task_info in task_infos.items()
+                                if task_info['status'] != 'cancel-requested'
+                                and original_statuses[task_id] == 'cancel-requested']
+    current_flamenco.manager_manager.api_update_cancel_requested(
+        {manager_id: cancel_requested_added}, {manager_id: cancel_requested_removed})
+    if status_count_deltas:
+        current_flamenco.manager_manager.api_bump_depsgraph_generation([manager_id])
+
+    # Update the tasks' jobs after updating the tasks themselves. This is done once per job,
+    # rather than once per task update.
+    current_flamenco.job_manager.update_jobs_after_task_status_changes(status_changes)
+
+    remember_handled_update_ids(
+        manager_id, [uid for uid in handled_update_ids if uid not in replayed_update_ids])
 
     return total_modif_count, handled_update_ids
 
 
+def retry_conflicting_task_updates(manager_id, conflicting_task_ids, task_sets, task_infos,
+                                   original_statuses, status_changes, valid_statuses) -> int:
+    """Re-applies task updates whose status change lost the race with another status change.
+
+    The new status is determined again from the current status of the task. The
+    task_infos, original_statuses and status_changes are modified to reflect what
+    was actually written, so that the bookkeeping of the caller stays correct.
+
+    :returns: the nr of modified tasks.
+    """
+
+    from flamenco import current_flamenco
+
+    tasks_coll = current_flamenco.db('tasks')
+    current_tasks = {task['_id']: task
+                     for task in tasks_coll.find({'_id': {'$in': conflicting_task_ids}},
+                                                 projection={'status': 1})}
+
+    modif_count = 0
+    for task_id in conflicting_task_ids:
+        updates = task_sets[task_id]
+        task_info = task_infos[task_id]
+        status_changes[:] = [change for change in status_changes if change[1] != task_id]
+
+        current_task = current_tasks.get(task_id)
+        if current_task is None:
+            log.info('Task %s was deleted while handling an update from manager %s',
+                     task_id, manager_id)
+            task_info['status'] = original_statuses[task_id]
+            continue
+
+        current_status = current_task['status']
+        log.info('Task %s changed status from %s to %s while handling an update from '
+                 'manager %s', task_id, original_statuses[task_id], current_status, manager_id)
+        original_statuses[task_id] = task_info['status'] = current_status
+
+        query = {'_id': task_id}
+        new_status = determine_new_task_status(manager_id, task_id, task_info,
+                                               updates.pop('status'), valid_statuses)
+        if new_status:
+            query['status'] = current_status
+            updates['status'] = new_status
+
+        result = tasks_coll.update_one(query, {'$set': updates})
+        if not result.matched_count:
+            log.warning('Update of task %s from manager %s lost the race with other status '
+                        'changes twice; ignoring it', task_id, manager_id)
+            continue
+        modif_count += result.modified_count
+        if new_status:
+            task_info['status'] = new_status
+            status_changes.append((task_info['job'], task_id, new_status))
+
+    return modif_count
+
+
+def find_handled_update_ids(manager_id, update_ids) -> set:
+    """Returns those task update IDs that were already handled for this Manager."""
+
+    from flamenco import current_flamenco
+
+    if not update_ids:
+        return set()
+
+    update_ids_coll = current_flamenco.db('task_update_ids')
+    found = update_ids_coll.find({'manager': manager_id, '_id': {'$in': update_ids}},
+                                 projection={'_id': 1})
+    return {doc['_id'] for doc in found}
+
+
+def remember_handled_update_ids(manager_id, update_ids):
+    """Stores task update IDs, so that replays of those updates can be recognised.
+
+    The IDs are forgotten after FLAMENCO_TASK_UPDATE_ID_RETENTION.
+    """
+
+    from flask import current_app
+    from pymongo.errors import BulkWriteError
+    from flamenco import current_flamenco
+
+    if not update_ids:
+        return
+
+    now = utcnow()
+    remove_after = now + current_app.config['FLAMENCO_TASK_UPDATE_ID_RETENTION']
+    docs = [{'_id': update_id,
+             'manager': manager_id,
+             'handled': now,
+             'remove_after': remove_after}
+            for update_id in set(update_ids)]
+
+    update_ids_coll = current_flamenco.db('task_update_ids')
+    try:
+        update_ids_coll.insert_many(docs, ordered=False)
+    except BulkWriteError as ex:
+        # Duplicate keys are fine; a concurrent request handled the same update.
+        non_dupes = [err for err in ex.details.get('writeErrors', [])
+                     if err.get('code') != 11000]
+        if non_dupes:
+            log.error('Unable to store handled task update IDs of manager %s: %s',
+                      manager_id, non_dupes)
+
+
 def determine_new_task_status(manager_id, task_id, current_task_info, new_status, valid_statuses):
     """Returns the new task status, or None if the task should not get a new status."""
 
@@ -220,17 +517,17 @@ def determine_new_task_status(manager_id, task_id, current_task_info, new_status
 
 
 def tasks_cancel_requested(manager_id):
-    """Returns a set of tasks of status cancel-requested."""
+    """Returns a set of tasks of status cancel-requested.
 
-    from flamenco import current_flamenco, eve_settings
+    Uses the version of the set from the Manager document fetched by manager_api_call,
+    so that an unchanged set can be returned without querying the database.
+    """
 
-    tasks_coll = current_flamenco.db('tasks')
+    from flamenco import current_flamenco
 
-    task_ids = {
-        task['_id']
-        for task in tasks_coll.find({'manager': manager_id, 'status': 'cancel-requested'},
-                                    projection={'_id': 1})
-        }
+    manager = g.get('flamenco_manager') or {}
+    known_version = manager.get('cancel_requested_version', 0)
+    task_ids = current_flamenco.manager_manager.cancel_requested_tasks(manager_id, known_version)
 
     log.debug('Returning %i tasks to be canceled by manager %s', len(task_ids), manager_id)
     return task_ids
@@ -243,38 +540,149 @@ def get_depsgraph(manager_id, request_json):
 
     Use the HTTP header X-Flamenco-If-Updated-Since to limit the dependency
     graph to tasks that have been modified since that timestamp.
+
+    The tasks are streamed from the database in batches of FLAMENCO_DEPSGRAPH_BATCH_SIZE,
+    and queued tasks are claimed per batch. JSON responses are streamed to the Manager
+    as they are produced.
+
+    Use the 'max_tasks' query parameter or the X-Flamenco-Max-Tasks header to only
+    get (and claim) the highest-priority tasks, ordered by job priority, task priority
+    and ID. When there may be more tasks, the response has an X-Flamenco-Next-Page-After
+    header; send its value in the X-Flamenco-Page-After header to get the next page.
+    In this case X-Flamenco-Last-Updated only reflects the tasks on the returned page.
+
+    Managers that send an X-Flamenco-Command-Blocks header get the commands of tasks
+    as references to content-addressed command blocks, see depsgraph.CommandBlocks.
+    The header value is a comma-separated list of the block hashes the Manager already
+    has; those blocks are not sent again.
+
+    Tasks that refer to their job's command templates get expanded commands, see
+    depsgraph.expand_templates().
+
+    Managers that prefer application/msgpack in their Accept header get a MessagePack
+    response, see msgpack_encoding.
+
+    Managers that send an X-Flamenco-Wait header along with X-Flamenco-If-Updated-Since
+    perform a long poll: when there are no modified tasks, the request waits for a
+    change for at most that many seconds (limited by FLAMENCO_DEPSGRAPH_MAX_WAIT)
+    before returning 304 Not Modified. This is not supported when limiting the number
+    of tasks.
     """
 
+    import time
+
     import dateutil.parser
-    from pillar.api.utils import jsonify, bsonify
+    from flask import Response, stream_with_context
+    from flamenco import current_flamenco
+    from . import depsgraph, msgpack_encoding
+
+    manager_manager = current_flamenco.manager_manager
+    if_updated_since = request.headers.get('X-Flamenco-If-Updated-Since')
+    modified_since = None
+    if if_updated_since is not None:
+        log.debug('Modified-since header: %s', if_updated_since)
+        modified_since = dateutil.parser.parse(if_updated_since)
+    max_tasks = depsgraph_max_tasks()
+    remember_unchanged = max_tasks is None and modified_since is not None
+    deadline = time.monotonic()
+    if remember_unchanged:
+        deadline += depsgraph_wait_timeout()
+
+    known_blocks = request.headers.get('X-Flamenco-Command-Blocks')
+    command_blocks = None
+    if known_blocks is not None:
+        command_blocks = depsgraph.CommandBlocks(
+            known={block_hash.strip() for block_hash in known_blocks.split(',')
+                   if block_hash.strip()})
+
+    # The generation must be obtained before querying the tasks; see
+    # ManagerManager.remember_unchanged_depsgraph().
+    generation = manager_manager.depsgraph_generation(
+        manager_id, mngr_doc=g.get('flamenco_manager'))
+    while True:
+        if remember_unchanged and manager_manager.depsgraph_unchanged(
+                manager_id, if_updated_since, generation):
+            remaining = deadline - time.monotonic()
+            if remaining > 0:
+                log.debug('Waiting at most %.1f seconds for depsgraph of manager %s to change',
+                          remaining, manager_id)
+                with current_flamenco.admission.idle('get_depsgraph'):
+                    generation = current_flamenco.change_notifier.wait(
+                        manager_id, generation, remaining)
+            if remaining <= 0 or generation is None:
+                log.debug('Depsgraph of manager %s unchanged', manager_id)
+                return '', 304  # Not Modified
+            continue
+
+        with current_flamenco.admission.database_work('get_depsgraph'):
+            batches, last_modification, next_page_after = query_depsgraph(
+                manager_id, modified_since, max_tasks)
+        if batches is not None:
+            batches = depsgraph.claim_batches(batches)
+            break
+
+        log.debug('Returning empty depsgraph')
+        if modified_since is None:
+            return '', 204  # empty response
+        if not remember_unchanged:
+            return '', 304  # Not Modified
+        manager_manager.remember_unchanged_depsgraph(manager_id, if_updated_since, generation)
+
+    if request.accept_mimetypes.best == 'application/bson':
+        resp = Response(depsgraph.encode_bson(batches, command_blocks),
+                        mimetype='application/bson')
+    elif payload.response_is_msgpack():
+        resp = Response(depsgraph.encode_msgpack(batches, command_blocks),
+                        mimetype=msgpack_encoding.MIMETYPE)
+    else:
+        resp = Response(stream_with_context(depsgraph.iter_json(batches, command_blocks)),
+                        mimetype='application/json')
+
+    log.debug('Last modification was %s', last_modification)
+    # We need a format that can handle sub-second precision, which is not provided by the
+    # HTTP date format (RFC 1123). This means that we can't use the Last-Modified header, as
+    # it may be incorrectly interpreted and rewritten by HaProxy, Apache or other software
+    # in the path between client & server.
+    resp.headers['X-Flamenco-Last-Updated'] = last_modification.isoformat()
+    if max_tasks is None:
+        # Nothing was modified after the last-modified task, until the generation changes.
+        manager_manager.remember_unchanged_depsgraph(
+            manager_id, resp.headers['X-Flamenco-Last-Updated'], generation)
+    resp.headers['X-Flamenco-Last-Updated-Format'] = 'ISO-8601'
+    if next_page_after:
+        resp.headers['X-Flamenco-Next-Page-After'] = next_page_after
+    return resp
+
+
+def query_depsgraph(manager_id, modified_since, max_tasks: typing.Optional[int]):
+    """Queries the tasks for the Manager's depsgraph.
+
+    :returns: tuple (batches of tasks, last modification timestamp, next page token),
+        or (None, None, None) when there are no tasks.
+    """
+
+    import itertools
+
+    import pymongo
+    from flask import current_app
     from flamenco import current_flamenco
-    from flamenco.utils import report_duration
+    from flamenco.utils import chunked, report_duration
+    from . import depsgraph
 
-    modified_since = request.headers.get('X-Flamenco-If-Updated-Since')
+    next_page_after = None
+    last_modification = None
+    batches = None
 
     with report_duration(log, 'depsgraph query'):
         tasks_coll = current_flamenco.db('tasks')
-        jobs_coll = current_flamenco.db('jobs')
 
-        # Get runnable jobs first, as non-runnable jobs are not interesting.
-        # Note that jobs going from runnable to non-runnable should have their
-        # tasks set to cancel-requested, which is communicated to the Manager
-        # through a different channel.
-        jobs = jobs_coll.find({
-            'manager': manager_id,
-            'status': {'$in': DEPSGRAPH_RUNNABLE_JOB_STATUSES}},
-            projection={'_id': 1},
-        )
-        job_ids = [job['_id'] for job in jobs]
-        if not job_ids:
-            log.debug('Returning empty depsgraph')
-            return '', 204  # empty response
-
-        log.debug('Requiring jobs to be in %s', job_ids)
+        # Only tasks of runnable jobs are interesting; the tasks' 'job_runnable' field
+        # reflects their job's status. Note that jobs going from runnable to non-runnable
+        # should have their tasks set to cancel-requested, which is communicated to the
+        # Manager through a different channel.
         task_query = {
             'manager': manager_id,
-            'status': {'$nin': ['active']},
-            'job': {'$in': job_ids},
+            'job_runnable': True,
         }
 
         if modified_since is None:
@@ -282,52 +690,99 @@ def get_depsgraph(manager_id, request_json):
             task_query['status'] = {'$in': DEPSGRAPH_CLEAN_SLATE_TASK_STATUSES}
         else:
             # Not clean slate, just give all updated tasks assigned to this manager.
-            log.debug('Modified-since header: %s', modified_since)
-            modified_since = dateutil.parser.parse(modified_since)
             task_query['_updated'] = {'$gt': modified_since}
             task_query['status'] = {'$in': DEPSGRAPH_MODIFIED_SINCE_TASK_STATUSES}
             log.debug('Querying all tasks changed since %s', modified_since)
 
-        cursor = tasks_coll.find(task_query)
-        depsgraph = list(cursor)
+        if max_tasks is None:
+            # Sorting on _updated means that the first task is the last-modified one.
+            batch_size = current_app.config['FLAMENCO_DEPSGRAPH_BATCH_SIZE']
+            cursor = tasks_coll.find(task_query) \
+                .sort('_updated', pymongo.DESCENDING) \
+                .batch_size(batch_size)
+            all_batches = chunked(cursor, batch_size)
+            first_batch = next(all_batches, None)
+            if first_batch:
+                last_modification = first_batch[0]['_updated']
+                batches = itertools.chain([first_batch], all_batches)
+        else:
+            page_after = request.headers.get('X-Flamenco-Page-After')
+            if page_after:
+                try:
+                    page_query = depsgraph.page_after_query(page_after)
+                except ValueError as ex:
+                    raise wz_exceptions.BadRequest(str(ex))
+                task_query = {'$and': [task_query, page_query]}
+
+            # The page is bounded in size, so it can be handled as one batch.
+            first_batch = list(tasks_coll.find(task_query)
+                               .sort(depsgraph.PRIORITY_SORT)
+                               .limit(max_tasks))
+            if first_batch:
+                last_modification = max(task['_updated'] for task in first_batch)
+                batches = [first_batch]
+            if len(first_batch) == max_tasks:
+                next_page_after = depsgraph.page_token(first_batch[-1])
+
+    if batches is not None:
+        batches = depsgraph.expand_templates(batches)
+    return batches, last_modification, next_page_after
+
+
+@api_blueprint.route('/admission-counters')
+@authorization.require_login(require_cap='flamenco-admin')
+def admission_counters():
+    """Returns the admission control counters of this web process, per endpoint."""
 
-    if len(depsgraph) == 0:
-        log.debug('Returning empty depsgraph')
-        if modified_since is not None:
-            return '', 304  # Not Modified
-    else:
-        log.info('Returning depsgraph of %i tasks', len(depsgraph))
-
-    # Update the task status in the database to move queued tasks to claimed-by-manager.
-    task_query['status'] = 'queued'
-    tasks_coll.update_many(task_query,
-                           {'$set': {'status': 'claimed-by-manager'}})
-
-    # Update the returned task statuses. Unfortunately Mongo doesn't support
-    # find_and_modify() on multiple documents.
-    for task in depsgraph:
-        if task['status'] == 'queued':
-            task['status'] = 'claimed-by-manager'
-
-    # Must be a dict to convert to BSON.
-    respdoc = {
-        'depsgraph': depsgraph,
-    }
-    if request.accept_mimetypes.best == 'application/bson':
-        resp = bsonify(respdoc)
-    else:
-        resp = jsonify(respdoc)
-
-    if depsgraph:
-        last_modification = max(task['_updated'] for task in depsgraph)
-        log.debug('Last modification was %s', last_modification)
-        # We need a format that can handle sub-second precision, which is not provided by the
-        # HTTP date format (RFC 1123). This means that we can't use the Last-Modified header, as
-        # it may be incorrectly interpreted and rewritten by HaProxy, Apache or other software
-        # in the path between client & server.
-        resp.headers['X-Flamenco-Last-Updated'] = last_modification.isoformat()
-        resp.headers['X-Flamenco-Last-Updated-Format'] = 'ISO-8601'
-    return resp
+    from pillar.api.utils import jsonify
+    from flamenco import current_flamenco
+
+    return jsonify(current_flamenco.admission.counters())
+
+
+def depsgraph_max_tasks() -> typing.Optional[int]:
+    """Returns the maximum nr of tasks the Manager wants in the depsgraph, or None."""
+
+    max_tasks = request.args.get('max_tasks') or request.headers.get('X-Flamenco-Max-Tasks')
+    if not max_tasks:
+        return None
+
+    try:
+        max_tasks = int(max_tasks)
+    except ValueError:
+        max_tasks = 0
+    if max_tasks < 1:
+        raise wz_exceptions.BadRequest('max_tasks should be a positive integer')
+    return max_tasks
+
+
+def depsgraph_wait_timeout() -> float:
+    """Returns the nr of seconds the Manager wants to wait for depsgraph changes."""
+
+    from flask import current_app
+
+    wait = request.headers.get('X-Flamenco-Wait')
+    if not wait:
+        return 0.0
+
+    try:
+        wait = float(wait)
+    except ValueError:
+        wait = -1.0
+    if wait < 0:
+        raise wz_exceptions.BadRequest('X-Flamenco-Wait should be a non-negative number')
+    max_wait = current_app.config['FLAMENCO_DEPSGRAPH_MAX_WAIT'].total_seconds()
+    return min(wait, max_wait)
+
+
+@api_blueprint.teardown_request
+def release_admission(exception):
+    """Ends the admission of the request, see manager_api_call()."""
+    from flamenco import current_flamenco
+
+    endpoint = g.pop('flamenco_admitted_endpoint', None)
+    if endpoint is not None:
+        current_flamenco.admission.release(endpoint)
 
 
 def setup_app(app):
@@ -0,0 +1,309 @@
+"""Claiming and encoding of the dependency graph sent to Managers.
+
+The depsgraph can contain many thousands of tasks, so it is handled in batches
+straight from the MongoDB cursor, rather than as one big list.
+"""
+
+import collections
+import logging
+import struct
+import typing
+
+import attr
+import bson
+import pymongo
+
+log = logging.getLogger(__name__)
+
+BSON_TYPE_DOCUMENT = b'\x03'
+BSON_TYPE_ARRAY = b'\x04'
+
+# Order in which tasks are handed out when the Manager limits the number of tasks.
+PRIORITY_SORT = [
+    ('job_priority', pymongo.DESCENDING),
+    ('priority', pymongo.DESCENDING),
+    ('_id', pymongo.ASCENDING),
+]
+
+
+def page_token(task: dict) -> str:
+    """Returns the token for the page of tasks after the given task, in PRIORITY_SORT order."""
+    return '%d:%d:%s' % (task['job_priority'], task['priority'], task['_id'])
+
+
+def page_after_query(token: str) -> dict:
+    """Returns the query for the tasks after the token's task, in PRIORITY_SORT order.
+
+    :raises ValueError: when the token is invalid.
+    """
+
+    try:
+        job_priority, priority, task_id = token.split(':')
+        job_priority = int(job_priority)
+        priority = int(priority)
+        task_id = bson.ObjectId(task_id)
+    except (ValueError, bson.errors.InvalidId):
+        raise ValueError('Invalid page token %r' % token)
+
+    return {'$or': [
+        {'job_priority': {'$lt': job_priority}},
+        {'job_priority': job_priority, 'priority': {'$lt': priority}},
+        {'job_priority': job_priority, 'priority': priority, '_id': {'$gt': task_id}},
+    ]}
+
+
+@attr.s
+class CommandBlocks:
+    """Content-addressed command blocks, for sending shared command settings only once.
+
+    Every command of a task is split into a block, containing the command name and
+    the settings that are not per-task, and the per-task settings. Blocks are
+    identified by a hash of their content. Tasks refer to their blocks by hash,
+    and blocks the Manager already knows are not sent again.
+    """
+
+    # Hashes of the blocks the Manager already has.
+    known = attr.ib(default=attr.Factory(set))
+    # Blocks to send to the Manager, as {hash: block}.
+    new_blocks = attr.ib(default=attr.Factory(dict))
+
+    @staticmethod
+    def block_hash(block: dict) -> str:
+        from flamenco.job_compilers.commands import template_key
+
+        return template_key(block)
+
+    def compress_command(self, command: dict) -> dict:
+        """Returns {'block': block hash, 'settings': per-task settings}."""
+
+        from flamenco.job_compilers.commands import per_task_settings
+
+        name = command['name']
+        settings = command.get('settings') or {}
+        per_task = per_task_settings(name)
+
+        block = {
+            'name': name,
+            'settings': {key: value for key, value in settings.items()
+                         if key not in per_task},
+        }
+        block_hash = self.block_hash(block)
+        if block_hash not in self.known:
+            self.known.add(block_hash)
+            self.new_blocks[block_hash] = block
+
+        return {
+            'block': block_hash,
+            'settings': {key: value for key, value in settings.items()
+                         if key in per_task},
+        }
+
+    def compress_task(self, task: dict) -> dict:
+        """Returns a copy of the task, with its commands referring to command blocks."""
+
+        compressed = task.copy()
+        compressed['commands'] = [self.compress_command(cmd)
+                                  for cmd in task.get('commands', [])]
+        return compressed
+
+
+def claim_queued_tasks(tasks: typing.List[dict]):
+    """Claims the queued tasks for their Manager.
+
+    Sets the status of the queued tasks to 'claimed-by-manager', both in the
+    database and in the given task documents.
+    """
+
+    from flamenco import current_flamenco
+
+    queued = [task for task in tasks if task['status'] == 'queued']
+    if not queued:
+        return
+
+    tasks_coll = current_flamenco.db('tasks')
+    result = tasks_coll.update_many(
+        {'_id': {'$in': [task['_id'] for task in queued]}, 'status': 'queued'},
+        {'$set': {'status': 'claimed-by-manager'}})
+
+    job_manager = current_flamenco.job_manager
+    if result.modified_count == len(queued):
+        deltas = collections.defaultdict(lambda: collections.defaultdict(int))
+        for task in queued:
+            deltas[task['job']]['queued'] -= 1
+            deltas[task['job']]['claimed-by-manager'] += 1
+        job_manager.api_inc_task_status_counts(deltas)
+    else:
+        # Some tasks changed status after we fetched them, so we don't know
+        # exactly which tasks were claimed.
+        log.info('Claimed %i of %i queued tasks, recounting task statuses of their jobs',
+                 result.modified_count, len(queued))
+        job_manager.api_recount_task_statuses(list({task['job'] for task in queued}))
+
+    for task in queued:
+        task['status'] = 'claimed-by-manager'
+
+
+@attr.s
+class CommandTemplates:
+    """Loads the command templates of jobs, to expand the commands of their tasks.
+
+    Templates are loaded per job, and only once per instance, unless a task refers
+    to a template that was stored after the job's templates were loaded.
+    """
+
+    # Mapping {job ID: {template key: command template}}
+    _templates = attr.ib(default=attr.Factory(dict), init=False, repr=False)
+
+    def expand_batch(self, batch: typing.List[dict]) -> typing.List[dict]:
+        """Returns the batch of tasks, with their templated commands expanded."""
+
+        from flamenco.job_compilers.commands import expand_task, uses_templates
+
+        templated = [task for task in batch if uses_templates(task)]
+        if not templated:
+            return batch
+
+        self._load({task['job'] for task in templated if task['job'] not in self._templates})
+
+        missing = {task['job'] for task in templated
+                   if any(cmd['template'] not in self._templates[task['job']]
+                          for cmd in task['commands'] if 'template' in cmd)}
+        if missing:
+            self._load(missing)
+
+        return [expand_task(task, self._templates.get(task['job'], {})) for task in batch]
+
+    def _load(self, job_ids: typing.Set[bson.ObjectId]):
+        from flamenco import current_flamenco
+
+        if not job_ids:
+            return
+
+        jobs_coll = current_flamenco.db('jobs')
+        for job in jobs_coll.find({'_id': {'$in': list(job_ids)}},
+                                  projection={'command_templates': 1}):
+            self._templates[job['_id']] = job.get('command_templates') or {}
+
+
+def expand_templates(batches: typing.Iterable[typing.List[dict]]) \
+        -> typing.Iterator[typing.List[dict]]:
+    """Generator, yields the batches with the templated commands of their tasks expanded.
+
+    The task documents in the database only refer to their job's command templates,
+    whereas Managers expect complete commands.
+    """
+
+    command_templates = CommandTemplates()
+    for batch in batches:
+        yield command_templates.expand_batch(batch)
+
+
+def claim_batches(batches: typing.Iterable[typing.List[dict]]) \
+        -> typing.Iterator[typing.List[dict]]:
+    """Generator, yields the batches after claiming their queued tasks.
+
+    Fetching a batch from the database and claiming its tasks is measured as database
+    work for admission control, see flamenco.managers.admission. Encoding the batch
+    and sending it to the Manager happens outside of that.
+    """
+
+    from flamenco import current_flamenco
+
+    batches = iter(batches)
+    while True:
+        with current_flamenco.admission.database_work('get_depsgraph'):
+            batch = next(batches, None)
+            if batch is not None:
+                claim_queued_tasks(batch)
+        if batch is None:
+            return
+        yield batch
+
+
+def _encodable_tasks(batch: typing.List[dict],
+                     command_blocks: typing.Optional[CommandBlocks]) -> typing.Iterable[dict]:
+    if command_blocks is None:
+        return batch
+    return (command_blocks.compress_task(task) for task in batch)
+
+
+def iter_json(batches: typing.Iterable[typing.List[dict]],
+              command_blocks: CommandBlocks = None) -> typing.Iterator[str]:
+    """Generator, yields the JSON depsgraph document in parts.
+
+    The batches should already be claimed, see claim_batches(); every batch is
+    fetched just before it is encoded. When command_blocks is given, the commands
+    refer to command blocks, which are sent at the end of the document as
+    'command_blocks'.
+    """
+
+    from pillar.api.utils import dumps
+
+    yield '{"depsgraph": ['
+    task_count = 0
+    for batch in batches:
+        separator = ', ' if task_count else ''
+        yield separator + ', '.join(dumps(task)
+                                    for task in _encodable_tasks(batch, command_blocks))
+        task_count += len(batch)
+    yield ']'
+    if command_blocks is not None:
+        yield ', "command_blocks": ' + dumps(command_blocks.new_blocks)
+    yield '}'
+
+    log.info('Returned depsgraph of %i tasks', task_count)
+
+
+def encode_bson(batches: typing.Iterable[typing.List[dict]],
+                command_blocks: CommandBlocks = None) -> bytes:
+    """Returns the BSON depsgraph document.
+
+    Every batch of tasks is encoded to BSON before the next batch is fetched,
+    so that only the encoded tasks are kept in memory.
+    See iter_json() for the meaning of command_blocks.
+    """
+
+    elements = []
+    for batch in batches:
+        for task in _encodable_tasks(batch, command_blocks):
+            key = str(len(elements)).encode('ascii')
+            elements.append(BSON_TYPE_DOCUMENT + key + b'\x00' + bson.BSON.encode(task))
+
+    log.info('Returning depsgraph of %i tasks', len(elements))
+    array = _bson_document(b''.join(elements))
+    doc_elements = BSON_TYPE_ARRAY + b'depsgraph\x00' + array
+    if command_blocks is not None:
+        doc_elements += (BSON_TYPE_DOCUMENT + b'command_blocks\x00' +
+                         bson.BSON.encode(command_blocks.new_blocks))
+    return _bson_document(doc_elements)
+
+
+def encode_msgpack(batches: typing.Iterable[typing.List[dict]],
+                   command_blocks: CommandBlocks = None) -> bytes:
+    """Returns the MessagePack depsgraph document.
+
+    Like encode_bson(), every batch is encoded before the next batch is fetched.
+    See iter_json() for the meaning of command_blocks.
+    """
+
+    from . import msgpack_encoding
+
+    packer = msgpack_encoding.packer()
+    elements = []
+    for batch in batches:
+        elements.extend(packer.pack(task) for task in _encodable_tasks(batch, command_blocks))
+
+    log.info('Returning depsgraph of %i tasks', len(elements))
+    if command_blocks is None:
+        return (packer.pack_map_header(1) +
+                packer.pack('depsgraph') + msgpack_encoding.pack_array(elements))
+    return (packer.pack_map_header(2) +
+            packer.pack('depsgraph') + msgpack_encoding.pack_array(elements) +
+            packer.pack('command_blocks') + packer.pack(command_blocks.new_blocks))
+
+
+def _bson_document(elements: bytes) -> bytes:
+    """Wraps BSON elements in a document, by adding the length prefix and terminator."""
+
+    # The length includes the 4 length bytes themselves and the terminating null byte.
+    return struct.pack('<i', len(elements) + 5) + elements + b'\x00'
@@ -49,6 +49,13 @@ def check_manager_permissions_modify(mngr_doc, original_doc=None):
     raise wz_exceptions.Forbidden()
 
 
+def forget_cached_manager(mngr_doc, original_doc=None):
+    """Ensures the Manager API does not use cached information of a modified Manager."""
+
+    manager_id = (original_doc or mngr_doc).get('_id')
+    current_flamenco.manager_manager.forget_api_info(manager_id)
+
+
 def pre_get_flamenco_managers(request, lookup):
     """Filter returned Flamenco managers."""
 
@@ -80,3 +87,6 @@ def setup_app(app):
     app.on_update_flamenco_managers += check_manager_permissions_modify
     app.on_replace_flamenco_managers += check_manager_permissions_modify
     app.on_delete_flamenco_managers += check_manager_permissions_modify
+    app.on_updated_flamenco_managers += forget_cached_manager
+    app.on_replaced_flamenco_managers += forget_cached_manager
+    app.on_deleted_item_flamenco_managers += forget_cached_manager
@@ -0,0 +1,71 @@
+"""MessagePack encoding of Manager API payloads.
+
+ObjectIds are encoded with extension type EXT_OBJECTID, as their 12 bytes.
+Datetimes are encoded with MessagePack's standard timestamp extension type;
+naive datetimes are assumed to be in UTC, and decoded datetimes are in UTC.
+
+The msgpack module is optional, see requirements-optional.txt; use available() to
+check whether it is installed. Without it, Managers get JSON responses.
+"""
+
+import datetime
+import typing
+
+import bson
+import bson.errors
+from bson import tz_util
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+MIMETYPE = 'application/msgpack'
+EXT_OBJECTID = 1
+
+
+def available() -> bool:
+    """Returns True iff the msgpack module is installed."""
+    return msgpack is not None
+
+
+def _default(obj):
+    if isinstance(obj, bson.ObjectId):
+        return msgpack.ExtType(EXT_OBJECTID, obj.binary)
+    if isinstance(obj, datetime.datetime):
+        if obj.tzinfo is None:
+            obj = obj.replace(tzinfo=tz_util.utc)
+        return msgpack.Timestamp.from_datetime(obj)
+    raise TypeError(f'Unable to encode {type(obj)} to MessagePack')
+
+
+def _ext_hook(code: int, data: bytes):
+    if code == EXT_OBJECTID:
+        return bson.ObjectId(data)
+    return msgpack.ExtType(code, data)
+
+
+def packer() -> 'msgpack.Packer':
+    """Returns a Packer that understands ObjectIds and datetimes."""
+    return msgpack.Packer(default=_default, use_bin_type=True)
+
+
+def packb(obj) -> bytes:
+    return packer().pack(obj)
+
+
+def unpackb(data: bytes):
+    """Decodes a MessagePack document.
+
+    :raises ValueError: when the data is not valid MessagePack.
+    """
+
+    try:
+        return msgpack.unpackb(data, ext_hook=_ext_hook, timestamp=3, raw=False)
+    except (ValueError, TypeError, msgpack.UnpackException, bson.errors.InvalidId) as ex:
+        raise ValueError(f'Invalid MessagePack data: {ex}')
+
+
+def pack_array(packed_items: typing.List[bytes]) -> bytes:
+    """Returns a MessagePack array of already-packed items."""
+    return packer().pack_array_header(len(packed_items)) + b''.join(packed_items)
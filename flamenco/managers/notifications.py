@@ -0,0 +1,198 @@
+"""Notification of depsgraph changes, for long-polling Managers.
+
+Changes are signalled by ManagerManager.api_bump_depsgraph_generation(). Waiting
+requests in the same process are woken up immediately. Changes made by other
+processes are only visible through the Managers' 'depsgraph_generation' field in
+MongoDB, which is polled by the MongoChangeNotifier.
+
+The MongoChangeNotifier uses one poller thread per web process, which fetches the
+generations of all Managers that have waiting requests with a single query. The
+cost of polling is thus one query per poll interval per web process, regardless
+of the nr of waiting requests.
+"""
+
+import abc
+import collections
+import logging
+import threading
+import time
+import typing
+
+import attr
+import bson
+
+log = logging.getLogger(__name__)
+
+
+@attr.s
+class AbstractChangeNotifier(metaclass=abc.ABCMeta):
+    """Wakes up requests waiting for changes of a Manager's depsgraph."""
+
+    # Mapping {manager ID: nr of notifications in this process}
+    _local_changes = attr.ib(default=attr.Factory(lambda: collections.defaultdict(int)),
+                             init=False, repr=False)
+    _condition = attr.ib(default=attr.Factory(threading.Condition), init=False, repr=False)
+
+    def notify(self, manager_ids: typing.Iterable[bson.ObjectId]):
+        """Wakes up the requests waiting for any of these Managers."""
+
+        with self._condition:
+            for manager_id in manager_ids:
+                self._local_changes[manager_id] += 1
+            self._condition.notify_all()
+
+    def _wait_local(self, manager_id: bson.ObjectId, seen_changes: int, timeout: float) -> bool:
+        """Waits for a notification in this process.
+
+        :returns: True when notified, False when the timeout expired.
+        """
+
+        with self._condition:
+            return self._condition.wait_for(
+                lambda: self._local_changes[manager_id] != seen_changes, timeout)
+
+    def _local_change_count(self, manager_id: bson.ObjectId) -> int:
+        with self._condition:
+            return self._local_changes[manager_id]
+
+    def wait(self, manager_id: bson.ObjectId, generation: int, timeout: float) \
+            -> typing.Optional[int]:
+        """Waits until the Manager's depsgraph generation differs from the given one.
+
+        :returns: the new generation, or None when the timeout expired first.
+        """
+
+        deadline = time.monotonic() + timeout
+        seen_changes = self._local_change_count(manager_id)
+
+        while True:
+            current = fetch_generation(manager_id)
+            if current != generation:
+                return current
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            if not self._wait_for_change(manager_id, generation, seen_changes, remaining):
+                return None
+            seen_changes = self._local_change_count(manager_id)
+
+    @abc.abstractmethod
+    def _wait_for_change(self, manager_id: bson.ObjectId, generation: int,
+                         seen_changes: int, timeout: float) -> bool:
+        """Waits until the Manager's depsgraph may have changed.
+
+        :returns: True when it may have changed, False when the timeout expired.
+        """
+
+
+class LocalChangeNotifier(AbstractChangeNotifier):
+    """Only sees changes made in this process.
+
+    This is only correct when there is a single web process, such as when testing.
+    """
+
+    def _wait_for_change(self, manager_id: bson.ObjectId, generation: int,
+                         seen_changes: int, timeout: float) -> bool:
+        return self._wait_local(manager_id, seen_changes, timeout)
+
+
+@attr.s
+class MongoChangeNotifier(AbstractChangeNotifier):
+    """Sees changes made in this process immediately, and in other processes by polling."""
+
+    poll_interval = attr.ib(default=1.0, validator=attr.validators.instance_of(float))
+
+    # Mapping {manager ID: nr of waiting requests}
+    _waiting = attr.ib(default=attr.Factory(collections.Counter), init=False, repr=False)
+    # Mapping {manager ID: generation}, as last fetched by the poller thread.
+    _polled = attr.ib(default=attr.Factory(dict), init=False, repr=False)
+    _poller = attr.ib(default=None, init=False, repr=False)
+
+    def _wait_for_change(self, manager_id: bson.ObjectId, generation: int,
+                         seen_changes: int, timeout: float) -> bool:
+        from flask import current_app
+
+        # Generations only increase, so an older poll result is never mistaken for a change.
+        def changed():
+            return (self._local_changes[manager_id] != seen_changes or
+                    self._polled.get(manager_id, generation) > generation)
+
+        with self._condition:
+            self._waiting[manager_id] += 1
+            if self._poller is None:
+                self._poller = threading.Thread(
+                    target=self._poll, args=(current_app._get_current_object(),),
+                    name='depsgraph-change-poller', daemon=True)
+                self._poller.start()
+            try:
+                return self._condition.wait_for(changed, timeout)
+            finally:
+                self._waiting[manager_id] -= 1
+                if not self._waiting[manager_id]:
+                    del self._waiting[manager_id]
+                    self._polled.pop(manager_id, None)
+
+    def _poll(self, app):
+        """Fetches the generations of the awaited Managers, until nobody is waiting."""
+
+        with app.app_context():
+            while True:
+                time.sleep(self.poll_interval)
+                with self._condition:
+                    manager_ids = list(self._waiting)
+                    if not manager_ids:
+                        self._poller = None
+                        return
+
+                try:
+                    generations = fetch_generations(manager_ids)
+                except Exception:
+                    # Keep polling; the waiting requests time out if this persists.
+                    log.exception('Error fetching depsgraph generations of %i Managers',
+                                  len(manager_ids))
+                    continue
+
+                with self._condition:
+                    for manager_id in self._waiting:
+                        if manager_id in generations:
+                            self._polled[manager_id] = generations[manager_id]
+                    self._condition.notify_all()
+
+
+def fetch_generation(manager_id: bson.ObjectId) -> int:
+    """Returns the depsgraph generation of the Manager, bypassing any cache."""
+
+    from flamenco import current_flamenco
+
+    managers_coll = current_flamenco.db('managers')
+    mngr_doc = managers_coll.find_one({'_id': manager_id},
+                                      projection={'depsgraph_generation': 1})
+    return (mngr_doc or {}).get('depsgraph_generation', 0)
+
+
+def fetch_generations(manager_ids: typing.List[bson.ObjectId]) \
+        -> typing.Dict[bson.ObjectId, int]:
+    """Returns the depsgraph generations of the Managers, with a single query."""
+
+    from flamenco import current_flamenco
+
+    managers_coll = current_flamenco.db('managers')
+    generations = {manager_id: 0 for manager_id in manager_ids}
+    for mngr_doc in managers_coll.find({'_id': {'$in': manager_ids}},
+                                       projection={'depsgraph_generation': 1}):
+        generations[mngr_doc['_id']] = mngr_doc.get('depsgraph_generation', 0)
+    return generations
+
+
+def create_notifier(config) -> AbstractChangeNotifier:
+    """Creates the change notifier configured with FLAMENCO_CHANGE_NOTIFIER."""
+
+    kind = config['FLAMENCO_CHANGE_NOTIFIER']
+    if kind == 'local':
+        return LocalChangeNotifier()
+    if kind == 'mongo':
+        interval = config['FLAMENCO_CHANGE_NOTIFIER_POLL_INTERVAL'].total_seconds()
+        return MongoChangeNotifier(poll_interval=interval)
+    raise ValueError(f'Unknown FLAMENCO_CHANGE_NOTIFIER {kind!r}, '
+                     f"should be 'local' or 'mongo'")
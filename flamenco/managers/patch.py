@@ -119,6 +119,7 @@ class ManagerPatchHandler(patch_handler.AbstractPatchHandler):
             self.log.warning('User %s edits Manager %s but update matched %i items',
                              current_user_id(), manager_id, result.matched_count)
             raise wz_exceptions.BadRequest()
+        current_flamenco.manager_manager.forget_api_info(manager_id)
 
         return '', 204
 
@@ -0,0 +1,220 @@
+"""Decoding of request payloads sent by Flamenco Managers, and response negotiation."""
+
+import base64
+import binascii
+import json
+import logging
+import typing
+import zlib
+
+from flask import current_app, request
+import werkzeug.exceptions as wz_exceptions
+
+from . import msgpack_encoding
+
+log = logging.getLogger(__name__)
+
+# Nr of bytes read from the request stream, and max nr of bytes produced per decompression step.
+CHUNK_SIZE = 64 * 1024
+TRUNCATED_LOG_SUFFIX = '\n[log truncated by Flamenco Server, it exceeded %i bytes]\n'
+
+
+class PayloadTooLarge(ValueError):
+    """Raised when decompressed data exceeds the allowed size."""
+
+
+def gunzip_limited(chunks: typing.Iterable[bytes], max_size: int) -> typing.Iterator[bytes]:
+    """Generator, decompresses gzipped chunks of data.
+
+    Never produces more than CHUNK_SIZE bytes per step, so that the memory usage
+    of the decompression itself stays bounded.
+
+    :raises PayloadTooLarge: as soon as the decompressed data exceeds max_size bytes.
+    :raises zlib.error: when the data is not valid gzip data.
+    """
+
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    total_size = 0
+
+    def check_size(data: bytes):
+        nonlocal total_size
+        total_size += len(data)
+        if total_size > max_size:
+            raise PayloadTooLarge(f'Decompressed data exceeds {max_size} bytes')
+
+    for chunk in chunks:
+        while chunk:
+            data = decompressor.decompress(chunk, CHUNK_SIZE)
+            check_size(data)
+            yield data
+            chunk = decompressor.unconsumed_tail
+
+    data = decompressor.flush()
+    check_size(data)
+    yield data
+
+
+def iter_request_body(chunk_size=CHUNK_SIZE) -> typing.Iterator[bytes]:
+    """Generator, yields the request body in chunks, decompressing when necessary.
+
+    The request body is gzip-decompressed when the request has a
+    'Content-Encoding: gzip' header.
+    """
+
+    chunks = iter(lambda: request.stream.read(chunk_size), b'')
+    if not request_is_gzipped():
+        yield from chunks
+        return
+
+    max_size = current_app.config['FLAMENCO_MAX_DECOMPRESSED_REQUEST_SIZE']
+    try:
+        yield from gunzip_limited(chunks, max_size)
+    except PayloadTooLarge:
+        log.warning('Decompressed request body exceeds %i bytes, rejecting', max_size)
+        raise wz_exceptions.RequestEntityTooLarge()
+    except zlib.error as ex:
+        log.warning('Unable to decompress request body: %s', ex)
+        raise wz_exceptions.BadRequest('Invalid gzip-compressed request body')
+
+
+def request_is_gzipped() -> bool:
+    return request.headers.get('Content-Encoding', '').lower() == 'gzip'
+
+
+def request_json():
+    """Returns the decoded JSON payload of the current request.
+
+    Behaves like Flask's request.json, except that it also understands request bodies
+    with 'Content-Encoding: gzip'. Returns None for non-JSON requests.
+    """
+
+    if not request_is_gzipped():
+        return request.json
+
+    if request.mimetype != 'application/json':
+        return None
+
+    body = b''.join(iter_request_body())
+    try:
+        return json.loads(body.decode('utf8'))
+    except ValueError as ex:
+        log.warning('Unable to decode gzip-compressed JSON: %s', ex)
+        raise wz_exceptions.BadRequest('Invalid JSON in request body')
+
+
+def request_is_msgpack() -> bool:
+    return request.mimetype == msgpack_encoding.MIMETYPE
+
+
+def request_payload():
+    """Returns the decoded JSON or MessagePack payload of the current request.
+
+    Returns None for requests that are neither.
+    """
+
+    if not request_is_msgpack():
+        return request_json()
+
+    if not msgpack_encoding.available():
+        log.warning('Received MessagePack request, but the msgpack module is not installed')
+        raise wz_exceptions.UnsupportedMediaType('MessagePack is not supported by this server')
+
+    body = b''.join(iter_request_body())
+    try:
+        return msgpack_encoding.unpackb(body)
+    except ValueError as ex:
+        log.warning('Unable to decode MessagePack request body: %s', ex)
+        raise wz_exceptions.BadRequest('Invalid MessagePack in request body')
+
+
+def response_is_msgpack() -> bool:
+    """Returns True iff the response should be MessagePack, rather than JSON."""
+
+    return (msgpack_encoding.available() and
+            request.accept_mimetypes.best == msgpack_encoding.MIMETYPE)
+
+
+def request_is_ndjson() -> bool:
+    return request.mimetype == 'application/x-ndjson'
+
+
+def iter_ndjson(chunks: typing.Iterable[bytes], max_line_size: int) -> typing.Iterator:
+    """Generator, yields the decoded JSON documents of newline-delimited JSON.
+
+    Empty lines are skipped.
+
+    :raises PayloadTooLarge: when a line exceeds max_line_size bytes.
+    :raises ValueError: when a line is not valid JSON.
+    """
+
+    def decode(line: bytes):
+        line = line.strip()
+        if not line:
+            return None
+        return json.loads(line.decode('utf8'))
+
+    buffer = b''
+    for chunk in chunks:
+        lines = (buffer + chunk).split(b'\n')
+        buffer = lines.pop()
+        if len(buffer) > max_line_size:
+            raise PayloadTooLarge(f'NDJSON line exceeds {max_line_size} bytes')
+
+        for line in lines:
+            doc = decode(line)
+            if doc is not None:
+                yield doc
+
+    doc = decode(buffer)
+    if doc is not None:
+        yield doc
+
+
+def iter_request_ndjson() -> typing.Iterator:
+    """Generator, yields the documents of an application/x-ndjson request body as they arrive."""
+
+    max_line_size = current_app.config['FLAMENCO_MAX_NDJSON_LINE_SIZE']
+    try:
+        yield from iter_ndjson(iter_request_body(), max_line_size)
+    except PayloadTooLarge:
+        log.warning('NDJSON request body has a line exceeding %i bytes, rejecting', max_line_size)
+        raise wz_exceptions.RequestEntityTooLarge()
+    except ValueError as ex:
+        log.warning('Unable to decode NDJSON request body: %s', ex)
+        raise wz_exceptions.BadRequest('Invalid JSON in request body')
+
+
+def decode_gz_log(gz_log: typing.Union[str, bytes]) -> str:
+    """Decodes a base64-encoded, gzip-compressed task log.
+
+    MessagePack payloads can contain the gzip-compressed bytes directly, in which
+    case they are not base64-decoded.
+
+    Logs that are larger than FLAMENCO_MAX_TASK_LOG_SIZE bytes when decompressed
+    are truncated.
+
+    :raises ValueError: when the log cannot be decoded.
+    """
+
+    max_size = current_app.config['FLAMENCO_MAX_TASK_LOG_SIZE']
+
+    if isinstance(gz_log, bytes):
+        compressed = gz_log
+    else:
+        try:
+            compressed = base64.b64decode(gz_log)
+        except binascii.Error as ex:
+            raise ValueError(f'Invalid base64 data: {ex}')
+
+    parts = []
+    try:
+        for part in gunzip_limited([compressed], max_size):
+            parts.append(part)
+    except PayloadTooLarge:
+        log.info('Decompressed task log exceeds %i bytes, truncating', max_size)
+        decoded = b''.join(parts)[:max_size].decode('utf8', errors='replace')
+        return decoded + TRUNCATED_LOG_SUFFIX % max_size
+    except zlib.error as ex:
+        raise ValueError(f'Invalid gzip data: {ex}')
+
+    return b''.join(parts).decode('utf8', errors='replace')
@@ -1,7 +1,9 @@
 """Task management."""
 
 import attr
+import collections
 import datetime
+import typing
 
 import bson
 from flask import current_app
@@ -27,6 +29,10 @@ COLOR_FOR_TASK_STATUS = {
 
 REQUEABLE_TASK_STATES = {'completed', 'canceled', 'failed'}
 
+# Max nr of times api_update_status_q() looks for tasks that started to match its
+# query while it was updating them.
+STATUS_UPDATE_ROUNDS = 3
+
 
 @attr.s
 class TaskManager(object):
@@ -42,9 +48,48 @@ class TaskManager(object):
                         status='queued', *, task_type: str) -> bson.ObjectId:
         """Creates a task in MongoDB for the given job, executing commands.
 
-        Returns the ObjectId of the created task.
+        Returns the ObjectId of the created task. Use task_buffer() to create
+        many tasks at once.
+        """
+
+        task = self.task_document(job, commands, name, parents, priority, status,
+                                  task_type=task_type)
+
+        self._log.info('Creating task %s for manager %s, user %s',
+                       name, job['manager'], job['user'])
+
+        r, _, _, status = current_app.post_internal('flamenco_tasks', task)
+        if status != 201:
+            self._log.error('Error %i creating task %s: %s',
+                            status, task, r)
+            raise wz_exceptions.InternalServerError('Unable to create task')
+
+        from flamenco import current_flamenco
+        current_flamenco.job_manager.api_inc_task_status_counts(
+            {job['_id']: {task['status']: 1}})
+        if task['job_runnable']:
+            current_flamenco.manager_manager.api_bump_depsgraph_generation([job['manager']])
+
+        return r['_id']
+
+    def task_document(self, job, commands, name, parents=None, priority=50,
+                      status='queued', *, task_type: str,
+                      command_templates: typing.MutableMapping[str, dict] = None) -> dict:
+        """Returns a new task document for the given job, executing commands.
+
+        :param command_templates: when given, commands with per-task settings refer
+            to a command template, which is added to this mapping. The templates
+            should be stored in the job's 'command_templates' field.
         """
 
+        from flamenco.managers.api import DEPSGRAPH_RUNNABLE_JOB_STATUSES
+        from flamenco.job_compilers.commands import to_templated_dict
+
+        if command_templates is None:
+            command_dicts = [cmd.to_dict() for cmd in commands]
+        else:
+            command_dicts = [to_templated_dict(cmd, command_templates) for cmd in commands]
+
         task = {
             'job': job['_id'],
             'manager': job['manager'],
@@ -53,25 +98,38 @@ class TaskManager(object):
             'status': status,
             'job_type': job['job_type'],
             'task_type': task_type,
-            'commands': [cmd.to_dict() for cmd in commands],
+            'commands': command_dicts,
             'job_priority': job['priority'],
+            'job_runnable': job.get('status') in DEPSGRAPH_RUNNABLE_JOB_STATUSES,
             'priority': priority,
             'project': job['project'],
         }
         # Insertion of None parents is not supported
         if parents:
             task['parents'] = parents
+        return task
 
-        self._log.info('Creating task %s for manager %s, user %s',
-                       name, job['manager'], job['user'])
+    def api_task_ids_for_job(self, job_id: bson.ObjectId, *,
+                             task_type: str = None) -> typing.List[bson.ObjectId]:
+        """Returns the IDs of the tasks of the job, in order of creation."""
 
-        r, _, _, status = current_app.post_internal('flamenco_tasks', task)
-        if status != 201:
-            self._log.error('Error %i creating task %s: %s',
-                            status, task, r)
-            raise wz_exceptions.InternalServerError('Unable to create task')
+        query = {'job': job_id}
+        if task_type is not None:
+            query['task_type'] = task_type
 
-        return r['_id']
+        found = self.collection().find(query, projection={'_id': 1}).sort('_id', 1)
+        return [task['_id'] for task in found]
+
+    def task_buffer(self, job) -> 'flamenco.tasks.buffer.TaskBuffer':
+        """Returns a buffer for creating the tasks of the job in bulk.
+
+        Call flush() on the buffer after creating the last task.
+        """
+
+        from flamenco.tasks.buffer import TaskBuffer
+
+        batch_size = current_app.config['FLAMENCO_TASK_INSERT_BATCH_SIZE']
+        return TaskBuffer(self, job, batch_size=batch_size)
 
     def tasks_for_job(self, job_id, status=None, *,
                       page=1, max_results=250,
@@ -143,6 +201,129 @@ class TaskManager(object):
                                          to_status,
                                          now=now)
 
+    def api_update_status_q(self, query: dict, new_status: str, update: dict) -> int:
+        """Sets the queried tasks to new_status, keeping the task status counts in sync.
+
+        The tasks are updated per transition found by status_transitions(), each
+        update filtered on the old status of that transition. The modified count
+        of such an update is the exact nr of tasks that made the transition, even
+        when tasks change status concurrently.
+
+        :param update: the MongoDB update that sets the status, see
+            FlamencoExtension.update_status_q().
+        :returns: the nr of modified tasks.
+        """
+
+        tasks_coll = self.collection()
+        modified_count = 0
+        for _ in range(STATUS_UPDATE_ROUNDS):
+            transitions = self.status_transitions(query, new_status)
+            if not transitions:
+                break
+
+            for transition in transitions:
+                transition_query = {'job': transition['job'],
+                                    'manager': transition['manager'],
+                                    'status': transition['status']}
+                task_ids = transition['task_ids']
+                if new_status == 'cancel-requested':
+                    transition_query['_id'] = {'$in': task_ids}
+                result = tasks_coll.update_many({'$and': [query, transition_query]}, update)
+
+                if new_status == 'cancel-requested' and result.modified_count < len(task_ids):
+                    # Some tasks changed status in the meantime; only track those that
+                    # are actually cancel-requested.
+                    transition['task_ids'] = [task['_id'] for task in tasks_coll.find(
+                        {'_id': {'$in': task_ids}, 'status': 'cancel-requested'},
+                        projection={'_id': 1})]
+                transition['count'] = result.modified_count
+                modified_count += result.modified_count
+
+            self.apply_status_transitions(transitions, new_status)
+        else:
+            self._log.warning('Tasks %s kept changing status while setting them to %r',
+                              query, new_status)
+
+        return modified_count
+
+    def status_transitions(self, query: dict, new_status: str) -> typing.List[dict]:
+        """Determines the status transitions for setting the queried tasks to new_status.
+
+        Use this before actually updating the tasks, and pass the result to
+        apply_status_transitions() afterwards; see api_update_status_q().
+
+        Transitions into or out of 'cancel-requested' also include the IDs of the
+        tasks involved, as those are tracked per Manager.
+
+        :returns: list of {'job': job ID, 'manager': manager ID, 'status': old status,
+            'count': nr of tasks} dicts.
+        """
+
+        tasks_coll = self.collection()
+        match = {'$and': [query, {'status': {'$ne': new_status}}]}
+        group = {
+            '_id': {'job': '$job', 'manager': '$manager', 'status': '$status'},
+            'count': {'$sum': 1},
+        }
+        if new_status == 'cancel-requested':
+            group['task_ids'] = {'$push': '$_id'}
+        grouped = tasks_coll.aggregate([{'$match': match}, {'$group': group}])
+
+        transitions = [{'job': group['_id'].get('job'),
+                        'manager': group['_id'].get('manager'),
+                        'status': group['_id'].get('status'),
+                        'count': group['count'],
+                        'task_ids': group.get('task_ids')}
+                       for group in grouped]
+
+        # Only fetch the IDs of tasks leaving 'cancel-requested' when there are any.
+        leaving = {(transition['job'], transition['manager']): transition
+                   for transition in transitions
+                   if transition['status'] == 'cancel-requested'}
+        if leaving:
+            for transition in leaving.values():
+                transition['task_ids'] = []
+            cancel_requested = tasks_coll.find(
+                {'$and': [query, {'status': 'cancel-requested'}]},
+                projection={'job': 1, 'manager': 1})
+            for task in cancel_requested:
+                transition = leaving.get((task.get('job'), task.get('manager')))
+                if transition is not None:
+                    transition['task_ids'].append(task['_id'])
+
+        return transitions
+
+    def apply_status_transitions(self, transitions: typing.Iterable[dict], new_status: str):
+        """Updates the per-job task status counts after tasks changed status.
+
+        :param transitions: the result of status_transitions(), with the counts set to
+            the nr of tasks that actually made each transition.
+        """
+
+        from flamenco import current_flamenco
+
+        deltas = collections.defaultdict(lambda: collections.defaultdict(int))
+        cancel_requested_added = collections.defaultdict(list)
+        cancel_requested_removed = collections.defaultdict(list)
+        for transition in transitions:
+            if transition.get('task_ids'):
+                if new_status == 'cancel-requested':
+                    cancel_requested_added[transition['manager']].extend(transition['task_ids'])
+                elif transition['status'] == 'cancel-requested':
+                    cancel_requested_removed[transition['manager']].extend(transition['task_ids'])
+
+            job_id = transition['job']
+            if job_id is None:
+                continue
+            deltas[job_id][transition['status']] -= transition['count']
+            deltas[job_id][new_status] += transition['count']
+
+        current_flamenco.job_manager.api_inc_task_status_counts(deltas)
+        current_flamenco.manager_manager.api_update_cancel_requested(
+            cancel_requested_added, cancel_requested_removed)
+        current_flamenco.manager_manager.api_bump_depsgraph_generation(
+            transition['manager'] for transition in transitions)
+
     def api_set_activity(self, task_query: dict, new_activity: str):
         """Updates the activity for all tasks that match the query."""
 
@@ -186,19 +367,42 @@ class TaskManager(object):
         tids = [t['_id'] for t in tasks]
         return tids
 
-    def api_delete_tasks_for_job(self, job_id: bson.ObjectId):
-        """Deletes all tasks for a given job.
+    def api_delete_tasks_for_job(self, job_id: bson.ObjectId,
+                                 task_ids: typing.Collection[bson.ObjectId] = None):
+        """Deletes all tasks for a given job, or only the given tasks of the job.
 
         NOTE: this breaks references in the task log database.
         """
 
         from pymongo.results import DeleteResult
+        from flamenco import current_flamenco
 
-        self._log.info('Deleting all tasks of job %s', job_id)
+        query = {'job': job_id}
+        if task_ids is None:
+            self._log.info('Deleting all tasks of job %s', job_id)
+        else:
+            self._log.info('Deleting %i tasks of job %s', len(task_ids), job_id)
+            query['_id'] = {'$in': list(task_ids)}
         tasks_coll = self.collection()
-        delres: DeleteResult = tasks_coll.delete_many({'job': job_id})
+
+        # Deleted tasks can no longer be cancelled by their Manager.
+        cancel_requested = collections.defaultdict(list)
+        for task in tasks_coll.find({**query, 'status': 'cancel-requested'},
+                                    projection={'manager': 1}):
+            cancel_requested[task.get('manager')].append(task['_id'])
+        current_flamenco.manager_manager.api_update_cancel_requested(
+            removed=cancel_requested)
+
+        delres: DeleteResult = tasks_coll.delete_many(query)
         self._log.info('Deleted %i tasks of job %s', delres.deleted_count, job_id)
 
+        if delres.deleted_count:
+            job = current_flamenco.db('jobs').find_one({'_id': job_id}, {'manager': 1})
+            if job is not None:
+                current_flamenco.manager_manager.api_bump_depsgraph_generation([job['manager']])
+
+        current_flamenco.job_manager.api_reset_task_status_counts(job_id)
+
 
 def setup_app(app):
     from . import eve_hooks, patch
@@ -0,0 +1,173 @@
+"""Bulk creation of tasks by job compilers.
+
+Creating tasks one by one with Eve's post_internal() means full validation, hooks
+and one database round trip per task. The TaskBuffer instead collects the tasks
+of a job and inserts them with insert_many(). ObjectIds are assigned when a task
+is added to the buffer, so that they can be used to refer to parent tasks before
+the tasks are actually inserted.
+
+Tasks that share the same shape (fields, commands, and types of the command
+settings) are only validated once against the tasks schema.
+
+Commands with per-task settings are stored as reference to a command template,
+see flamenco.job_compilers.commands.to_templated_dict(). The templates are
+stored on the job before the tasks that use them are inserted.
+"""
+
+import collections
+import datetime
+import typing
+import uuid
+
+import attr
+import bson
+from bson import tz_util
+import werkzeug.exceptions as wz_exceptions
+
+from pillar import attrs_extra
+
+
+@attr.s
+class TaskBuffer:
+    task_manager = attr.ib(cmp=False, hash=False)
+    job = attr.ib(validator=attr.validators.instance_of(dict), repr=False)
+    batch_size = attr.ib(default=1000, validator=attr.validators.instance_of(int))
+
+    _log = attrs_extra.log('%s.TaskBuffer' % __name__)
+    _tasks = attr.ib(default=attr.Factory(list), init=False, repr=False)
+    _validated_shapes = attr.ib(default=attr.Factory(set), init=False, repr=False)
+    _task_ids = attr.ib(default=attr.Factory(set), init=False, repr=False)
+    # Mapping {template key: command template} of the templates used by the tasks.
+    command_templates = attr.ib(default=attr.Factory(dict), init=False, repr=False)
+    _stored_templates = attr.ib(default=attr.Factory(set), init=False, repr=False)
+    # Total nr of tasks inserted by this buffer.
+    inserted_count = attr.ib(default=0, init=False)
+    _inserted_ids = attr.ib(default=attr.Factory(list), init=False, repr=False)
+
+    def create_task(self, commands, name, parents=None, priority=50,
+                    status='queued', *, task_type: str) -> bson.ObjectId:
+        """Adds a task to the buffer, flushing the buffer when it is full.
+
+        Takes the same parameters as TaskManager.api_create_task(), except the job.
+
+        :returns: the ObjectId the task will have.
+        """
+
+        task = self.task_manager.task_document(self.job, commands, name, parents, priority,
+                                               status, task_type=task_type,
+                                               command_templates=self.command_templates)
+        self._validate(task)
+
+        task['_id'] = bson.ObjectId()
+        self._task_ids.add(task['_id'])
+        self._tasks.append(task)
+        if len(self._tasks) >= self.batch_size:
+            self.flush()
+        return task['_id']
+
+    def flush(self):
+        """Inserts the buffered tasks into the database."""
+
+        from flamenco import current_flamenco
+
+        if not self._tasks:
+            return
+
+        tasks, self._tasks = self._tasks, []
+        now = datetime.datetime.now(tz=tz_util.utc)
+        etag = uuid.uuid4().hex
+        status_counts = collections.Counter()
+        for task in tasks:
+            task['_created'] = task['_updated'] = now
+            task['_etag'] = etag
+            status_counts[task['status']] += 1
+
+        new_templates = {key: template for key, template in self.command_templates.items()
+                         if key not in self._stored_templates}
+        if new_templates:
+            current_flamenco.job_manager.api_add_command_templates(self.job['_id'],
+                                                                   new_templates)
+            self._stored_templates.update(new_templates)
+
+        self._log.info('Creating %i tasks for job %s, manager %s, user %s',
+                       len(tasks), self.job['_id'], self.job['manager'], self.job['user'])
+        tasks_coll = current_flamenco.db('tasks')
+        tasks_coll.insert_many(tasks, ordered=True)
+        self.inserted_count += len(tasks)
+        self._inserted_ids.extend(task['_id'] for task in tasks)
+
+        current_flamenco.job_manager.api_inc_task_status_counts(
+            {self.job['_id']: status_counts})
+        current_flamenco.job_manager.api_inc_compile_progress(self.job['_id'], len(tasks))
+        if any(task['job_runnable'] for task in tasks):
+            current_flamenco.manager_manager.api_bump_depsgraph_generation([self.job['manager']])
+
+    def discard(self):
+        """Forgets the buffered tasks, and deletes the tasks that were already inserted.
+
+        Use this when compilation fails halfway, so that compiling again does not
+        create the same tasks twice.
+        """
+
+        from flamenco import current_flamenco
+
+        self._tasks = []
+        if not self._inserted_ids:
+            return
+
+        job_id = self.job['_id']
+        job_manager = current_flamenco.job_manager
+        current_flamenco.task_manager.api_delete_tasks_for_job(job_id, self._inserted_ids)
+        # The deleted tasks may have changed status since they were inserted.
+        job_manager.api_recount_task_statuses([job_id])
+        job_manager.api_inc_compile_progress(job_id, -len(self._inserted_ids))
+        self.inserted_count -= len(self._inserted_ids)
+        self._inserted_ids = []
+
+    def _validate(self, task: dict):
+        """Validates the task against the tasks schema, once per shape.
+
+        Parent tasks may not have been inserted yet, so they are checked against the
+        tasks created by this buffer, rather than against the database.
+        """
+
+        from flask import current_app
+
+        unknown_parents = [parent for parent in task.get('parents', [])
+                           if parent not in self._task_ids]
+        if unknown_parents:
+            self._log.error('Error creating task %s: parents %s were not created by this buffer',
+                            task, unknown_parents)
+            raise wz_exceptions.InternalServerError('Unable to create task')
+
+        shape = _shape(task)
+        if shape in self._validated_shapes:
+            return
+
+        if 'parents' in task:
+            task = {**task, 'parents': []}
+        schema = current_app.config['DOMAIN']['flamenco_tasks']['schema']
+        validator = current_app.validator(schema, resource='flamenco_tasks')
+        if not validator.validate(task):
+            self._log.error('Error creating task %s: %s', task, validator.errors)
+            raise wz_exceptions.InternalServerError('Unable to create task')
+        self._validated_shapes.add(shape)
+
+
+def _shape(task: dict) -> typing.Hashable:
+    """Returns the shape of the task, which determines whether it needs validation.
+
+    The status is part of the shape, as only certain values are allowed.
+    """
+
+    def value_shape(value):
+        if isinstance(value, dict):
+            return tuple(sorted((key, value_shape(item)) for key, item in value.items()))
+        if isinstance(value, list):
+            return 'list', tuple(sorted({value_shape(item) for item in value}, key=repr))
+        return type(value).__name__
+
+    commands = tuple((cmd.get('name', cmd.get('template')), value_shape(cmd))
+                     for cmd in task['commands'])
+    other_fields = {key: value for key, value in task.items() if key != 'commands'}
+    return task['status'], value_shape(other_fields), commands
@@ -96,10 +96,54 @@ def update_job_status(task_doc, original_doc):
         log.warning('update_job_status(): Task %s has no job, this should not happen.', task_id)
         return
 
+    current_flamenco.job_manager.api_inc_task_status_counts(
+        {job_id: {old_status: -1, current_status: 1}})
+
+    manager_id = task_doc.get('manager')
+    if current_status == 'cancel-requested':
+        current_flamenco.manager_manager.api_update_cancel_requested(
+            added={manager_id: [task_id]})
+    elif old_status == 'cancel-requested':
+        current_flamenco.manager_manager.api_update_cancel_requested(
+            removed={manager_id: [task_id]})
+    current_flamenco.manager_manager.api_bump_depsgraph_generation([manager_id])
+
     current_flamenco.job_manager.update_job_after_task_status_change(
         job_id, task_id, current_status)
 
 
+def after_inserting_tasks(task_docs: typing.List[dict]):
+    """Counts tasks created via Eve in the task status counts of their jobs."""
+    _count_tasks(task_docs, 1)
+
+
+def after_deleting_task(task_doc: dict):
+    """Uncounts a task deleted via Eve from the task status counts of its job."""
+    _count_tasks([task_doc], -1)
+
+
+def _count_tasks(task_docs: typing.List[dict], delta: int):
+    import collections
+
+    deltas = collections.defaultdict(lambda: collections.defaultdict(int))
+    cancel_requested = collections.defaultdict(list)
+    for task_doc in task_docs:
+        job_id = task_doc.get('job')
+        status = task_doc.get('status')
+        if job_id and status:
+            deltas[job_id][status] += delta
+        if status == 'cancel-requested':
+            cancel_requested[task_doc.get('manager')].append(task_doc['_id'])
+
+    current_flamenco.job_manager.api_inc_task_status_counts(deltas)
+    if delta > 0:
+        current_flamenco.manager_manager.api_update_cancel_requested(added=cancel_requested)
+    else:
+        current_flamenco.manager_manager.api_update_cancel_requested(removed=cancel_requested)
+    current_flamenco.manager_manager.api_bump_depsgraph_generation(
+        task_doc.get('manager') for task_doc in task_docs)
+
+
 def setup_app(app):
     from functools import partial
 
@@ -115,3 +159,5 @@ def setup_app(app):
     app.on_update_flamenco_tasks += partial(check_task_edit_permissions, action='edit')
     app.on_replace_flamenco_tasks += check_task_permissions_edit
     app.on_replaced_flamenco_tasks += update_job_status
+    app.on_inserted_flamenco_tasks += after_inserting_tasks
+    app.on_deleted_item_flamenco_tasks += after_deleting_task
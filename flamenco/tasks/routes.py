@@ -1,5 +1,6 @@
 # coding=utf-8
 import logging
+import typing
 
 import bson
 import flask_login
@@ -101,6 +102,7 @@ def view_task(project, flamenco_props, task_id):
         raise wz_exceptions.Forbidden()
 
     task = Task.find(task_id, api=api)
+    commands = task_commands(task.to_dict(), api)
 
     from . import REQUEABLE_TASK_STATES
     project_id = bson.ObjectId(project['_id'])
@@ -110,6 +112,7 @@ def view_task(project, flamenco_props, task_id):
 
     return render_template('flamenco/tasks/view_task_embed.html',
                            task=task,
+                           commands=commands,
                            project=project,
                            flamenco_props=flamenco_props.to_dict(),
                            flamenco_context=request.args.get('context'),
@@ -117,6 +120,25 @@ def view_task(project, flamenco_props, task_id):
                            can_requeue_task=can_requeue_task)
 
 
+def task_commands(task: dict, api) -> typing.List[dict]:
+    """Returns the task's commands, with references to command templates expanded."""
+
+    from flamenco.jobs.sdk import Job
+    from flamenco.job_compilers.commands import expand_command, uses_templates
+
+    if not uses_templates(task):
+        return task.get('commands') or []
+
+    job = Job.find(task['job'], {'projection': {'command_templates': 1}}, api=api)
+    templates = job.to_dict().get('command_templates') or {}
+    try:
+        return [expand_command(cmd, templates) for cmd in task['commands']]
+    except KeyError:
+        log.warning('Task %s refers to a command template that job %s does not have',
+                    task['_id'], task['job'])
+        return task['commands']
+
+
 @perproject_blueprint.route('/<task_id>/set-status', methods=['POST'])
 @flask_login.login_required
 @flamenco_project_view(action=Actions.USE)
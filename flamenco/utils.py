@@ -32,6 +32,32 @@ def frame_range_parse(frame_range=None):
     return frames_list
 
 
+def frame_range_count(frame_range=None):
+    """Given a range of frames, return the number of frames, without listing them.
+
+    Frames that occur more than once are counted more than once.
+
+    :type frame_range: str
+    :rtype: int
+
+    :Example:
+    >>> frame_range_count("1,3-5,8")
+    >>> 5
+    """
+    if not frame_range:
+        return 0
+
+    count = 0
+    for part in frame_range.split(','):
+        x = part.split("-")
+        num_parts = len(x)
+        if num_parts == 1:
+            count += 1
+        elif num_parts == 2:
+            count += max(0, int(x[1]) - int(x[0]) + 1)
+    return count
+
+
 def frame_range_merge(frames_list=None, blender_style=False):
     """Given a frames list, merge them and return them as range of frames.
 
@@ -93,6 +119,22 @@ def iter_frame_range(merged_frame_range, chunk_size):
         yield chunk_frames
 
 
+def chunked(iterable, chunk_size):
+    """Generator, yields lists of at most 'chunk_size' items from the iterable.
+
+    Only consumes the iterable as far as necessary to produce the next list.
+    """
+
+    import itertools
+
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
 @contextlib.contextmanager
 def report_duration(logger, description):
     import time
@@ -16,6 +16,11 @@ class FlamencoTestServer(PillarTestServer):
     def __init__(self, *args, **kwargs):
         PillarTestServer.__init__(self, *args, **kwargs)
 
+        # The tests run in a single process, so there is no need to poll MongoDB.
+        self.config['FLAMENCO_CHANGE_NOTIFIER'] = 'local'
+        # Most tests expect the tasks of a job to exist as soon as the job is created.
+        self.config['FLAMENCO_COMPILE_IN_BACKGROUND'] = False
+
         from flamenco import FlamencoExtension
         self.load_extension(FlamencoExtension(), '/flamenco')
 
@@ -134,10 +139,15 @@ class AbstractFlamencoTest(AbstractPillarTest):
         if job_id is None:
             job_id = self.job_id
 
+        from flamenco.managers.api import DEPSGRAPH_RUNNABLE_JOB_STATUSES
+
         with self.app.test_request_context():
             jobs_coll = self.flamenco.db('jobs')
             result = jobs_coll.update_one({'_id': job_id},
                                           {'$set': {'status': new_status}})
+            # Keep the tasks' denormalised runnability in sync.
+            self.jmngr.api_set_tasks_job_runnable(
+                job_id, new_status in DEPSGRAPH_RUNNABLE_JOB_STATUSES)
         self.assertEqual(1, result.matched_count)
 
     def set_job_updated(self, new_updated, job_id=None):
@@ -0,0 +1,149 @@
+import time
+
+from abstract_flamenco_test import AbstractFlamencoTest
+
+
+class AdmissionControllerTest(AbstractFlamencoTest):
+    def setUp(self, **kwargs):
+        super().setUp(**kwargs)
+
+        self.app.config['FLAMENCO_ADMISSION_MAX_IN_FLIGHT'] = {'default': 4}
+        self.app.config['FLAMENCO_ADMISSION_PRIORITY_RESERVE'] = 0.5
+
+    def test_in_flight(self):
+        admission = self.flamenco.admission
+
+        with self.app.app_context():
+            # Requests are in flight from their admission, not from their database work.
+            self.assertIsNone(admission.admit('endpoint', priority=False))
+            self.assertIsNone(admission.admit('endpoint', priority=False))
+
+            # Half the capacity is reserved for priority requests.
+            rejection = admission.admit('endpoint', priority=False)
+            self.assertEqual(429, rejection.status)
+            self.assertGreaterEqual(rejection.retry_after, 1)
+            self.assertIsNone(admission.admit('endpoint', priority=True))
+
+            # Other endpoints are not affected.
+            self.assertIsNone(admission.admit('other', priority=False))
+
+            for _ in range(3):
+                admission.release('endpoint')
+            self.assertIsNone(admission.admit('endpoint', priority=False))
+            admission.release('endpoint')
+
+        counters = admission.counters()['endpoint']
+        self.assertEqual(0, counters['in_flight'])
+        self.assertEqual(4, counters['admitted'])
+        self.assertEqual(1, counters['admitted_priority'])
+        self.assertEqual({'429': 1}, counters['rejected'])
+
+    def test_idle(self):
+        admission = self.flamenco.admission
+
+        with self.app.app_context():
+            self.assertIsNone(admission.admit('endpoint', priority=False))
+            self.assertIsNone(admission.admit('endpoint', priority=False))
+
+            # Waiting requests do not take the place of other requests.
+            with admission.idle('endpoint'), admission.idle('endpoint'):
+                self.assertEqual(0, admission.counters()['endpoint']['in_flight'])
+                self.assertIsNone(admission.admit('endpoint', priority=False))
+                admission.release('endpoint')
+
+            self.assertEqual(2, admission.counters()['endpoint']['in_flight'])
+
+    def test_latency(self):
+        import datetime
+
+        admission = self.flamenco.admission
+        self.app.config['FLAMENCO_ADMISSION_MAX_LATENCY'] = datetime.timedelta(milliseconds=1)
+
+        with self.app.app_context():
+            with admission.database_work('endpoint'):
+                time.sleep(0.01)
+
+            rejection = admission.admit('endpoint', priority=False)
+            self.assertEqual(503, rejection.status)
+            self.assertIsNone(admission.admit('endpoint', priority=True))
+
+            # Old measurements should be ignored.
+            self.app.config['FLAMENCO_ADMISSION_LATENCY_WINDOW'] = datetime.timedelta(0)
+            self.assertIsNone(admission.admit('endpoint', priority=False))
+
+    def test_latency_after_window(self):
+        import datetime
+
+        admission = self.flamenco.admission
+        self.app.config['FLAMENCO_ADMISSION_MAX_LATENCY'] = datetime.timedelta(milliseconds=5)
+        self.app.config['FLAMENCO_ADMISSION_LATENCY_WINDOW'] = datetime.timedelta(
+            milliseconds=50)
+
+        with self.app.app_context():
+            with admission.database_work('endpoint'):
+                time.sleep(0.05)
+            self.assertEqual(503, admission.admit('endpoint', priority=False).status)
+
+            # A fast measurement after the slow one expired should not be mixed with it.
+            time.sleep(0.06)
+            with admission.database_work('endpoint'):
+                pass
+            self.assertIsNone(admission.admit('endpoint', priority=False))
+
+    def test_disabled(self):
+        admission = self.flamenco.admission
+        self.app.config['FLAMENCO_ADMISSION_CONTROL'] = False
+        self.app.config['FLAMENCO_ADMISSION_MAX_IN_FLIGHT'] = {'default': 0}
+
+        with self.app.app_context():
+            self.assertIsNone(admission.admit('endpoint', priority=False))
+
+
+class ManagerAPIAdmissionTest(AbstractFlamencoTest):
+    def setUp(self, **kwargs):
+        super().setUp(**kwargs)
+
+        mngr_doc, account, token = self.create_manager_service_account()
+        self.mngr_id = mngr_doc['_id']
+        self.mngr_token = token['token']
+
+        self.app.config['FLAMENCO_ADMISSION_MAX_IN_FLIGHT'] = {'default': 2}
+        self.app.config['FLAMENCO_ADMISSION_PRIORITY_RESERVE'] = 0.5
+
+    def post_updates(self, updates, expected_status=200):
+        return self.post('/api/flamenco/managers/%s/task-update-batch' % self.mngr_id,
+                         auth_token=self.mngr_token,
+                         json=updates,
+                         expected_status=expected_status)
+
+    def test_status_changes_have_priority(self):
+        progress_update = {'_id': 24 * '1', 'task_id': 24 * '2', 'activity': 'rendering'}
+        status_update = {'_id': 24 * '3', 'task_id': 24 * '2', 'task_status': 'failed'}
+
+        admission = self.flamenco.admission
+        with self.app.app_context():
+            # Another request was admitted, but has not started its database work yet.
+            self.assertIsNone(admission.admit('task_update_batch', priority=False))
+
+            resp = self.post_updates([progress_update], expected_status=429)
+            self.assertGreaterEqual(int(resp.headers['Retry-After']), 1)
+
+            self.post_updates([progress_update, status_update])
+
+            admission.release('task_update_batch')
+
+        self.post_updates([progress_update])
+
+    def test_counters(self):
+        self.create_user(user_id=24 * 'f', roles={'flamenco-admin'}, token='fladmin-token')
+        self.post_updates([])
+
+        counters = self.get('/api/flamenco/managers/admission-counters',
+                            auth_token='fladmin-token').json
+        self.assertEqual(1, counters['task_update_batch']['admitted'])
+        # The request is no longer in flight once it has been handled.
+        self.assertEqual(0, counters['task_update_batch']['in_flight'])
+
+        self.get('/api/flamenco/managers/admission-counters',
+                 auth_token=self.mngr_token,
+                 expected_status=403)
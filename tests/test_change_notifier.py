@@ -0,0 +1,69 @@
+import threading
+import unittest.mock
+
+from abstract_flamenco_test import AbstractFlamencoTest
+
+
+class MongoChangeNotifierTest(AbstractFlamencoTest):
+    def setUp(self, **kwargs):
+        super().setUp(**kwargs)
+
+        from flamenco.managers.notifications import MongoChangeNotifier
+
+        self.notifier = MongoChangeNotifier(poll_interval=0.05)
+        self.mngr_ids = [self.create_manager_service_account()[0]['_id'] for _ in range(2)]
+
+    def _bump_in_other_process(self, manager_id):
+        with self.app.app_context():
+            self.flamenco.db('managers').update_one(
+                {'_id': manager_id}, {'$inc': {'depsgraph_generation': 1}})
+
+    def _wait_in_thread(self, manager_id, results):
+        def wait():
+            with self.app.app_context():
+                results[manager_id] = self.notifier.wait(manager_id, 0, 5.0)
+
+        thread = threading.Thread(target=wait)
+        thread.start()
+        return thread
+
+    def test_one_query_for_all_waiters(self):
+        import time
+        from flamenco.managers import notifications
+
+        results = {}
+        with unittest.mock.patch('flamenco.managers.notifications.fetch_generations',
+                                 wraps=notifications.fetch_generations) as mock_fetch:
+            threads = [self._wait_in_thread(manager_id, results)
+                       for manager_id in self.mngr_ids]
+
+            # The poller should fetch the generations of both Managers at once.
+            deadline = time.monotonic() + 5
+            while not any(set(call[0][0]) == set(self.mngr_ids)
+                          for call in mock_fetch.call_args_list):
+                self.assertLess(time.monotonic(), deadline)
+                time.sleep(0.01)
+
+            self._bump_in_other_process(self.mngr_ids[0])
+            self._bump_in_other_process(self.mngr_ids[1])
+            for thread in threads:
+                thread.join(5)
+
+        self.assertEqual({self.mngr_ids[0]: 1, self.mngr_ids[1]: 1}, results)
+
+    def test_timeout(self):
+        with self.app.app_context():
+            self.assertIsNone(self.notifier.wait(self.mngr_ids[0], 0, 0.2))
+
+    def test_local_notification(self):
+        from flamenco.managers.notifications import MongoChangeNotifier
+
+        # Local notifications should not have to wait for the poller.
+        self.notifier = MongoChangeNotifier(poll_interval=60.0)
+        results = {}
+        thread = self._wait_in_thread(self.mngr_ids[0], results)
+        self._bump_in_other_process(self.mngr_ids[0])
+        self.notifier.notify([self.mngr_ids[0]])
+        thread.join(5)
+
+        self.assertEqual({self.mngr_ids[0]: 1}, results)
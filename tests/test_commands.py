@@ -6,3 +6,95 @@ class SomeCommandsTest(TestCase):
         from flamenco.job_compilers.commands import BlenderRender
 
         self.assertEqual('blender_render', BlenderRender.cmdname())
+
+    def test_per_task_settings(self):
+        from flamenco.job_compilers.commands import per_task_settings
+
+        self.assertEqual({'frames'}, per_task_settings('blender_render'))
+        self.assertIn('cycles_chunk', per_task_settings('blender_render_progressive'))
+        self.assertEqual(frozenset(), per_task_settings('sleep'))
+        self.assertEqual(frozenset(), per_task_settings('unknown-command'))
+
+
+class CommandBlocksTest(TestCase):
+    def test_compress_task(self):
+        from flamenco.job_compilers.commands import BlenderRender
+        from flamenco.managers.depsgraph import CommandBlocks
+
+        def task(frames):
+            cmd = BlenderRender(blender_cmd='{blender}', filepath='/render/file.blend',
+                                format='EXR', render_output='/render/out/####',
+                                frames=frames)
+            return {'_id': frames, 'commands': [cmd.to_dict()]}
+
+        blocks = CommandBlocks()
+        compressed = [blocks.compress_task(task(frames)) for frames in ('1-10', '11-20')]
+
+        # Both tasks should refer to the same block, which should not contain the frames.
+        self.assertEqual(1, len(blocks.new_blocks))
+        block_hash, block = next(iter(blocks.new_blocks.items()))
+        self.assertEqual('blender_render', block['name'])
+        self.assertNotIn('frames', block['settings'])
+        self.assertEqual([{'block': block_hash, 'settings': {'frames': '1-10'}}],
+                         compressed[0]['commands'])
+        self.assertEqual([{'block': block_hash, 'settings': {'frames': '11-20'}}],
+                         compressed[1]['commands'])
+
+        # Blocks the Manager already knows should not be sent again.
+        blocks = CommandBlocks(known={block_hash})
+        blocks.compress_task(task('21-30'))
+        self.assertEqual({}, blocks.new_blocks)
+
+
+class CommandTemplatesTest(TestCase):
+    def test_per_task_settings(self):
+        from flamenco.job_compilers.commands import (
+            BlenderRender, Sleep, to_templated_dict, expand_command)
+
+        templates = {}
+        render_cmds = [
+            BlenderRender(blender_cmd='{blender}', filepath='/render/file.blend',
+                          format='EXR', render_output='/render/out/####', frames=frames)
+            for frames in ('1..10', '11..20')]
+        templated = [to_templated_dict(cmd, templates) for cmd in render_cmds]
+
+        # Both commands should refer to the same template, which should not contain the frames.
+        self.assertEqual(1, len(templates))
+        key, template = next(iter(templates.items()))
+        self.assertEqual('blender_render', template['name'])
+        self.assertNotIn('frames', template['settings'])
+        self.assertEqual({'template': key, 'settings': {'frames': '1..10'}}, templated[0])
+        self.assertEqual([cmd.to_dict() for cmd in render_cmds],
+                         [expand_command(cmd, templates) for cmd in templated])
+
+        # Commands without per-task settings should not be templated.
+        sleep = Sleep(time_in_seconds=3)
+        self.assertEqual(sleep.to_dict(), to_templated_dict(sleep, templates))
+        self.assertEqual(1, len(templates))
+
+    def test_for_frame(self):
+        from flamenco.job_compilers.commands import (
+            CopyFile, ForFrame, to_templated_dict, expand_command, expand_task)
+
+        copy_file = CopyFile(src='/render/tmp/frame-%06i.exr', dest='/render/out/%06i.exr')
+        frame_cmds = [ForFrame(copy_file, frozenset({'src', 'dest'}), frame)
+                      for frame in (1, 2)]
+        self.assertEqual({'name': 'copy_file', 'settings': {
+            'src': '/render/tmp/frame-000002.exr',
+            'dest': '/render/out/000002.exr',
+        }}, frame_cmds[1].to_dict())
+
+        templates = {}
+        task = {'_id': 'some-task',
+                'commands': [to_templated_dict(cmd, templates) for cmd in frame_cmds]}
+        self.assertEqual(1, len(templates))
+        key = next(iter(templates))
+        self.assertEqual({'template': key, 'frame': 2, 'settings': {}}, task['commands'][1])
+
+        expanded = expand_task(task, templates)
+        self.assertEqual([cmd.to_dict() for cmd in frame_cmds], expanded['commands'])
+        self.assertEqual({'template': key, 'frame': 1, 'settings': {}}, task['commands'][0],
+                         'the task itself should not be modified')
+
+        with self.assertRaises(KeyError):
+            expand_command(task['commands'][0], {})
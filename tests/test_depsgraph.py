@@ -1,6 +1,8 @@
 # -*- encoding: utf-8 -*-
 
+import importlib.util
 import logging
+import unittest
 
 from bson import ObjectId
 
@@ -144,6 +146,33 @@ class DepsgraphTest(AbstractFlamencoTest):
         self.assertEqual(5 * ['claimed-by-manager'],
                          [task['status'] for task in depsgraph])
 
+    def test_job_runnable_flag(self):
+        def depsgraph_task_ids():
+            resp = self.get('/api/flamenco/managers/%s/depsgraph' % self.mngr_id,
+                            auth_token=self.mngr_token)
+            return {ObjectId(t['_id']) for t in resp.json['depsgraph']}
+
+        with self.app.test_request_context():
+            tasks_coll = self.flamenco.db('tasks')
+            job2_task_ids = {t['_id'] for t in tasks_coll.find({'job': self.jobid2})}
+            for task in tasks_coll.find():
+                expect_runnable = task['job'] in {self.jobid1, self.jobid2}
+                self.assertEqual(expect_runnable, task['job_runnable'])
+
+        # Completing the job should make its tasks invisible to the depsgraph.
+        self.set_job_status('completed', job_id=self.jobid2)
+        with self.app.test_request_context():
+            for task in tasks_coll.find({'job': self.jobid2}):
+                self.assertFalse(task['job_runnable'])
+        self.assertEqual(set(self.task_ids) - job2_task_ids, depsgraph_task_ids())
+
+        # Requeueing should make them visible again.
+        self.set_job_status('queued', job_id=self.jobid2)
+        with self.app.test_request_context():
+            for task in tasks_coll.find({'job': self.jobid2}):
+                self.assertTrue(task['job_runnable'])
+        self.assertEqual(set(self.task_ids), depsgraph_task_ids())
+
     def test_get_subsequent_call(self):
         import time
         from dateutil.parser import parse
@@ -192,3 +221,223 @@ class DepsgraphTest(AbstractFlamencoTest):
         self.assertEqual(task2['status'], 'claimed-by-manager')
         self.assertEqual(2 * ['claimed-by-manager'],
                          [task['status'] for task in depsgraph])
+
+    def test_unchanged_poll_answered_from_generation(self):
+        import datetime
+
+        resp = self.get('/api/flamenco/managers/%s/depsgraph' % self.mngr_id,
+                        auth_token=self.mngr_token)
+        last_modified = resp.headers['X-Flamenco-Last-Updated']
+
+        # Modify a task behind Flamenco's back, without bumping the generation.
+        with self.app.test_request_context():
+            tasks_coll = self.flamenco.db('tasks')
+            task0 = tasks_coll.find_one({'_id': self.task_ids[0]})
+            tasks_coll.update_one({'_id': self.task_ids[0]},
+                                  {'$set': {'_updated': task0['_updated'] +
+                                                        datetime.timedelta(seconds=5)}})
+
+        # The depsgraph should be considered unchanged, as querying the tasks
+        # would have returned the modified task.
+        self.get('/api/flamenco/managers/%s/depsgraph' % self.mngr_id,
+                 auth_token=self.mngr_token,
+                 headers={'X-Flamenco-If-Updated-Since': last_modified},
+                 expected_status=304)
+
+        # After bumping the generation, the modified task should be returned.
+        with self.app.test_request_context():
+            self.flamenco.manager_manager.api_bump_depsgraph_generation([self.mngr_id])
+        resp = self.get('/api/flamenco/managers/%s/depsgraph' % self.mngr_id,
+                        auth_token=self.mngr_token,
+                        headers={'X-Flamenco-If-Updated-Since': last_modified})
+        self.assertEqual([str(self.task_ids[0])], [t['_id'] for t in resp.json['depsgraph']])
+
+    def test_long_poll(self):
+        import threading
+        import time
+
+        resp = self.get('/api/flamenco/managers/%s/depsgraph' % self.mngr_id,
+                        auth_token=self.mngr_token)
+        last_modified = resp.headers['X-Flamenco-Last-Updated']
+
+        # Without changes, the request should wait until the timeout expires.
+        start = time.monotonic()
+        self.get('/api/flamenco/managers/%s/depsgraph' % self.mngr_id,
+                 auth_token=self.mngr_token,
+                 headers={'X-Flamenco-If-Updated-Since': last_modified,
+                          'X-Flamenco-Wait': '0.2'},
+                 expected_status=304)
+        self.assertGreaterEqual(time.monotonic() - start, 0.2)
+
+        # A change during the wait should be returned as soon as it happens.
+        def requeue_task():
+            time.sleep(0.1)
+            self.force_task_status(0, 'queued')
+
+        thread = threading.Thread(target=requeue_task)
+        thread.start()
+        start = time.monotonic()
+        resp = self.get('/api/flamenco/managers/%s/depsgraph' % self.mngr_id,
+                        auth_token=self.mngr_token,
+                        headers={'X-Flamenco-If-Updated-Since': last_modified,
+                                 'X-Flamenco-Wait': '10'})
+        duration = time.monotonic() - start
+        thread.join()
+
+        self.assertLess(duration, 5)
+        self.assertEqual([str(self.task_ids[0])], [t['_id'] for t in resp.json['depsgraph']])
+
+    def test_long_poll_invalid_wait(self):
+        self.get('/api/flamenco/managers/%s/depsgraph' % self.mngr_id,
+                 auth_token=self.mngr_token,
+                 headers={'X-Flamenco-If-Updated-Since': '2018-07-06T10:00:00+00:00',
+                          'X-Flamenco-Wait': 'forever'},
+                 expected_status=400)
+
+    def test_get_clean_slate_in_batches(self):
+        self.app.config['FLAMENCO_DEPSGRAPH_BATCH_SIZE'] = 3
+
+        resp = self.get('/api/flamenco/managers/%s/depsgraph' % self.mngr_id,
+                        auth_token=self.mngr_token)
+        depsgraph = resp.json['depsgraph']
+        self.assertEqual({str(tid) for tid in self.task_ids}, {t['_id'] for t in depsgraph})
+        self.assertEqual(8 * ['claimed-by-manager'], [task['status'] for task in depsgraph])
+
+        # Tasks should be returned in order of last modification.
+        updated = [task['_updated'] for task in depsgraph]
+        self.assertEqual(sorted(updated, reverse=True), updated)
+
+        # Claiming should keep the task status counts up to date.
+        with self.app.test_request_context():
+            self.assertEqual({'claimed-by-manager': 4}, self.jmngr.task_status_counts(self.jobid1))
+            self.assertEqual({'claimed-by-manager': 4}, self.jmngr.task_status_counts(self.jobid2))
+
+    def test_get_clean_slate_bson(self):
+        import bson
+
+        self.app.config['FLAMENCO_DEPSGRAPH_BATCH_SIZE'] = 3
+
+        resp = self.get('/api/flamenco/managers/%s/depsgraph' % self.mngr_id,
+                        auth_token=self.mngr_token,
+                        headers={'Accept': 'application/bson'})
+        self.assertEqual('application/bson', resp.mimetype)
+
+        depsgraph = bson.BSON(resp.data).decode()['depsgraph']
+        self.assertEqual(set(self.task_ids), {t['_id'] for t in depsgraph})
+        self.assertEqual(8 * ['claimed-by-manager'], [task['status'] for task in depsgraph])
+
+    @unittest.skipUnless(importlib.util.find_spec('msgpack'), 'msgpack is not installed')
+    def test_get_clean_slate_msgpack(self):
+        from flamenco.managers import msgpack_encoding
+
+        resp = self.get('/api/flamenco/managers/%s/depsgraph' % self.mngr_id,
+                        auth_token=self.mngr_token,
+                        headers={'Accept': 'application/msgpack'})
+        self.assertEqual('application/msgpack', resp.mimetype)
+
+        depsgraph = msgpack_encoding.unpackb(resp.data)['depsgraph']
+        self.assertEqual(set(self.task_ids), {t['_id'] for t in depsgraph})
+        self.assertEqual(8 * ['claimed-by-manager'], [task['status'] for task in depsgraph])
+
+    def test_get_limited_pages(self):
+        import pymongo
+
+        url = '/api/flamenco/managers/%s/depsgraph' % self.mngr_id
+        with self.app.test_request_context():
+            expected_order = [task['_id'] for task in self.flamenco.db('tasks').find(
+                {'_id': {'$in': self.task_ids}},
+                sort=[('job_priority', pymongo.DESCENDING),
+                      ('priority', pymongo.DESCENDING),
+                      ('_id', pymongo.ASCENDING)])]
+
+        # The first page should only claim its own tasks.
+        resp = self.get(url + '?max_tasks=3', auth_token=self.mngr_token)
+        page_ids = [ObjectId(t['_id']) for t in resp.json['depsgraph']]
+        self.assertEqual(expected_order[:3], page_ids)
+        for task_id in expected_order[:3]:
+            self.assert_task_status(task_id, 'claimed-by-manager')
+        for task_id in expected_order[3:]:
+            self.assert_task_status(task_id, 'queued')
+
+        # Page through the rest using the header.
+        seen_ids = page_ids
+        while 'X-Flamenco-Next-Page-After' in resp.headers:
+            resp = self.get(url, auth_token=self.mngr_token,
+                            headers={'X-Flamenco-Max-Tasks': '3',
+                                     'X-Flamenco-Page-After':
+                                         resp.headers['X-Flamenco-Next-Page-After']})
+            if resp.status_code == 204:
+                break
+            seen_ids.extend(ObjectId(t['_id']) for t in resp.json['depsgraph'])
+        self.assertEqual(expected_order, seen_ids)
+
+        self.get(url + '?max_tasks=0', auth_token=self.mngr_token, expected_status=400)
+        self.get(url, auth_token=self.mngr_token,
+                 headers={'X-Flamenco-Max-Tasks': '3', 'X-Flamenco-Page-After': 'hey'},
+                 expected_status=400)
+
+    def test_get_command_blocks(self):
+        url = '/api/flamenco/managers/%s/depsgraph' % self.mngr_id
+        resp = self.get(url, auth_token=self.mngr_token,
+                        headers={'X-Flamenco-Command-Blocks': ''})
+        blocks = resp.json['command_blocks']
+
+        # All tasks of these sleep jobs share the same commands.
+        self.assertEqual(2, len(blocks))
+        with self.app.test_request_context():
+            db_tasks = {str(t['_id']): t for t in self.flamenco.db('tasks').find()}
+        for task in resp.json['depsgraph']:
+            restored = [{'name': blocks[cmd['block']]['name'],
+                         'settings': dict(blocks[cmd['block']]['settings'], **cmd['settings'])}
+                        for cmd in task['commands']]
+            self.assertEqual(db_tasks[task['_id']]['commands'], restored)
+
+        # Known blocks should not be sent again.
+        resp = self.get(url, auth_token=self.mngr_token,
+                        headers={'X-Flamenco-Command-Blocks': ', '.join(blocks.keys())})
+        self.assertEqual({}, resp.json['command_blocks'])
+        self.assertEqual(8, len(resp.json['depsgraph']))
+
+    def test_get_expanded_command_templates(self):
+        from pillar.api.utils.authentication import force_cli_user
+
+        with self.app.test_request_context():
+            force_cli_user()
+            job = self.jmngr.api_create_job(
+                'render job',
+                'Wörk wørk w°rk.',
+                'blender-render',
+                {
+                    'blender_cmd': '{blender}',
+                    'filepath': '/my/blend.file',
+                    'frames': '1-6',
+                    'chunk_size': 2,
+                    'render_output': '/render/out/####',
+                },
+                self.proj_id,
+                ctd.EXAMPLE_PROJECT_OWNER_ID,
+                self.mngr_id,
+            )
+            db_job = self.flamenco.db('jobs').find_one(job['_id'])
+            db_tasks = list(self.flamenco.db('tasks').find({'task_type': 'blender-render',
+                                                            'job': job['_id']}))
+
+        # The tasks should only store their frames, and refer to the job's template.
+        self.assertEqual(1, len(db_job['command_templates']))
+        template_key = next(iter(db_job['command_templates']))
+        self.assertEqual(3, len(db_tasks))
+        for task in db_tasks:
+            self.assertEqual(template_key, task['commands'][0]['template'])
+            self.assertEqual({'frames'}, set(task['commands'][0]['settings']))
+
+        resp = self.get('/api/flamenco/managers/%s/depsgraph' % self.mngr_id,
+                        auth_token=self.mngr_token)
+        render_tasks = {task['name']: task for task in resp.json['depsgraph']
+                        if task['job'] == str(job['_id'])
+                        and task['task_type'] == 'blender-render'}
+        self.assertEqual(3, len(render_tasks))
+        cmd = render_tasks['blender-render-1-2']['commands'][0]
+        self.assertEqual('blender_render', cmd['name'])
+        self.assertEqual('1..2', cmd['settings']['frames'])
+        self.assertEqual('/my/blend.file', cmd['settings']['filepath'])
+        self.assertEqual('{blender}', cmd['settings']['blender_cmd'])
@@ -15,6 +15,17 @@ class FrameRangeTest(unittest.TestCase):
         self.assertEqual([0, 531443, 5315886, 9999993414, 9999993415, 9999993416],
                          frame_range_parse('0,531443,    5315886,  9999993414 - 9999993416'))
 
+    def test_frame_range_count(self):
+        from flamenco.utils import frame_range_count
+
+        self.assertEqual(0, frame_range_count(None))
+        self.assertEqual(0, frame_range_count(''))
+        self.assertEqual(1, frame_range_count('1'))
+        self.assertEqual(4, frame_range_count('1, 2-4'))
+        self.assertEqual(0, frame_range_count('4-1'))
+        self.assertEqual(100000000, frame_range_count('1-100000000'))
+        self.assertEqual(6, frame_range_count('0,531443,    5315886,  9999993414 - 9999993416'))
+
     def test_frame_range_merge(self):
         from flamenco.utils import frame_range_merge
 
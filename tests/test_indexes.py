@@ -0,0 +1,33 @@
+from abstract_flamenco_test import AbstractFlamencoTest
+
+
+class IndexesTest(AbstractFlamencoTest):
+    def test_indexes_created(self):
+        from flamenco import indexes
+
+        with self.app.app_context():
+            db = self.app.db()
+            self.assertEqual([], indexes.missing_indexes(db))
+            self.assertEqual([], indexes.obsolete_indexes(db))
+
+    def test_hot_queries_use_index(self):
+        from flamenco import indexes
+
+        with self.app.app_context():
+            db = self.app.db()
+            indexes.create_indexes(db)
+
+            for query in indexes.hot_queries():
+                stages = indexes.explain(db, query)
+                self.assertNotIn('COLLSCAN', stages,
+                                 f'Hot query {query.name!r} does not use an index: {stages}')
+                self.assertIn('IXSCAN', stages, f'Hot query {query.name!r}: {stages}')
+
+    def test_plan_stages(self):
+        from flamenco.indexes import plan_stages
+
+        plan = {'stage': 'FETCH',
+                'inputStage': {'stage': 'OR',
+                               'inputStages': [{'stage': 'IXSCAN'},
+                                               {'stage': 'COLLSCAN'}]}}
+        self.assertEqual({'FETCH', 'OR', 'IXSCAN', 'COLLSCAN'}, plan_stages(plan))
@@ -53,9 +53,12 @@ class SleepSimpleTest(unittest.TestCase):
     def _expect_create_task_calls(self, task_manager, job_doc):
         from flamenco.job_compilers import commands
 
-        task_manager.api_create_task.assert_has_calls([
+        # The tasks should be created in bulk, and all be inserted before the status flip.
+        task_manager.task_buffer.assert_called_once_with(job_doc)
+        task_manager.task_buffer.return_value.flush.assert_called_once_with()
+
+        task_manager.task_buffer.return_value.create_task.assert_has_calls([
             mock.call(
-                job_doc,
                 [
                     commands.Echo(message='Preparing to sleep'),
                     commands.Sleep(time_in_seconds=3),
@@ -65,7 +68,6 @@ class SleepSimpleTest(unittest.TestCase):
                 task_type='sleep',
             ),
             mock.call(
-                job_doc,
                 [
                     commands.Echo(message='Preparing to sleep'),
                     commands.Sleep(time_in_seconds=3),
@@ -75,7 +77,6 @@ class SleepSimpleTest(unittest.TestCase):
                 task_type='sleep',
             ),
             mock.call(
-                job_doc,
                 [
                     commands.Echo(message='Preparing to sleep'),
                     commands.Sleep(time_in_seconds=3),
@@ -179,16 +180,15 @@ class BlenderRenderTest(unittest.TestCase):
         # - 1 move-to-final task
         # so that's 4 tasks in total.
         task_ids = [ObjectId() for _ in range(4)]
-        task_manager.api_create_task.side_effect = task_ids
+        task_manager.task_buffer.return_value.create_task.side_effect = task_ids
 
         compiler = blender_render.BlenderRender(
             task_manager=task_manager, job_manager=job_manager)
         compiler.compile(job_doc)
 
-        task_manager.api_create_task.assert_has_calls([
+        task_manager.task_buffer.return_value.create_task.assert_has_calls([
             # Render tasks
             mock.call(
-                job_doc,
                 [commands.BlenderRender(
                     blender_cmd='/path/to/blender --enable-new-depsgraph',
                     filepath='/agent327/scenes/someshot/somefile.blend',
@@ -200,7 +200,6 @@ class BlenderRenderTest(unittest.TestCase):
                 task_type='blender-render',
             ),
             mock.call(
-                job_doc,
                 [commands.BlenderRender(
                     blender_cmd='/path/to/blender --enable-new-depsgraph',
                     filepath='/agent327/scenes/someshot/somefile.blend',
@@ -212,7 +211,6 @@ class BlenderRenderTest(unittest.TestCase):
                 task_type='blender-render',
             ),
             mock.call(
-                job_doc,
                 [commands.BlenderRender(
                     blender_cmd='/path/to/blender --enable-new-depsgraph',
                     filepath='/agent327/scenes/someshot/somefile.blend',
@@ -226,7 +224,6 @@ class BlenderRenderTest(unittest.TestCase):
 
             # Move to final location
             mock.call(
-                job_doc,
                 [commands.MoveToFinal(
                     src='/render/out__intermediate-2018-07-06_115233',
                     dest='/render/out')],
@@ -241,6 +238,93 @@ class BlenderRenderTest(unittest.TestCase):
             job_doc['_id'], 'under-construction', 'queued', now=mock_now)
         job_manager.api_set_job_status(job_doc['_id'], 'under-construction', 'queued', now=mock_now)
 
+    @mock.patch('datetime.datetime')
+    def test_windowed_job(self, mock_datetime):
+        from flamenco.job_compilers import blender_render
+
+        job_doc = JobDocForTesting({
+            '_id': ObjectId(24 * 'f'),
+            '_created': self.created,
+            'settings': {
+                'frames': '1-5',
+                'chunk_size': 2,
+                'render_output': '/render/out/frames-######',
+                'format': 'EXR',
+                'filepath': '/agent327/scenes/someshot/somefile.blend',
+                'blender_cmd': '/path/to/blender --enable-new-depsgraph',
+            },
+            'job_type': 'blender-render',
+        })
+
+        task_manager = mock.Mock()
+        job_manager = mock.Mock()
+        mock_datetime.now.side_effect = [datetime.datetime.now(tz=tz_util.utc)]
+
+        task_ids = [ObjectId() for _ in range(4)]
+        create_task = task_manager.task_buffer.return_value.create_task
+        create_task.side_effect = task_ids
+
+        compiler = blender_render.BlenderRender(
+            task_manager=task_manager, job_manager=job_manager, window_size=2)
+
+        # The first window only contains render tasks, and is flipped to queued.
+        compiler.compile(job_doc)
+        self.assertEqual(['blender-render-1,2', 'blender-render-3,4'],
+                         [call[0][1] for call in create_task.call_args_list])
+        job_manager.api_set_compile_cursor.assert_called_once_with(job_doc['_id'], 2)
+        task_manager.api_set_task_status_for_job.assert_called_once()
+
+        # The last window contains the move-to-final task, which depends on all render tasks.
+        create_task.reset_mock()
+        task_manager.api_task_ids_for_job.return_value = task_ids[0:2]
+        self.assertIsNone(compiler.compile_window(job_doc, 2))
+
+        self.assertEqual(['blender-render-5', 'move-to-final'],
+                         [call[0][1] for call in create_task.call_args_list])
+        self.assertEqual({'queued'}, {call[1]['status'] for call in create_task.call_args_list})
+        self.assertEqual(task_ids[0:3], create_task.call_args_list[1][1]['parents'])
+        task_manager.api_task_ids_for_job.assert_called_once_with(
+            job_doc['_id'], task_type='blender-render')
+
+
+    def test_dry_run(self):
+        from flamenco.job_compilers import blender_render
+
+        job_doc = JobDocForTesting({
+            '_id': ObjectId(24 * 'f'),
+            '_created': self.created,
+            'settings': {
+                'frames': '1-5',
+                'chunk_size': 2,
+                'render_output': '/render/out/frames-######',
+                'format': 'EXR',
+                'filepath': '/agent327/scenes/someshot/somefile.blend',
+                'blender_cmd': '/path/to/blender --enable-new-depsgraph',
+            },
+            'job_type': 'blender-render',
+        })
+
+        task_manager = mock.Mock()
+        task_manager.task_document.return_value = {'name': 'some-task'}
+        job_manager = mock.Mock()
+
+        compiler = blender_render.BlenderRender(
+            task_manager=task_manager, job_manager=job_manager, window_size=1)
+        stats = compiler.dry_run(job_doc)
+
+        self.assertEqual(4, stats.task_count)
+        self.assertEqual({'blender-render': 3, 'file-management': 1}, stats.task_types)
+        self.assertEqual(2, stats.critical_path_length)
+        self.assertEqual(3, stats.max_fan_in)
+        self.assertEqual(1, stats.max_fan_out)
+        self.assertGreater(stats.document_size, 0)
+
+        # Nothing should have touched the database.
+        task_manager.task_buffer.assert_not_called()
+        task_manager.api_set_task_status_for_job.assert_not_called()
+        job_manager.api_set_job_status.assert_not_called()
+        self.assertEqual(1, compiler.window_size)
+
 
 class BlenderRenderProgressiveTest(unittest.TestCase):
     def setUp(self):
@@ -302,16 +386,15 @@ class BlenderRenderProgressiveTest(unittest.TestCase):
         mock_datetime.now.side_effect = [mock_now]
 
         task_ids = [ObjectId() for _ in range(17)]
-        task_manager.api_create_task.side_effect = task_ids
+        task_manager.task_buffer.return_value.create_task.side_effect = task_ids
 
         compiler = blender_render_progressive.BlenderRenderProgressive(
             task_manager=task_manager, job_manager=job_manager)
         compiler.compile(job_doc)
 
-        task_manager.api_create_task.assert_has_calls([
+        task_manager.task_buffer.return_value.create_task.assert_has_calls([
             # Pre-existing intermediate directory is destroyed.
             mock.call(  # task 0
-                job_doc,
                 [commands.RemoveTree(path='/render/out__intermediate-2018-07-06_115233')],
                 'destroy-preexisting-intermediate',
                 status='under-construction',
@@ -320,7 +403,6 @@ class BlenderRenderProgressiveTest(unittest.TestCase):
 
             # First Cycles chunk goes into intermediate directory
             mock.call(  # task 1
-                job_doc,
                 [commands.BlenderRenderProgressive(
                     blender_cmd='/path/to/blender --enable-new-depsgraph',
                     filepath='/agent327/scenes/someshot/somefile.blend',
@@ -338,7 +420,6 @@ class BlenderRenderProgressiveTest(unittest.TestCase):
                 task_type='blender-render',
             ),
             mock.call(  # task 2
-                job_doc,
                 [commands.BlenderRenderProgressive(
                     blender_cmd='/path/to/blender --enable-new-depsgraph',
                     filepath='/agent327/scenes/someshot/somefile.blend',
@@ -356,7 +437,6 @@ class BlenderRenderProgressiveTest(unittest.TestCase):
                 task_type='blender-render',
             ),
             mock.call(  # task 3
-                job_doc,
                 [commands.BlenderRenderProgressive(
                     blender_cmd='/path/to/blender --enable-new-depsgraph',
                     filepath='/agent327/scenes/someshot/somefile.blend',
@@ -377,29 +457,16 @@ class BlenderRenderProgressiveTest(unittest.TestCase):
             # Pre-existing render output dir is moved aside, and intermediate is destroyed.
             # Copy first sample chunk of frames to the output directory.
             mock.call(  # task 4
-                job_doc,
                 [
                     commands.MoveOutOfWay(src='/render/out'),
-                    commands.CopyFile(
-                        src='/render/out__intermediate-2018-07-06_115233/render-smpl-0001-0010-frm-000001.exr',
-                        dest='/render/out/frames-000001.exr',
-                    ),
-                    commands.CopyFile(
-                        src='/render/out__intermediate-2018-07-06_115233/render-smpl-0001-0010-frm-000002.exr',
-                        dest='/render/out/frames-000002.exr',
-                    ),
-                    commands.CopyFile(
-                        src='/render/out__intermediate-2018-07-06_115233/render-smpl-0001-0010-frm-000003.exr',
-                        dest='/render/out/frames-000003.exr',
-                    ),
-                    commands.CopyFile(
-                        src='/render/out__intermediate-2018-07-06_115233/render-smpl-0001-0010-frm-000004.exr',
-                        dest='/render/out/frames-000004.exr',
-                    ),
-                    commands.CopyFile(
-                        src='/render/out__intermediate-2018-07-06_115233/render-smpl-0001-0010-frm-000005.exr',
-                        dest='/render/out/frames-000005.exr',
-                    ),
+                    *[commands.ForFrame(
+                        commands.CopyFile(
+                            src='/render/out__intermediate-2018-07-06_115233/render-smpl-0001-0010-frm-%06i.exr',
+                            dest='/render/out/frames-%06i.exr',
+                        ),
+                        frozenset({'src', 'dest'}),
+                        frame,
+                    ) for frame in range(1, 6)],
                 ],
                 'publish-first-chunk',
                 parents=task_ids[1:4],
@@ -409,7 +476,6 @@ class BlenderRenderProgressiveTest(unittest.TestCase):
 
             # Second Cycles chunk renders to intermediate directory.
             mock.call(  # task 5
-                job_doc,
                 [commands.BlenderRenderProgressive(
                     blender_cmd='/path/to/blender --enable-new-depsgraph',
                     filepath='/agent327/scenes/someshot/somefile.blend',
@@ -427,7 +493,6 @@ class BlenderRenderProgressiveTest(unittest.TestCase):
                 task_type='blender-render',
             ),
             mock.call(  # task 6
-                job_doc,
                 [commands.BlenderRenderProgressive(
                     blender_cmd='/path/to/blender --enable-new-depsgraph',
                     filepath='/agent327/scenes/someshot/somefile.blend',
@@ -445,7 +510,6 @@ class BlenderRenderProgressiveTest(unittest.TestCase):
                 task_type='blender-render',
             ),
             mock.call(  # task 7
-                job_doc,
                 [commands.BlenderRenderProgressive(
                     blender_cmd='/path/to/blender --enable-new-depsgraph',
                     filepath='/agent327/scenes/someshot/somefile.blend',
@@ -465,29 +529,44 @@ class BlenderRenderProgressiveTest(unittest.TestCase):
 
             # First merge pass, outputs to intermediate directory and copies to output dir
             mock.call(  # task 8
-                job_doc,
                 [
-                    commands.MergeProgressiveRenders(
-                        input1='/render/out__intermediate-2018-07-06_115233/render-smpl-0001-0010-frm-000001.exr',
-                        input2='/render/out__intermediate-2018-07-06_115233/render-smpl-0011-0020-frm-000001.exr',
-                        output='/render/out__intermediate-2018-07-06_115233/merge-smpl-0020-frm-000001.exr',
-                        weight1=10,
-                        weight2=10,
+                    commands.ForFrame(
+                        commands.MergeProgressiveRenders(
+                            input1='/render/out__intermediate-2018-07-06_115233/render-smpl-0001-0010-frm-%06i.exr',
+                            input2='/render/out__intermediate-2018-07-06_115233/render-smpl-0011-0020-frm-%06i.exr',
+                            output='/render/out__intermediate-2018-07-06_115233/merge-smpl-0020-frm-%06i.exr',
+                            weight1=10,
+                            weight2=10,
+                        ),
+                        frozenset({'input1', 'input2', 'output'}),
+                        1,
                     ),
-                    commands.CopyFile(
-                        src='/render/out__intermediate-2018-07-06_115233/merge-smpl-0020-frm-000001.exr',
-                        dest='/render/out/frames-000001.exr',
+                    commands.ForFrame(
+                        commands.CopyFile(
+                            src='/render/out__intermediate-2018-07-06_115233/merge-smpl-0020-frm-%06i.exr',
+                            dest='/render/out/frames-%06i.exr',
+                        ),
+                        frozenset({'src', 'dest'}),
+                        1,
                     ),
-                    commands.MergeProgressiveRenders(
-                        input1='/render/out__intermediate-2018-07-06_115233/render-smpl-0001-0010-frm-000002.exr',
-                        input2='/render/out__intermediate-2018-07-06_115233/render-smpl-0011-0020-frm-000002.exr',
-                        output='/render/out__intermediate-2018-07-06_115233/merge-smpl-0020-frm-000002.exr',
-                        weight1=10,
-                        weight2=10,
+                    commands.ForFrame(
+                        commands.MergeProgressiveRenders(
+                            input1='/render/out__intermediate-2018-07-06_115233/render-smpl-0001-0010-frm-%06i.exr',
+                            input2='/render/out__intermediate-2018-07-06_115233/render-smpl-0011-0020-frm-%06i.exr',
+                            output='/render/out__intermediate-2018-07-06_115233/merge-smpl-0020-frm-%06i.exr',
+                            weight1=10,
+                            weight2=10,
+                        ),
+                        frozenset({'input1', 'input2', 'output'}),
+                        2,
                     ),
-                    commands.CopyFile(
-                        src='/render/out__intermediate-2018-07-06_115233/merge-smpl-0020-frm-000002.exr',
-                        dest='/render/out/frames-000002.exr',
+                    commands.ForFrame(
+                        commands.CopyFile(
+                            src='/render/out__intermediate-2018-07-06_115233/merge-smpl-0020-frm-%06i.exr',
+                            dest='/render/out/frames-%06i.exr',
+                        ),
+                        frozenset({'src', 'dest'}),
+                        2,
                     ),
                 ],
                 'merge-to-smpl20-frm1,2',
@@ -497,29 +576,44 @@ class BlenderRenderProgressiveTest(unittest.TestCase):
                 task_type='exr-merge',
             ),
             mock.call(  # task 9
-                job_doc,
                 [
-                    commands.MergeProgressiveRenders(
-                        input1='/render/out__intermediate-2018-07-06_115233/render-smpl-0001-0010-frm-000003.exr',
-                        input2='/render/out__intermediate-2018-07-06_115233/render-smpl-0011-0020-frm-000003.exr',
-                        output='/render/out__intermediate-2018-07-06_115233/merge-smpl-0020-frm-000003.exr',
-                        weight1=10,
-                        weight2=10,
+                    commands.ForFrame(
+                        commands.MergeProgressiveRenders(
+                            input1='/render/out__intermediate-2018-07-06_115233/render-smpl-0001-0010-frm-%06i.exr',
+                            input2='/render/out__intermediate-2018-07-06_115233/render-smpl-0011-0020-frm-%06i.exr',
+                            output='/render/out__intermediate-2018-07-06_115233/merge-smpl-0020-frm-%06i.exr',
+                            weight1=10,
+                            weight2=10,
+                        ),
+                        frozenset({'input1', 'input2', 'output'}),
+                        3,
                     ),
-                    commands.CopyFile(
-                        src='/render/out__intermediate-2018-07-06_115233/merge-smpl-0020-frm-000003.exr',
-                        dest='/render/out/frames-000003.exr',
+                    commands.ForFrame(
+                        commands.CopyFile(
+                            src='/render/out__intermediate-2018-07-06_115233/merge-smpl-0020-frm-%06i.exr',
+                            dest='/render/out/frames-%06i.exr',
+                        ),
+                        frozenset({'src', 'dest'}),
+                        3,
                     ),
-                    commands.MergeProgressiveRenders(
-                        input1='/render/out__intermediate-2018-07-06_115233/render-smpl-0001-0010-frm-000004.exr',
-                        input2='/render/out__intermediate-2018-07-06_115233/render-smpl-0011-0020-frm-000004.exr',
-                        output='/render/out__intermediate-2018-07-06_115233/merge-smpl-0020-frm-000004.exr',
-                        weight1=10,
-                        weight2=10,
+                    commands.ForFrame(
+                        commands.MergeProgressiveRenders(
+                            input1='/render/out__intermediate-2018-07-06_115233/render-smpl-0001-0010-frm-%06i.exr',
+                            input2='/render/out__intermediate-2018-07-06_115233/render-smpl-0011-0020-frm-%06i.exr',
+                            output='/render/out__intermediate-2018-07-06_115233/merge-smpl-0020-frm-%06i.exr',
+                            weight1=10,
+                            weight2=10,
+                        ),
+                        frozenset({'input1', 'input2', 'output'}),
+                        4,
                     ),
-                    commands.CopyFile(
-                        src='/render/out__intermediate-2018-07-06_115233/merge-smpl-0020-frm-000004.exr',
-                        dest='/render/out/frames-000004.exr',
+                    commands.ForFrame(
+                        commands.CopyFile(
+                            src='/render/out__intermediate-2018-07-06_115233/merge-smpl-0020-frm-%06i.exr',
+                            dest='/render/out/frames-%06i.exr',
+                        ),
+                        frozenset({'src', 'dest'}),
+                        4,
                     ),
                 ],
                 'merge-to-smpl20-frm3,4',
@@ -529,18 +623,25 @@ class BlenderRenderProgressiveTest(unittest.TestCase):
                 task_type='exr-merge',
             ),
             mock.call(  # task 10
-                job_doc,
                 [
-                    commands.MergeProgressiveRenders(
-                        input1='/render/out__intermediate-2018-07-06_115233/render-smpl-0001-0010-frm-000005.exr',
-                        input2='/render/out__intermediate-2018-07-06_115233/render-smpl-0011-0020-frm-000005.exr',
-                        output='/render/out__intermediate-2018-07-06_115233/merge-smpl-0020-frm-000005.exr',
-                        weight1=10,
-                        weight2=10,
+                    commands.ForFrame(
+                        commands.MergeProgressiveRenders(
+                            input1='/render/out__intermediate-2018-07-06_115233/render-smpl-0001-0010-frm-%06i.exr',
+                            input2='/render/out__intermediate-2018-07-06_115233/render-smpl-0011-0020-frm-%06i.exr',
+                            output='/render/out__intermediate-2018-07-06_115233/merge-smpl-0020-frm-%06i.exr',
+                            weight1=10,
+                            weight2=10,
+                        ),
+                        frozenset({'input1', 'input2', 'output'}),
+                        5,
                     ),
-                    commands.CopyFile(
-                        src='/render/out__intermediate-2018-07-06_115233/merge-smpl-0020-frm-000005.exr',
-                        dest='/render/out/frames-000005.exr',
+                    commands.ForFrame(
+                        commands.CopyFile(
+                            src='/render/out__intermediate-2018-07-06_115233/merge-smpl-0020-frm-%06i.exr',
+                            dest='/render/out/frames-%06i.exr',
+                        ),
+                        frozenset({'src', 'dest'}),
+                        5,
                     ),
                 ],
                 'merge-to-smpl20-frm5',
@@ -552,7 +653,6 @@ class BlenderRenderProgressiveTest(unittest.TestCase):
 
             # Third Cycles chunk renders to intermediate directory.
             mock.call(  # task 11
-                job_doc,
                 [commands.BlenderRenderProgressive(
                     blender_cmd='/path/to/blender --enable-new-depsgraph',
                     filepath='/agent327/scenes/someshot/somefile.blend',
@@ -570,7 +670,6 @@ class BlenderRenderProgressiveTest(unittest.TestCase):
                 task_type='blender-render',
             ),
             mock.call(  # task 12
-                job_doc,
                 [commands.BlenderRenderProgressive(
                     blender_cmd='/path/to/blender --enable-new-depsgraph',
                     filepath='/agent327/scenes/someshot/somefile.blend',
@@ -588,7 +687,6 @@ class BlenderRenderProgressiveTest(unittest.TestCase):
                 task_type='blender-render',
             ),
             mock.call(  # task 13
-                job_doc,
                 [commands.BlenderRenderProgressive(
                     blender_cmd='/path/to/blender --enable-new-depsgraph',
                     filepath='/agent327/scenes/someshot/somefile.blend',
@@ -610,29 +708,44 @@ class BlenderRenderProgressiveTest(unittest.TestCase):
             # intermediate directory shows a complete picture (pun intended), we take a similar
             # approach as earlier merge passes.
             mock.call(  # task 14
-                job_doc,
                 [
-                    commands.MergeProgressiveRenders(
-                        input1='/render/out__intermediate-2018-07-06_115233/merge-smpl-0020-frm-000001.exr',
-                        input2='/render/out__intermediate-2018-07-06_115233/render-smpl-0021-0030-frm-000001.exr',
-                        output='/render/out__intermediate-2018-07-06_115233/merge-smpl-0030-frm-000001.exr',
-                        weight1=20,
-                        weight2=10,
+                    commands.ForFrame(
+                        commands.MergeProgressiveRenders(
+                            input1='/render/out__intermediate-2018-07-06_115233/merge-smpl-0020-frm-%06i.exr',
+                            input2='/render/out__intermediate-2018-07-06_115233/render-smpl-0021-0030-frm-%06i.exr',
+                            output='/render/out__intermediate-2018-07-06_115233/merge-smpl-0030-frm-%06i.exr',
+                            weight1=20,
+                            weight2=10,
+                        ),
+                        frozenset({'input1', 'input2', 'output'}),
+                        1,
                     ),
-                    commands.CopyFile(
-                        src='/render/out__intermediate-2018-07-06_115233/merge-smpl-0030-frm-000001.exr',
-                        dest='/render/out/frames-000001.exr',
+                    commands.ForFrame(
+                        commands.CopyFile(
+                            src='/render/out__intermediate-2018-07-06_115233/merge-smpl-0030-frm-%06i.exr',
+                            dest='/render/out/frames-%06i.exr',
+                        ),
+                        frozenset({'src', 'dest'}),
+                        1,
                     ),
-                    commands.MergeProgressiveRenders(
-                        input1='/render/out__intermediate-2018-07-06_115233/merge-smpl-0020-frm-000002.exr',
-                        input2='/render/out__intermediate-2018-07-06_115233/render-smpl-0021-0030-frm-000002.exr',
-                        output='/render/out__intermediate-2018-07-06_115233/merge-smpl-0030-frm-000002.exr',
-                        weight1=20,
-                        weight2=10,
+                    commands.ForFrame(
+                        commands.MergeProgressiveRenders(
+                            input1='/render/out__intermediate-2018-07-06_115233/merge-smpl-0020-frm-%06i.exr',
+                            input2='/render/out__intermediate-2018-07-06_115233/render-smpl-0021-0030-frm-%06i.exr',
+                            output='/render/out__intermediate-2018-07-06_115233/merge-smpl-0030-frm-%06i.exr',
+                            weight1=20,
+                            weight2=10,
+                        ),
+                        frozenset({'input1', 'input2', 'output'}),
+                        2,
                     ),
-                    commands.CopyFile(
-                        src='/render/out__intermediate-2018-07-06_115233/merge-smpl-0030-frm-000002.exr',
-                        dest='/render/out/frames-000002.exr',
+                    commands.ForFrame(
+                        commands.CopyFile(
+                            src='/render/out__intermediate-2018-07-06_115233/merge-smpl-0030-frm-%06i.exr',
+                            dest='/render/out/frames-%06i.exr',
+                        ),
+                        frozenset({'src', 'dest'}),
+                        2,
                     ),
                 ],
                 'merge-to-smpl30-frm1,2',
@@ -642,29 +755,44 @@ class BlenderRenderProgressiveTest(unittest.TestCase):
                 task_type='exr-merge',
             ),
             mock.call(  # task 15
-                job_doc,
                 [
-                    commands.MergeProgressiveRenders(
-                        input1='/render/out__intermediate-2018-07-06_115233/merge-smpl-0020-frm-000003.exr',
-                        input2='/render/out__intermediate-2018-07-06_115233/render-smpl-0021-0030-frm-000003.exr',
-                        output='/render/out__intermediate-2018-07-06_115233/merge-smpl-0030-frm-000003.exr',
-                        weight1=20,
-                        weight2=10,
+                    commands.ForFrame(
+                        commands.MergeProgressiveRenders(
+                            input1='/render/out__intermediate-2018-07-06_115233/merge-smpl-0020-frm-%06i.exr',
+                            input2='/render/out__intermediate-2018-07-06_115233/render-smpl-0021-0030-frm-%06i.exr',
+                            output='/render/out__intermediate-2018-07-06_115233/merge-smpl-0030-frm-%06i.exr',
+                            weight1=20,
+                            weight2=10,
+                        ),
+                        frozenset({'input1', 'input2', 'output'}),
+                        3,
                     ),
-                    commands.CopyFile(
-                        src='/render/out__intermediate-2018-07-06_115233/merge-smpl-0030-frm-000003.exr',
-                        dest='/render/out/frames-000003.exr',
+                    commands.ForFrame(
+                        commands.CopyFile(
+                            src='/render/out__intermediate-2018-07-06_115233/merge-smpl-0030-frm-%06i.exr',
+                            dest='/render/out/frames-%06i.exr',
+                        ),
+                        frozenset({'src', 'dest'}),
+                        3,
                     ),
-                    commands.MergeProgressiveRenders(
-                        input1='/render/out__intermediate-2018-07-06_115233/merge-smpl-0020-frm-000004.exr',
-                        input2='/render/out__intermediate-2018-07-06_115233/render-smpl-0021-0030-frm-000004.exr',
-                        output='/render/out__intermediate-2018-07-06_115233/merge-smpl-0030-frm-000004.exr',
-                        weight1=20,
-                        weight2=10,
+                    commands.ForFrame(
+                        commands.MergeProgressiveRenders(
+                            input1='/render/out__intermediate-2018-07-06_115233/merge-smpl-0020-frm-%06i.exr',
+                            input2='/render/out__intermediate-2018-07-06_115233/render-smpl-0021-0030-frm-%06i.exr',
+                            output='/render/out__intermediate-2018-07-06_115233/merge-smpl-0030-frm-%06i.exr',
+                            weight1=20,
+                            weight2=10,
+                        ),
+                        frozenset({'input1', 'input2', 'output'}),
+                        4,
                     ),
-                    commands.CopyFile(
-                        src='/render/out__intermediate-2018-07-06_115233/merge-smpl-0030-frm-000004.exr',
-                        dest='/render/out/frames-000004.exr',
+                    commands.ForFrame(
+                        commands.CopyFile(
+                            src='/render/out__intermediate-2018-07-06_115233/merge-smpl-0030-frm-%06i.exr',
+                            dest='/render/out/frames-%06i.exr',
+                        ),
+                        frozenset({'src', 'dest'}),
+                        4,
                     ),
                 ],
                 'merge-to-smpl30-frm3,4',
@@ -674,18 +802,25 @@ class BlenderRenderProgressiveTest(unittest.TestCase):
                 task_type='exr-merge',
             ),
             mock.call(  # task 16
-                job_doc,
                 [
-                    commands.MergeProgressiveRenders(
-                        input1='/render/out__intermediate-2018-07-06_115233/merge-smpl-0020-frm-000005.exr',
-                        input2='/render/out__intermediate-2018-07-06_115233/render-smpl-0021-0030-frm-000005.exr',
-                        output='/render/out__intermediate-2018-07-06_115233/merge-smpl-0030-frm-000005.exr',
-                        weight1=20,
-                        weight2=10,
+                    commands.ForFrame(
+                        commands.MergeProgressiveRenders(
+                            input1='/render/out__intermediate-2018-07-06_115233/merge-smpl-0020-frm-%06i.exr',
+                            input2='/render/out__intermediate-2018-07-06_115233/render-smpl-0021-0030-frm-%06i.exr',
+                            output='/render/out__intermediate-2018-07-06_115233/merge-smpl-0030-frm-%06i.exr',
+                            weight1=20,
+                            weight2=10,
+                        ),
+                        frozenset({'input1', 'input2', 'output'}),
+                        5,
                     ),
-                    commands.CopyFile(
-                        src='/render/out__intermediate-2018-07-06_115233/merge-smpl-0030-frm-000005.exr',
-                        dest='/render/out/frames-000005.exr',
+                    commands.ForFrame(
+                        commands.CopyFile(
+                            src='/render/out__intermediate-2018-07-06_115233/merge-smpl-0030-frm-%06i.exr',
+                            dest='/render/out/frames-%06i.exr',
+                        ),
+                        frozenset({'src', 'dest'}),
+                        5,
                     ),
                 ],
                 'merge-to-smpl30-frm5',
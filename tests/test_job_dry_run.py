@@ -0,0 +1,71 @@
+from unittest import mock
+
+from abstract_flamenco_test import AbstractFlamencoTest
+
+
+class JobDryRunTest(AbstractFlamencoTest):
+    def setUp(self, **kwargs):
+        super().setUp(**kwargs)
+
+        self.create_user(user_id=24 * 'f', roles={'flamenco-admin'}, token='fladmin-token')
+
+    def dry_run(self, job, expected_status=200):
+        return self.post('/api/flamenco/jobs/dry-run',
+                         auth_token='fladmin-token',
+                         json=job,
+                         expected_status=expected_status)
+
+    def test_dry_run(self):
+        stats = self.dry_run({
+            'job_type': 'blender-render',
+            'settings': {
+                'frames': '1-100000',
+                'chunk_size': 10,
+                'render_output': '/render/out/frames-######',
+                'format': 'EXR',
+                'filepath': '/agent327/scenes/someshot/somefile.blend',
+                'blender_cmd': '{blender}',
+            },
+        }).json
+
+        self.assertEqual(10001, stats['task_count'])
+        self.assertEqual({'blender-render': 10000, 'file-management': 1}, stats['task_types'])
+        self.assertEqual(2, stats['critical_path_length'])
+        self.assertEqual(10000, stats['max_fan_in'])
+        self.assertEqual(1, stats['max_fan_out'])
+        self.assertGreater(stats['document_size'], 10000 * 200)
+
+        with self.app.app_context():
+            self.assertEqual(0, self.flamenco.db('tasks').count())
+            self.assertEqual(0, self.flamenco.db('jobs').count())
+
+    def test_too_many_tasks(self):
+        settings = {
+            'frames': '1-100000000',
+            'chunk_size': 10,
+            'render_output': '/render/out/frames-######',
+            'format': 'EXR',
+            'filepath': '/agent327/scenes/someshot/somefile.blend',
+            'blender_cmd': '{blender}',
+        }
+
+        # Refused without listing all frames.
+        with mock.patch('flamenco.utils.frame_range_parse') as mock_parse:
+            self.dry_run({'job_type': 'blender-render', 'settings': settings},
+                         expected_status=422)
+        mock_parse.assert_not_called()
+
+        # Refused while compiling, as there is one more task than frame chunks.
+        self.app.config['FLAMENCO_DRY_RUN_MAX_TASKS'] = 10
+        self.dry_run({'job_type': 'blender-render', 'settings': {**settings, 'frames': '1-100'}},
+                     expected_status=422)
+
+    def test_bad_settings(self):
+        self.dry_run({'job_type': 'blender-render', 'settings': {'frames': '1-10'}},
+                     expected_status=422)
+        self.dry_run({'job_type': 'unknown', 'settings': {}}, expected_status=422)
+        self.dry_run({'job_type': 'sleep'}, expected_status=400)
+
+    def test_anonymous(self):
+        self.post('/api/flamenco/jobs/dry-run', json={'job_type': 'sleep', 'settings': {}},
+                  expected_status=403)
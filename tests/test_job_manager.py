@@ -66,6 +66,263 @@ class JobManagerTest(AbstractFlamencoTest):
                 }
             }, task['commands'][1])
 
+    def test_job_status_summary(self):
+        from pillar.api.utils.authentication import force_cli_user
+        from flamenco.jobs import ProjectSummary
+
+        self.assertEqual([('active', 75), ('queued', 25)],
+                         list(ProjectSummary({'queued': 1, 'active': 3}).percentages()))
+
+        manager, _, _ = self.create_manager_service_account()
+        with self.app.test_request_context():
+            force_cli_user()
+            job = self.jmngr.api_create_job(
+                'test job', 'Wörk wørk w°rk.', 'sleep',
+                {'frames': '12-18', 'chunk_size': 5, 'time_in_seconds': 3},
+                self.proj_id, ctd.EXAMPLE_PROJECT_OWNER_ID, manager['_id'],
+            )
+
+            summary = self.jmngr.job_status_summary(self.proj_id)
+            self.assertEqual([('queued', 100)], list(summary.percentages()))
+            self.assertEqual([], list(self.jmngr.job_status_summary(24 * 'f').percentages()))
+
+            # Changes made behind Flamenco's back are only seen after the cache expires.
+            jobs_coll = self.flamenco.db('jobs')
+            jobs_coll.update_one({'_id': job['_id']}, {'$set': {'status': 'paused'}})
+            summary = self.jmngr.job_status_summary(self.proj_id)
+            self.assertEqual([('queued', 100)], list(summary.percentages()))
+
+            # Job status changes invalidate the cache.
+            self.jmngr.api_set_job_status(job['_id'], 'active')
+            summary = self.jmngr.job_status_summary(self.proj_id)
+            self.assertEqual([('active', 100)], list(summary.percentages()))
+
+    def _create_job_in_background(self):
+        from pillar.api.utils.authentication import force_cli_user
+
+        self.app.config['FLAMENCO_COMPILE_IN_BACKGROUND'] = True
+        manager, _, _ = self.create_manager_service_account()
+
+        with self.app.test_request_context(), \
+                mock.patch('flamenco.celery.job_compilation.compile_job') as mock_compile:
+            force_cli_user()
+            job = self.jmngr.api_create_job(
+                'test job', 'Wörk wørk w°rk.', 'sleep',
+                {'frames': '12-18, 20-22', 'chunk_size': 5, 'time_in_seconds': 3},
+                self.proj_id, ctd.EXAMPLE_PROJECT_OWNER_ID, manager['_id'],
+            )
+        mock_compile.delay.assert_called_once_with(str(job['_id']))
+
+        with self.app.app_context():
+            db_job = self.flamenco.db('jobs').find_one(job['_id'])
+            self.assertEqual('under-construction', db_job['status'])
+            self.assertEqual(0, self.flamenco.db('tasks').count({'job': job['_id']}))
+        return job['_id']
+
+    def test_compile_in_background(self):
+        from flamenco.celery import job_compilation
+
+        job_id = self._create_job_in_background()
+        with self.app.app_context():
+            job_compilation.compile_job(str(job_id))
+
+            db_job = self.flamenco.db('jobs').find_one(job_id)
+            self.assertEqual('queued', db_job['status'])
+            self.assertEqual({'tasks_created': 2}, db_job['compilation'])
+            self.assertEqual(2, self.flamenco.db('tasks').count({'job': job_id}))
+
+    def test_compile_in_background_failure(self):
+        from flamenco.celery import job_compilation
+
+        job_id = self._create_job_in_background()
+        with self.app.app_context(), \
+                mock.patch('flamenco.job_compilers.compile_job') as mock_compile:
+            mock_compile.side_effect = KeyError('frames')
+            job_compilation.compile_job(str(job_id))
+
+            db_job = self.flamenco.db('jobs').find_one(job_id)
+            self.assertEqual('canceled', db_job['status'])
+            self.assertEqual("KeyError: 'frames'", db_job['compilation']['failure_reason'])
+
+    def test_compile_in_windows(self):
+        from pillar.api.utils.authentication import force_cli_user
+
+        self.app.config['FLAMENCO_COMPILE_WINDOW_SIZE'] = 2
+        self.app.config['FLAMENCO_COMPILE_LOW_WATER'] = 2
+        manager, _, _ = self.create_manager_service_account()
+
+        with self.app.test_request_context():
+            force_cli_user()
+            job = self.jmngr.api_create_job(
+                'test job', 'Wörk wørk w°rk.', 'sleep',
+                {'frames': '1-20', 'chunk_size': 5, 'time_in_seconds': 3},
+                self.proj_id, ctd.EXAMPLE_PROJECT_OWNER_ID, manager['_id'],
+            )
+            job_id = job['_id']
+            jobs_coll = self.flamenco.db('jobs')
+            tasks_coll = self.flamenco.db('tasks')
+
+            def complete_tasks():
+                for task in list(tasks_coll.find({'job': job_id, 'status': 'queued'})):
+                    self.flamenco.update_status('tasks', task['_id'], 'completed')
+                    self.jmngr.update_job_after_task_status_change(job_id, task['_id'],
+                                                                   'completed')
+
+            # Only the first window of 2 tasks has been created.
+            self.assertEqual(['sleep-1-5', 'sleep-6-10'],
+                             [task['name'] for task in tasks_coll.find({'job': job_id})])
+            db_job = jobs_coll.find_one(job_id)
+            self.assertEqual('queued', db_job['status'])
+            self.assertEqual(2, db_job['compilation']['cursor'])
+
+            # Completing tasks creates the next window, and does not complete the job.
+            complete_tasks()
+            self.assertEqual(4, tasks_coll.count({'job': job_id}))
+            self.assertEqual(2, tasks_coll.count({'job': job_id, 'status': 'queued'}))
+            db_job = jobs_coll.find_one(job_id)
+            self.assertEqual('active', db_job['status'])
+            self.assertNotIn('cursor', db_job['compilation'])
+            self.assertEqual(4, db_job['compilation']['tasks_created'])
+
+            complete_tasks()
+            self.assertEqual('completed', jobs_coll.find_one(job_id)['status'])
+
+    def test_compile_in_windows_paused(self):
+        from pillar.api.utils.authentication import force_cli_user
+
+        self.app.config['FLAMENCO_COMPILE_WINDOW_SIZE'] = 2
+        self.app.config['FLAMENCO_COMPILE_LOW_WATER'] = 2
+        manager, _, _ = self.create_manager_service_account()
+
+        with self.app.test_request_context():
+            force_cli_user()
+            job = self.jmngr.api_create_job(
+                'test job', 'Wörk wørk w°rk.', 'sleep',
+                {'frames': '1-20', 'chunk_size': 5, 'time_in_seconds': 3},
+                self.proj_id, ctd.EXAMPLE_PROJECT_OWNER_ID, manager['_id'],
+            )
+            job_id = job['_id']
+            jobs_coll = self.flamenco.db('jobs')
+            tasks_coll = self.flamenco.db('tasks')
+
+            # The tasks of the first window finish while the job is paused, which
+            # cannot create the next window.
+            self.jmngr.api_set_job_status(job_id, 'paused')
+            for task in list(tasks_coll.find({'job': job_id})):
+                self.flamenco.update_status('tasks', task['_id'], 'completed')
+                self.jmngr.update_job_after_task_status_change(job_id, task['_id'],
+                                                               'completed')
+            self.jmngr.api_recount_task_statuses([job_id])
+            self.assertEqual(2, tasks_coll.count({'job': job_id}))
+            db_job = jobs_coll.find_one(job_id)
+            self.assertEqual('paused', db_job['status'])
+            self.assertEqual(2, db_job['compilation']['cursor'])
+
+            # Requeueing the job should create the next window, rather than leaving
+            # the job queued without any tasks to run.
+            self.jmngr.api_set_job_status(job_id, 'requeued')
+            self.assertEqual(4, tasks_coll.count({'job': job_id}))
+            self.assertEqual(2, tasks_coll.count({'job': job_id, 'status': 'queued'}))
+            db_job = jobs_coll.find_one(job_id)
+            self.assertEqual('queued', db_job['status'])
+            self.assertNotIn('cursor', db_job['compilation'])
+
+    def test_compile_window_failure(self):
+        from pillar.api.utils.authentication import force_cli_user
+        from flamenco.tasks.buffer import TaskBuffer
+
+        self.app.config['FLAMENCO_COMPILE_WINDOW_SIZE'] = 2
+        self.app.config['FLAMENCO_COMPILE_LOW_WATER'] = 2
+        # Insert every task separately, so that a window fails after a flush.
+        self.app.config['FLAMENCO_TASK_INSERT_BATCH_SIZE'] = 1
+        manager, _, _ = self.create_manager_service_account()
+
+        with self.app.test_request_context():
+            force_cli_user()
+            job = self.jmngr.api_create_job(
+                'test job', 'Wörk wørk w°rk.', 'sleep',
+                {'frames': '1-20', 'chunk_size': 5, 'time_in_seconds': 3},
+                self.proj_id, ctd.EXAMPLE_PROJECT_OWNER_ID, manager['_id'],
+            )
+            job_id = job['_id']
+            jobs_coll = self.flamenco.db('jobs')
+            tasks_coll = self.flamenco.db('tasks')
+
+            self.jmngr.api_set_job_status(job_id, 'paused')
+            for task in list(tasks_coll.find({'job': job_id})):
+                self.flamenco.update_status('tasks', task['_id'], 'completed')
+            self.jmngr.api_recount_task_statuses([job_id])
+
+            # Resuming the job compiles the next window, which fails after its first task.
+            orig_create_task = TaskBuffer.create_task
+            created = []
+
+            def create_task(buffer, *args, **kwargs):
+                if created:
+                    raise ValueError('this is a test')
+                created.append(orig_create_task(buffer, *args, **kwargs))
+                return created[-1]
+
+            with mock.patch.object(TaskBuffer, 'create_task', autospec=True,
+                                   side_effect=create_task):
+                self.jmngr.api_set_job_status(job_id, 'queued')
+
+            self.assertEqual(1, len(created))
+            self.assertIsNone(tasks_coll.find_one(created[0]))
+            self.assertEqual(2, tasks_coll.count({'job': job_id}))
+            db_job = jobs_coll.find_one(job_id)
+            self.assertEqual('failed', db_job['status'])
+            self.assertEqual(2, db_job['compilation']['cursor'])
+            self.assertEqual(2, db_job['compilation']['tasks_created'])
+            self.assertEqual({'completed': 2}, self.jmngr.task_status_counts(job_id))
+
+            # Requeueing compiles the window again, without duplicate tasks.
+            self.jmngr.api_set_job_status(job_id, 'requeued')
+            self.assertEqual(['sleep-1-5', 'sleep-6-10', 'sleep-11-15', 'sleep-16-20'],
+                             sorted((task['name'] for task in tasks_coll.find({'job': job_id})),
+                                    key=lambda name: int(name.split('-')[1])))
+            self.assertEqual('queued', jobs_coll.find_one(job_id)['status'])
+
+
+    def test_compile_window_stale_claim(self):
+        import datetime
+        from bson import tz_util
+        from pillar.api.utils.authentication import force_cli_user
+
+        self.app.config['FLAMENCO_COMPILE_WINDOW_SIZE'] = 2
+        self.app.config['FLAMENCO_COMPILE_LOW_WATER'] = 2
+        manager, _, _ = self.create_manager_service_account()
+
+        with self.app.test_request_context():
+            force_cli_user()
+            job = self.jmngr.api_create_job(
+                'test job', 'Wörk wørk w°rk.', 'sleep',
+                {'frames': '1-20', 'chunk_size': 5, 'time_in_seconds': 3},
+                self.proj_id, ctd.EXAMPLE_PROJECT_OWNER_ID, manager['_id'],
+            )
+            job_id = job['_id']
+            jobs_coll = self.flamenco.db('jobs')
+            tasks_coll = self.flamenco.db('tasks')
+
+            # A fresh claim cannot be taken over.
+            self.assertIsNotNone(self.jmngr.api_claim_compile_window(job_id, 2))
+            self.assertIsNone(self.jmngr.api_claim_compile_window(job_id, 2))
+
+            # The process that claimed the window died long ago.
+            timeout = self.app.config['FLAMENCO_COMPILE_WINDOW_CLAIM_TIMEOUT']
+            long_ago = datetime.datetime.now(tz=tz_util.utc) - 2 * timeout
+            jobs_coll.update_one({'_id': job_id},
+                                 {'$set': {'compilation.window_claimed': long_ago}})
+
+            # Completing the tasks should compile the window regardless.
+            for task in list(tasks_coll.find({'job': job_id})):
+                self.flamenco.update_status('tasks', task['_id'], 'completed')
+                self.jmngr.update_job_after_task_status_change(job_id, task['_id'],
+                                                               'completed')
+            self.assertEqual(4, tasks_coll.count({'job': job_id}))
+            db_job = jobs_coll.find_one(job_id)
+            self.assertNotIn('cursor', db_job['compilation'])
+            self.assertNotIn('window_claimed', db_job['compilation'])
 
 class JobStatusChangeTest(AbstractFlamencoTest):
     def setUp(self, **kwargs):
@@ -223,6 +480,8 @@ class JobStatusChangeTest(AbstractFlamencoTest):
             # otherwise ignored by the tests.
             tasks_coll = self.app.db('flamenco_tasks')
             tasks_coll.update_many({'job': self.job_id}, {'$set': {'status': 'completed'}})
+            # Bypassing Flamenco also bypasses the task status counts, so rebuild those.
+            self.jmngr.api_recount_task_statuses([self.job_id])
         self.force_job_status('canceled')
 
         # This should re-queue all non-completed tasks, see that they are all
@@ -301,6 +560,160 @@ class JobStatusChangeTest(AbstractFlamencoTest):
 
         self.assert_job_status('canceled')
 
+    def test_plan_status_change(self):
+        # Planning happens in memory, based on the task status counts of the job.
+        job = {'_id': self.job_id, 'status': 'canceled', 'manager': None,
+               'task_status_counts': {'completed': 3, 'cancel-requested': 0}}
+        plan = self.jmngr.plan_job_status_change(job, 'requeued')
+        self.assertEqual(['requeued', 'queued', 'completed'], plan.statuses)
+        self.assertFalse(plan.tasks_changed)
+
+        job['task_status_counts'] = {'completed': 2, 'failed': 1}
+        plan = self.jmngr.plan_job_status_change(job, 'requeued')
+        self.assertEqual(['requeued', 'queued'], plan.statuses)
+        self.assertEqual({'failed': -1, 'queued': 1},
+                         {status: delta for status, delta in plan.count_deltas.items() if delta})
+
+        with self.assertRaises(ValueError):
+            self.jmngr.plan_job_status_change(job, 'nonexistant-status')
+
+    def test_status_change_single_timestamp(self):
+        import datetime
+        from bson import tz_util
+
+        self.force_job_status('active')
+        now = datetime.datetime.now(tz=tz_util.utc).replace(microsecond=0)
+
+        with self.app.test_request_context():
+            self.jmngr.api_set_job_status(self.job_id, 'cancel-requested', now=now)
+
+            jobs_coll = self.flamenco.db('jobs')
+            job = jobs_coll.find_one(self.job_id)
+            self.assertEqual('cancel-requested', job['status'])
+            self.assertEqual(now, job['_updated'])
+
+            tasks_coll = self.flamenco.db('tasks')
+            for task_idx, expected_status in [(0, 'canceled'), (1, 'cancel-requested'),
+                                              (3, 'cancel-requested')]:
+                task = tasks_coll.find_one(self.task_ids[task_idx])
+                self.assertEqual(expected_status, task['status'])
+                self.assertEqual(now, task['_updated'])
+                self.assertIn('cancel-requested', task['activity'])
+
+    def test_transition_job_status(self):
+        self.force_job_status('active')
+
+        # The status only changes when the current status matches.
+        with self.app.test_request_context():
+            self.assertIsNone(self.jmngr.api_transition_job_status(
+                self.job_id, 'queued', 'cancel-requested'))
+        self.assert_job_status('active')
+        self.assert_task_status(0, 'queued')
+
+        with self.app.test_request_context():
+            job = self.jmngr.api_transition_job_status(self.job_id, 'active', 'cancel-requested')
+        self.assertEqual('active', job['status'])
+
+        self.assert_job_status('cancel-requested')
+        self.assert_task_status(0, 'canceled')
+
+    def test_task_status_counts(self):
+        # The move-to-final task is not part of self.task_ids, and is still queued.
+        expected = {'queued': 2, 'claimed-by-manager': 1, 'completed': 1, 'active': 1,
+                    'canceled': 1, 'failed': 1, 'cancel-requested': 1, 'paused': 1}
+
+        with self.app.test_request_context():
+            self.assertEqual(expected, self.jmngr.task_status_counts(self.job_id))
+
+        # Changing the job status changes task statuses, which should be counted.
+        self.force_job_status('active')
+        self.set_job_status('failed')
+
+        with self.app.test_request_context():
+            counts = self.jmngr.task_status_counts(self.job_id)
+            self.assertEqual({'canceled': 3, 'cancel-requested': 3, 'completed': 1,
+                              'failed': 1, 'paused': 1}, counts)
+
+            # A full recount should produce the same numbers.
+            recounted = self.jmngr.api_recount_task_statuses([self.job_id])
+            self.assertEqual(counts, recounted[self.job_id])
+
+            # Deleting the tasks should reset the counts.
+            self.tmngr.api_delete_tasks_for_job(self.job_id)
+            self.assertEqual({}, self.jmngr.task_status_counts(self.job_id))
+
+    def test_task_status_counts_missing(self):
+        """Jobs from before task status counting should be recounted on first use."""
+
+        with self.app.test_request_context():
+            jobs_coll = self.flamenco.db('jobs')
+            jobs_coll.update_one({'_id': self.job_id}, {'$unset': {'task_status_counts': 1}})
+
+            # Incrementing should not create a partial count.
+            self.jmngr.api_inc_task_status_counts({self.job_id: {'completed': 1}})
+            job = jobs_coll.find_one(self.job_id)
+            self.assertNotIn('task_status_counts', job)
+
+            counts = self.jmngr.task_status_counts(self.job_id)
+            self.assertEqual(9, sum(counts.values()))
+            job = jobs_coll.find_one(self.job_id)
+            self.assertEqual(counts, job['task_status_counts'])
+
+    def test_task_status_counts_concurrent_change(self):
+        """Tasks changing status while updating their statuses should be counted correctly."""
+
+        from flamenco.tasks import TaskManager
+
+        real_status_transitions = TaskManager.status_transitions
+
+        def status_transitions(tmngr, query, new_status):
+            transitions = real_status_transitions(tmngr, query, new_status)
+            if status_transitions.first_call:
+                status_transitions.first_call = False
+                # Another writer changes a task after the transitions were determined.
+                self.flamenco.update_status('tasks', self.task_ids[0], 'active')
+            return transitions
+
+        status_transitions.first_call = True
+
+        with self.app.test_request_context():
+            with mock.patch.object(TaskManager, 'status_transitions', autospec=True,
+                                   side_effect=status_transitions):
+                self.tmngr.api_set_task_status_for_job(self.job_id, 'queued', 'canceled')
+
+            counts = self.jmngr.task_status_counts(self.job_id)
+            recounted = self.jmngr.api_recount_task_statuses([self.job_id])
+            self.assertEqual(recounted[self.job_id], counts)
+            self.assertNotIn('queued', counts)
+
+        self.assert_task_status(0, 'active')
+
+    def test_task_status_counts_eve_hooks(self):
+        """Tasks created and deleted via Eve should be counted."""
+
+        import bson
+        from flamenco.tasks import eve_hooks
+
+        mngr_man = self.flamenco.manager_manager
+        with self.app.test_request_context():
+            tasks_coll = self.flamenco.db('tasks')
+            task = tasks_coll.find_one(self.task_ids[0])
+            task['_id'] = bson.ObjectId()
+            task['status'] = 'cancel-requested'
+            tasks_coll.insert_one(task)
+
+            eve_hooks.after_inserting_tasks([task])
+            self.assertEqual(2, self.jmngr.task_status_counts(self.job_id)['cancel-requested'])
+            version = mngr_man.api_info(task['manager'])['cancel_requested_version']
+            self.assertIn(task['_id'], mngr_man.cancel_requested_tasks(task['manager'], version))
+
+            tasks_coll.delete_one({'_id': task['_id']})
+            eve_hooks.after_deleting_task(task)
+            counts = self.jmngr.task_status_counts(self.job_id)
+            self.assertEqual(1, counts['cancel-requested'])
+            self.assertEqual(self.jmngr.api_recount_task_statuses([self.job_id])[self.job_id],
+                             counts)
+
     @mock.patch('flamenco.jobs.JobManager.handle_job_status_change')
     def test_put_job(self, handle_job_status_change):
         """Test that flamenco.jobs.JobManager.handle_job_status_change is called when we PUT."""
@@ -72,11 +72,9 @@ class JobPatchingTest(AbstractFlamencoTest):
             job = jobs_coll.find_one({'_id': self.job_id})
             self.assertEqual('completed', job['status'])
 
-    @mock.patch('flamenco.jobs.JobManager.handle_job_status_change')
-    def test_task_status_change_due_to_job_patch(self, mock_handle_job_status_change):
+    def test_task_status_change_due_to_job_patch(self):
         self.assert_job_status('queued')
 
-        mock_handle_job_status_change.return_value = None
         self.patch(
             '/api/flamenco/jobs/%s' % self.job_id,
             json={'op': 'set-job-status',
@@ -85,19 +83,15 @@ class JobPatchingTest(AbstractFlamencoTest):
             expected_status=204,
         )
 
-        mock_handle_job_status_change.assert_called_with(
-            self.job_id, 'queued', 'completed')
         self.assert_job_status('completed')
 
-    @mock.patch('flamenco.jobs.JobManager.handle_job_status_change')
-    def test_set_job_valid_status_as_outside_subscriber(self, mock_handle_job_status_change):
+    def test_set_job_valid_status_as_outside_subscriber(self):
         """Flamenco users not member of the project should not be allowed to do this."""
 
         self.create_user(user_id=24 * 'e', roles={'subscriber'},
                          token='flamuser-token')
 
         self.assert_job_status('queued')
-        mock_handle_job_status_change.return_value = None
         self.patch(
             '/api/flamenco/jobs/%s' % self.job_id,
             json={'op': 'set-job-status',
@@ -106,11 +100,9 @@ class JobPatchingTest(AbstractFlamencoTest):
             expected_status=403,
         )
 
-        mock_handle_job_status_change.assert_not_called()
         self.assert_job_status('queued')
 
-    @mock.patch('flamenco.jobs.JobManager.handle_job_status_change')
-    def test_set_job_valid_status_as_projmember_subscriber(self, mock_handle_job_status_change):
+    def test_set_job_valid_status_as_projmember_subscriber(self):
         """Subscribers member of the project should be allowed to do this."""
 
         from pillar.api.projects.utils import get_admin_group_id
@@ -123,7 +115,6 @@ class JobPatchingTest(AbstractFlamencoTest):
                          token='flamuser-token')
 
         self.assert_job_status('queued')
-        mock_handle_job_status_change.return_value = None
         self.patch(
             '/api/flamenco/jobs/%s' % self.job_id,
             json={'op': 'set-job-status',
@@ -132,8 +123,6 @@ class JobPatchingTest(AbstractFlamencoTest):
             expected_status=204,
         )
 
-        mock_handle_job_status_change.assert_called_with(
-            self.job_id, 'queued', 'completed')
         self.assert_job_status('completed')
 
     @mock.patch('flamenco.tasks.TaskManager.api_set_task_status_for_job')
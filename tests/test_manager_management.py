@@ -225,6 +225,52 @@ class ManagerAccessTest(AbstractFlamencoTest):
             all_tokens = tokens_coll.find({'user': service_account_id})
             self.assertEqual(all_tokens.count(), 0)
 
+    def test_api_info_cache(self):
+        with self.app.test_request_context():
+            mngr_man = self.flamenco.manager_manager
+            info = mngr_man.api_info(self.mngr_id)
+            self.assertEqual(self.mngr_doc['service_account'], info['service_account'])
+
+            # Changes made behind the cache's back are only seen after invalidation.
+            managers_coll = self.flamenco.db('managers')
+            managers_coll.update_one({'_id': self.mngr_id},
+                                     {'$set': {'depsgraph_generation': 47}})
+            self.assertIs(info, mngr_man.api_info(self.mngr_id))
+
+            mngr_man.revoke_auth_token(self.mngr_id)
+            self.assertEqual(47, mngr_man.api_info(self.mngr_id)['depsgraph_generation'])
+
+            self.assertIsNone(mngr_man.api_info(bson.ObjectId()))
+
+    def test_api_info_cache_depsgraph_generation(self):
+        with self.app.test_request_context():
+            mngr_man = self.flamenco.manager_manager
+            info = mngr_man.api_info(self.mngr_id)
+
+            managers_coll = self.flamenco.db('managers')
+            managers_coll.update_one({'_id': self.mngr_id},
+                                     {'$set': {'depsgraph_generation': 47,
+                                               'cancel_requested_version': 3}})
+
+            # Bumping the generation refreshes it in the cache, without refetching.
+            mngr_man.api_bump_depsgraph_generation([self.mngr_id])
+            refreshed = mngr_man.api_info(self.mngr_id)
+            self.assertEqual(48, refreshed['depsgraph_generation'])
+            self.assertEqual(info.get('cancel_requested_version'),
+                             refreshed.get('cancel_requested_version'))
+
+    def test_api_info_cache_bounded(self):
+        self.app.config['FLAMENCO_MANAGER_API_CACHE_SIZE'] = 1
+        other_mngr, _, _ = self.create_manager_service_account()
+
+        with self.app.test_request_context():
+            mngr_man = self.flamenco.manager_manager
+            info = mngr_man.api_info(self.mngr_id)
+            mngr_man.api_info(other_mngr['_id'])
+
+            # The first Manager should have been evicted, and thus be fetched again.
+            self.assertIsNot(info, mngr_man.api_info(self.mngr_id))
+
     def test_share(self):
 
         owner_gid = self.mngr_doc['owner']
@@ -0,0 +1,95 @@
+import gzip
+import importlib.util
+import unittest
+
+
+class GunzipLimitedTest(unittest.TestCase):
+    def test_happy(self):
+        from flamenco.managers.payload import gunzip_limited
+
+        data = 100 * 'je moeder '.encode()
+        compressed = gzip.compress(data)
+        chunks = [compressed[:10], compressed[10:50], compressed[50:]]
+
+        self.assertEqual(data, b''.join(gunzip_limited(chunks, len(data))))
+
+    def test_too_large(self):
+        from flamenco.managers.payload import gunzip_limited, PayloadTooLarge
+
+        compressed = gzip.compress(1024 * 1024 * b'\0')
+
+        with self.assertRaises(PayloadTooLarge):
+            for _ in gunzip_limited([compressed], 1024):
+                pass
+
+    def test_invalid_data(self):
+        import zlib
+        from flamenco.managers.payload import gunzip_limited
+
+        with self.assertRaises(zlib.error):
+            list(gunzip_limited([b'this is not gzip'], 1024))
+
+
+class IterNDJSONTest(unittest.TestCase):
+    def test_happy(self):
+        from flamenco.managers.payload import iter_ndjson
+
+        chunks = [b'{"a": 1}\n{"b"', b': 2}\n\n', b'{"c": 3}']
+        self.assertEqual([{'a': 1}, {'b': 2}, {'c': 3}], list(iter_ndjson(chunks, 1024)))
+
+    def test_line_too_large(self):
+        from flamenco.managers.payload import iter_ndjson, PayloadTooLarge
+
+        with self.assertRaises(PayloadTooLarge):
+            list(iter_ndjson([b'{"a": 1}\n', 64 * b'x'], 16))
+
+
+class DepsgraphBSONTest(unittest.TestCase):
+    def test_encode_bson(self):
+        import bson
+        from flamenco.managers.depsgraph import encode_bson
+
+        tasks = [{'_id': bson.ObjectId(), 'status': 'active', 'name': 'task %d' % idx}
+                 for idx in range(12)]
+        batches = [tasks[:5], tasks[5:10], tasks[10:]]
+
+        self.assertEqual(bson.BSON.encode({'depsgraph': tasks}), encode_bson(batches))
+
+
+@unittest.skipUnless(importlib.util.find_spec('msgpack'), 'msgpack is not installed')
+class MsgpackEncodingTest(unittest.TestCase):
+    def test_roundtrip(self):
+        import datetime
+        import bson
+        from bson import tz_util
+        from flamenco.managers import msgpack_encoding
+
+        doc = {'_id': bson.ObjectId(),
+               'when': datetime.datetime(2018, 7, 6, 10, 47, 3, 120000, tzinfo=tz_util.utc),
+               'naive': datetime.datetime(2018, 7, 6, 10, 47, 3),
+               'gz_log': b'\x1f\x8b',
+               'nested': [{'name': 'task'}]}
+        decoded = msgpack_encoding.unpackb(msgpack_encoding.packb(doc))
+
+        self.assertEqual(doc['_id'], decoded['_id'])
+        self.assertEqual(doc['when'], decoded['when'])
+        self.assertEqual(doc['naive'].replace(tzinfo=tz_util.utc), decoded['naive'])
+        self.assertEqual(doc['gz_log'], decoded['gz_log'])
+        self.assertEqual(doc['nested'], decoded['nested'])
+
+    def test_invalid_data(self):
+        from flamenco.managers import msgpack_encoding
+
+        with self.assertRaises(ValueError):
+            msgpack_encoding.unpackb(b'\x92\x01')
+
+    def test_encode_depsgraph(self):
+        import bson
+        from flamenco.managers import msgpack_encoding
+        from flamenco.managers.depsgraph import encode_msgpack
+
+        tasks = [{'_id': bson.ObjectId(), 'status': 'active', 'name': 'task %d' % idx}
+                 for idx in range(12)]
+        batches = [tasks[:5], tasks[5:10], tasks[10:]]
+
+        self.assertEqual(msgpack_encoding.packb({'depsgraph': tasks}), encode_msgpack(batches))
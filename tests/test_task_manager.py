@@ -67,6 +67,66 @@ class TaskManagerTest(AbstractFlamencoTest):
 
         return job_doc['_id']
 
+    def test_task_buffer(self):
+        import werkzeug.exceptions as wz_exceptions
+        from pillar.api.utils.authentication import force_cli_user
+        from flamenco.job_compilers import commands
+
+        manager, _, _ = self.create_manager_service_account()
+
+        with self.app.test_request_context():
+            force_cli_user()
+            job_doc = self.jmngr.api_create_job(
+                'test job',
+                'Wörk wørk w°rk.',
+                'sleep', {
+                    'frames': '12-18, 20-22',
+                    'chunk_size': 7,
+                    'time_in_seconds': 3,
+                },
+                self.proj_id,
+                ctd.EXAMPLE_PROJECT_OWNER_ID,
+                manager['_id'],
+            )
+            job_id = job_doc['_id']
+            tasks_coll = self.flamenco.db('tasks')
+
+            self.app.config['FLAMENCO_TASK_INSERT_BATCH_SIZE'] = 2
+            buffer = self.tmngr.task_buffer(job_doc)
+            cmds = [commands.Sleep(time_in_seconds=3)]
+            first_id = buffer.create_task(cmds, 'first', status='under-construction',
+                                          task_type='sleep')
+            self.assertIsNone(tasks_coll.find_one(first_id))
+
+            # Parents can be referred to before they are inserted.
+            second_id = buffer.create_task(cmds, 'second', parents=[first_id],
+                                           status='under-construction', task_type='sleep')
+            third_id = buffer.create_task(cmds, 'third', parents=[first_id, second_id],
+                                          status='under-construction', task_type='sleep')
+
+            # The first two tasks should have been flushed automatically.
+            self.assertIsNotNone(tasks_coll.find_one(second_id))
+            self.assertIsNone(tasks_coll.find_one(third_id))
+            buffer.flush()
+            self.assertEqual(3, buffer.inserted_count)
+
+            third = tasks_coll.find_one(third_id)
+            self.assertEqual([first_id, second_id], third['parents'])
+            self.assertEqual('under-construction', third['status'])
+            self.assertEqual(manager['_id'], third['manager'])
+            self.assertIn('_created', third)
+            self.assertIn('_etag', third)
+
+            counts = self.jmngr.task_status_counts(job_id)
+            self.assertEqual(3, counts['under-construction'])
+
+            # Invalid tasks should be refused.
+            with self.assertRaises(wz_exceptions.InternalServerError):
+                buffer.create_task(cmds, 'invalid', status='finished', task_type='sleep')
+            with self.assertRaises(wz_exceptions.InternalServerError):
+                buffer.create_task(cmds, 'orphan', parents=[job_id],
+                                   status='under-construction', task_type='sleep')
+
     def test_api_find_jobfinal_tasks(self):
         from pillar.api.utils.authentication import force_cli_user
         from flamenco.job_compilers import commands
@@ -1,5 +1,9 @@
 # -*- encoding: utf-8 -*-
 
+import importlib.util
+import unittest
+from unittest import mock
+
 from bson import ObjectId
 
 from pillar.tests import common_test_data as ctd
@@ -99,6 +103,216 @@ class TaskBatchUpdateTest(AbstractTaskBatchUpdateTest):
                          dateutil.parser.parse('2018-03-04T3:27:47+02:00'))
         self.assertNotEqual(db_task['_etag'], etag_before)
 
+    def test_multiple_updates_same_task(self):
+        """Updates for the same task in one batch should be applied in order."""
+
+        chunk = self.get('/api/flamenco/managers/%s/depsgraph' % self.mngr_id,
+                         auth_token=self.mngr_token).json['depsgraph']
+        task = chunk[0]
+        other_task = chunk[1]
+
+        update_ids = [str(ObjectId()) for _ in range(3)]
+        resp = self.post('/api/flamenco/managers/%s/task-update-batch' % self.mngr_id,
+                         auth_token=self.mngr_token,
+                         json=[{
+                             '_id': update_ids[0],
+                             'task_id': task['_id'],
+                             'task_status': 'active',
+                             'activity': 'starting',
+                             'log': 'first log line',
+                             'received_on_manager': '2018-03-04T3:27:47+02:00',
+                         }, {
+                             '_id': update_ids[1],
+                             'task_id': other_task['_id'],
+                             'task_status': 'active',
+                             'received_on_manager': '2018-03-04T3:27:48+02:00',
+                         }, {
+                             '_id': update_ids[2],
+                             'task_id': task['_id'],
+                             'task_status': 'completed',
+                             'activity': 'done',
+                             'log': 'second log line',
+                             'received_on_manager': '2018-03-04T3:27:49+02:00',
+                         }])
+
+        self.assertEqual(update_ids, resp.json['handled_update_ids'])
+        self.assertEqual(2, resp.json['modified_count'])
+
+        db_task = self.assert_task_status(task['_id'], 'completed')
+        self.assertEqual('done', db_task['activity'])
+        self.assert_task_status(other_task['_id'], 'active')
+
+        with self.app.test_request_context():
+            logs_coll = self.flamenco.db('task_logs')
+            logs = logs_coll.find({'task': ObjectId(task['_id'])}).sort('received_on_manager')
+            self.assertEqual(['first log line', 'second log line'],
+                             [log_entry['log'] for log_entry in logs])
+
+    def test_gz_log(self):
+        import base64
+        import gzip
+
+        chunk = self.get('/api/flamenco/managers/%s/depsgraph' % self.mngr_id,
+                         auth_token=self.mngr_token).json['depsgraph']
+        task = chunk[0]
+
+        gz_log = base64.b64encode(gzip.compress('je möeder'.encode('utf8'))).decode('ascii')
+        task_update_id = 24 * '0'
+        resp = self.post('/api/flamenco/managers/%s/task-update-batch' % self.mngr_id,
+                         auth_token=self.mngr_token,
+                         json=[{
+                             '_id': task_update_id,
+                             'task_id': task['_id'],
+                             'received_on_manager': '2018-03-04T3:27:47+02:00',
+                             'gz_log': gz_log,
+                         }])
+        self.assertEqual(resp.json['handled_update_ids'], [task_update_id])
+
+        with self.app.test_request_context():
+            log_entry = self.flamenco.db('task_logs').find_one(ObjectId(task_update_id))
+        self.assertEqual('je möeder', log_entry['log'])
+
+    def test_replayed_updates(self):
+        """Updates that were handled before should be acknowledged, but not handled again."""
+
+        chunk = self.get('/api/flamenco/managers/%s/depsgraph' % self.mngr_id,
+                         auth_token=self.mngr_token).json['depsgraph']
+        task = chunk[0]
+
+        update = {
+            '_id': str(ObjectId()),
+            'task_id': task['_id'],
+            'task_status': 'active',
+            'activity': 'starting',
+            'log': 'first log line',
+        }
+        url = '/api/flamenco/managers/%s/task-update-batch' % self.mngr_id
+        resp = self.post(url, auth_token=self.mngr_token, json=[update])
+        self.assertEqual([update['_id']], resp.json['handled_update_ids'])
+        self.assertEqual(1, resp.json['modified_count'])
+
+        with self.app.test_request_context():
+            tasks_coll = self.flamenco.db('tasks')
+            tasks_coll.update_one({'_id': ObjectId(task['_id'])},
+                                  {'$set': {'activity': 'changed in the meantime'}})
+
+        # Resend the update together with a new one.
+        new_update = {
+            '_id': str(ObjectId()),
+            'task_id': task['_id'],
+            'task_progress_percentage': 50,
+        }
+        resp = self.post(url, auth_token=self.mngr_token, json=[update, new_update])
+        self.assertEqual([update['_id'], new_update['_id']], resp.json['handled_update_ids'])
+        self.assertEqual(1, resp.json['modified_count'])
+
+        db_task = self.assert_task_status(task['_id'], 'active')
+        self.assertEqual('changed in the meantime', db_task['activity'])
+        self.assertEqual(50, db_task['task_progress_percentage'])
+
+    def test_gzipped_request_body(self):
+        import gzip
+        import json
+
+        chunk = self.get('/api/flamenco/managers/%s/depsgraph' % self.mngr_id,
+                         auth_token=self.mngr_token).json['depsgraph']
+        task = chunk[0]
+
+        task_update_id = 24 * '0'
+        body = gzip.compress(json.dumps([{
+            '_id': task_update_id,
+            'task_id': task['_id'],
+            'task_status': 'active',
+            'log': 'compressed log',
+        }]).encode('utf8'))
+        resp = self.post('/api/flamenco/managers/%s/task-update-batch' % self.mngr_id,
+                         auth_token=self.mngr_token,
+                         data=body,
+                         headers={'Content-Encoding': 'gzip',
+                                  'Content-Type': 'application/json'})
+        self.assertEqual(resp.json['handled_update_ids'], [task_update_id])
+        self.assert_task_status(task['_id'], 'active')
+
+        # Too large decompressed bodies should be rejected.
+        self.app.config['FLAMENCO_MAX_DECOMPRESSED_REQUEST_SIZE'] = 16
+        self.post('/api/flamenco/managers/%s/task-update-batch' % self.mngr_id,
+                  auth_token=self.mngr_token,
+                  data=body,
+                  headers={'Content-Encoding': 'gzip',
+                           'Content-Type': 'application/json'},
+                  expected_status=413)
+
+    def test_ndjson_request_body(self):
+        import json
+
+        chunk = self.get('/api/flamenco/managers/%s/depsgraph' % self.mngr_id,
+                         auth_token=self.mngr_token).json['depsgraph']
+        task = chunk[0]
+
+        # Use tiny sub-batches, so that the stream is handled in multiple steps.
+        self.app.config['FLAMENCO_TASK_UPDATE_SUB_BATCH_SIZE'] = 2
+
+        updates = [{'_id': '%024x' % idx,
+                    'task_id': task['_id'],
+                    'task_status': status,
+                    'activity': 'update %i' % idx}
+                   for idx, status in enumerate(['active', 'active', 'completed'])]
+        body = '\n'.join(json.dumps(update) for update in updates) + '\n\n'
+        resp = self.post('/api/flamenco/managers/%s/task-update-batch' % self.mngr_id,
+                         auth_token=self.mngr_token,
+                         data=body.encode('utf8'),
+                         headers={'Content-Type': 'application/x-ndjson'})
+        self.assertEqual(resp.json['handled_update_ids'], [u['_id'] for u in updates])
+        self.assert_task_status(task['_id'], 'completed')
+
+        # Invalid JSON should be rejected.
+        self.post('/api/flamenco/managers/%s/task-update-batch' % self.mngr_id,
+                  auth_token=self.mngr_token,
+                  data=b'{"_id": ',
+                  headers={'Content-Type': 'application/x-ndjson'},
+                  expected_status=400)
+
+    @unittest.skipUnless(importlib.util.find_spec('msgpack'), 'msgpack is not installed')
+    def test_msgpack_request_and_response(self):
+        import datetime
+        import gzip
+        from bson import tz_util
+        from flamenco.managers import msgpack_encoding
+
+        chunk = self.get('/api/flamenco/managers/%s/depsgraph' % self.mngr_id,
+                         auth_token=self.mngr_token).json['depsgraph']
+        task_id = ObjectId(chunk[0]['_id'])
+
+        update_id = ObjectId(24 * '1')
+        received_on_manager = datetime.datetime(2018, 7, 6, 10, 47, 3, tzinfo=tz_util.utc)
+        body = msgpack_encoding.packb([{
+            '_id': update_id,
+            'task_id': task_id,
+            'task_status': 'active',
+            'received_on_manager': received_on_manager,
+            'gz_log': gzip.compress(b'msgpack log'),
+        }])
+        resp = self.post('/api/flamenco/managers/%s/task-update-batch' % self.mngr_id,
+                         auth_token=self.mngr_token,
+                         data=body,
+                         headers={'Content-Type': 'application/msgpack',
+                                  'Accept': 'application/msgpack'})
+        self.assertEqual('application/msgpack', resp.mimetype)
+        self.assertEqual([update_id], msgpack_encoding.unpackb(resp.data)['handled_update_ids'])
+
+        task = self.assert_task_status(task_id, 'active')
+        self.assertEqual(received_on_manager, task['_updated'])
+        with self.app.test_request_context():
+            task_log = self.flamenco.db('task_logs').find_one({'_id': update_id})
+        self.assertEqual('msgpack log', task_log['log'])
+
+        # Invalid MessagePack should be rejected.
+        self.post('/api/flamenco/managers/%s/task-update-batch' % self.mngr_id,
+                  auth_token=self.mngr_token,
+                  data=b'\x92\x01',
+                  headers={'Content-Type': 'application/msgpack'},
+                  expected_status=400)
+
     def test_set_task_invalid_status(self):
         chunk = self.get('/api/flamenco/managers/%s/depsgraph' % self.mngr_id,
                          auth_token=self.mngr_token).json['depsgraph']
@@ -177,6 +391,101 @@ class TaskBatchUpdateTest(AbstractTaskBatchUpdateTest):
         self.assertNotIn('cancel_task_ids', resp_json)
         self.assert_task_status(task_id, 'canceled')
 
+    def test_cancel_requested_during_update(self):
+        """A status change from the Manager should not overwrite a concurrent cancel request."""
+
+        from flamenco import current_flamenco
+        from flamenco.managers import api
+
+        chunk = self.get('/api/flamenco/managers/%s/depsgraph' % self.mngr_id,
+                         auth_token=self.mngr_token).json['depsgraph']
+        task = chunk[0]
+        task_id = ObjectId(task['_id'])
+        real_determine_new_task_status = api.determine_new_task_status
+
+        def determine_new_task_status(*args):
+            # Request cancellation after the task was fetched for handling the update.
+            if determine_new_task_status.first_call:
+                determine_new_task_status.first_call = False
+                current_flamenco.update_status('tasks', task_id, 'cancel-requested')
+            return real_determine_new_task_status(*args)
+
+        determine_new_task_status.first_call = True
+
+        task_update_id = 24 * '0'
+        with mock.patch('flamenco.managers.api.determine_new_task_status',
+                        side_effect=determine_new_task_status):
+            resp = self.post('/api/flamenco/managers/%s/task-update-batch' % self.mngr_id,
+                             auth_token=self.mngr_token,
+                             json=[{
+                                 '_id': task_update_id,
+                                 'task_id': task['_id'],
+                                 'task_status': 'active',
+                                 'activity': 'starting',
+                             }])
+
+        resp_json = resp.json
+        self.assertEqual(resp_json['handled_update_ids'], [task_update_id])
+        self.assertEqual(resp_json['cancel_task_ids'], [task['_id']])
+
+        db_task = self.assert_task_status(task_id, 'cancel-requested')
+        self.assertEqual('starting', db_task['activity'])
+
+        with self.app.test_request_context():
+            counts = self.jmngr.task_status_counts(self.job_id)
+        self.assertEqual(1, counts['cancel-requested'])
+        self.assertNotIn('active', counts)
+
+    def test_concurrent_write_after_status_change(self):
+        """Written status changes should be counted, even when their _etag changed since."""
+
+        from flamenco import current_flamenco
+        from flamenco.managers import api
+
+        chunk = self.get('/api/flamenco/managers/%s/depsgraph' % self.mngr_id,
+                         auth_token=self.mngr_token).json['depsgraph']
+        written_task_id = ObjectId(chunk[0]['_id'])
+        conflicting_task_id = ObjectId(chunk[1]['_id'])
+        real_determine_new_task_status = api.determine_new_task_status
+        real_retry = api.retry_conflicting_task_updates
+
+        def determine_new_task_status(*args):
+            # Request cancellation after the task was fetched for handling the update.
+            if args[1] == conflicting_task_id and determine_new_task_status.first_call:
+                determine_new_task_status.first_call = False
+                current_flamenco.update_status('tasks', conflicting_task_id, 'cancel-requested')
+            return real_determine_new_task_status(*args)
+
+        determine_new_task_status.first_call = True
+
+        def retry_conflicting_task_updates(*args):
+            # Another non-status write to the task whose status change was written.
+            current_flamenco.db('tasks').update_one(
+                {'_id': written_task_id},
+                {'$set': {'activity': 'concurrently written', '_etag': 'other-etag'}})
+            return real_retry(*args)
+
+        with mock.patch('flamenco.managers.api.determine_new_task_status',
+                        side_effect=determine_new_task_status), \
+                mock.patch('flamenco.managers.api.retry_conflicting_task_updates',
+                           side_effect=retry_conflicting_task_updates) as mock_retry:
+            self.post('/api/flamenco/managers/%s/task-update-batch' % self.mngr_id,
+                      auth_token=self.mngr_token,
+                      json=[{'_id': 24 * '0', 'task_id': str(written_task_id),
+                             'task_status': 'active'},
+                            {'_id': 24 * '1', 'task_id': str(conflicting_task_id),
+                             'task_status': 'active'}])
+        self.assertEqual(1, mock_retry.call_count)
+
+        self.assert_task_status(written_task_id, 'active')
+        self.assert_task_status(conflicting_task_id, 'cancel-requested')
+        self.assert_job_status('active')
+
+        with self.app.test_request_context():
+            counts = self.jmngr.task_status_counts(self.job_id)
+        self.assertEqual(1, counts['active'])
+        self.assertEqual(1, counts['cancel-requested'])
+
     def test_job_status_complete_due_to_task_update(self):
         """A task update batch should influence the job status."""
 
@@ -242,6 +551,38 @@ class TaskBatchUpdateTest(AbstractTaskBatchUpdateTest):
         self.do_batch_update(tasks, [1, 2, 3], 3 * ['canceled'])
         self.assert_job_status('canceled')
 
+    def test_cancel_requested_tasks_maintained(self):
+        """The Manager's set of cancel-requested tasks should follow the task statuses."""
+
+        self.force_job_status('queued')
+        tasks = self.do_schedule_tasks()
+        task_ids = [ObjectId(task['_id']) for task in tasks]
+
+        self.do_batch_update(tasks, [0], ['completed'])
+        self.set_job_status('cancel-requested')
+
+        def assert_cancel_requested(expected_task_ids):
+            with self.app.test_request_context():
+                mngr_doc = self.flamenco.db('managers').find_one(self.mngr_id)
+            self.assertEqual(set(expected_task_ids), set(mngr_doc['cancel_requested_tasks']))
+
+        assert_cancel_requested(task_ids[1:])
+
+        # The batch response should include those tasks, except the one that just got canceled.
+        self.do_batch_update(tasks, [1], ['canceled'],
+                             expect_cancel_task_ids={tasks[2]['_id'], tasks[3]['_id']})
+        assert_cancel_requested(task_ids[2:])
+
+        # Rebuilding from the tasks collection should give the same result.
+        with self.app.test_request_context():
+            counts = self.flamenco.manager_manager.api_rebuild_cancel_requested()
+        self.assertEqual({self.mngr_id: 2}, counts)
+        assert_cancel_requested(task_ids[2:])
+
+        self.do_batch_update(tasks, [2, 3], 2 * ['canceled'])
+        assert_cancel_requested([])
+        self.assert_job_status('canceled')
+
     def test_job_status_canceled_after_request_with_all_tasks_canceled(self):
         """Same as test_job_status_canceled_due_to_task_update(), except that in this test
         all tasks are in a state that can be immediately cancelled without waiting for the
@@ -359,6 +700,23 @@ class LargeTaskBatchUpdateTest(AbstractTaskBatchUpdateTest):
             expect_cancel_task_ids={t['_id'] for t in tasks[10:]})
         self.assert_job_status('failed')
 
+    def test_job_status_evaluated_once_per_batch(self):
+        from flamenco.jobs import JobManager
+
+        self.force_job_status('queued')
+        tasks = self.do_schedule_tasks()
+
+        orig = JobManager.update_job_after_task_status_change
+        with mock.patch.object(JobManager, 'update_job_after_task_status_change',
+                               autospec=True, side_effect=orig) as mock_update:
+            self.do_batch_update(
+                tasks, list(range(50)), 25 * ['completed'] + 25 * ['claimed-by-manager'])
+
+        # Claimed-by-manager has no influence on the job, and 'completed' should only be
+        # evaluated once for the entire batch.
+        self.assertEqual(1, mock_update.call_count)
+        self.assert_job_status('active')
+
     def test_job_status_failed_with_mixture_of_canceled_and_failed_tasks(self):
         self.force_job_status('queued')
         tasks = self.do_schedule_tasks()